@@ -0,0 +1,205 @@
+"""In-memory index of when tracked shows air next, with release events.
+
+Shows get tracked from any media the backend fetches with its
+nextAiringEpisode, or by id through `watch` when only the id is at hand
+(catalog lists). The index keeps a min-heap of upcoming airingAt times; a
+background task sleeps until the earliest one, announces the episodes that
+just aired to subscribers, and then asks AniList for the next airing of
+exactly those shows (plus any newly watched ones) in one batched query.
+Endpoints read nextAiringEpisode out of the index, with timeUntilAiring
+computed at read time, instead of querying for it.
+"""
+import asyncio, heapq, time
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+# Per media, the upcoming episode as {"airingAt", "episode"} or None when nothing is scheduled
+NextAiring = Optional[dict]
+
+
+class AiringSchedule:
+    def __init__(
+        self,
+        fetch: Callable[[list[int]], Awaitable[dict[int, NextAiring]]],
+        batch_size: int = 50,
+        max_sleep: float = 60.0,
+        retry_after: float = 60.0,
+        recheck_after: float = 6 * 3600.0,
+        max_tracked: int = 20000,
+    ):
+        # ids -> next airing of each id AniList knows about
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self.retry_after = retry_after
+        self.recheck_after = recheck_after
+        self.max_tracked = max_tracked
+        self._next: dict[int, NextAiring] = {}
+        self._checked_at: dict[int, float] = {}
+        # (airingAt, media id, episode); entries that no longer match _next are skipped when popped
+        self._heap: list[tuple[int, int, int]] = []
+        self._pending: set[int] = set()
+        self._subscribers: set[asyncio.Queue] = set()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"released": 0, "refreshes": 0, "refreshed": 0, "errors": 0, "dropped_events": 0}
+
+    def __len__(self) -> int:
+        return len(self._next)
+
+    def __contains__(self, media_id: int) -> bool:
+        return media_id in self._next
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def update(self, media_id: int, next_airing: NextAiring):
+        """Record what a fetch said about one show"""
+        if media_id not in self._next and len(self._next) >= self.max_tracked:
+            return
+        if next_airing and next_airing.get("airingAt"):
+            next_airing = {"airingAt": next_airing["airingAt"], "episode": next_airing["episode"]}
+            if self._next.get(media_id) != next_airing:
+                heapq.heappush(self._heap, (next_airing["airingAt"], media_id, next_airing["episode"]))
+                self._wake.set()
+        else:
+            next_airing = None
+        self._next[media_id] = next_airing
+        self._checked_at[media_id] = time.time()
+        self._pending.discard(media_id)
+
+    def track(self, media: Iterable[dict]):
+        """Record every media object that was fetched with its id and nextAiringEpisode"""
+        for item in media:
+            if "id" in item and "nextAiringEpisode" in item:
+                self.update(item["id"], item["nextAiringEpisode"])
+
+    def watch(self, media_ids: Iterable[int]):
+        """Look up shows the index doesn't know, or hasn't checked in a while, on the next pass"""
+        now = time.time()
+        for media_id in media_ids:
+            if now - self._checked_at.get(media_id, 0) > self.recheck_after and media_id not in self._pending:
+                if len(self._next) + len(self._pending) < self.max_tracked:
+                    self._pending.add(media_id)
+                    self._wake.set()
+
+    def next_airing(self, media_id: int, countdown: bool = True) -> Optional[dict]:
+        """
+        nextAiringEpisode as AniList would return it right now, None when
+        unknown or not airing. Without countdown timeUntilAiring is left out,
+        for bodies that must stay the same from one second to the next.
+        """
+        entry = self._next.get(media_id)
+        if entry is None:
+            return None
+        until = entry["airingAt"] - int(time.time())
+        if until <= 0:
+            # Aired, the refresh for the following one is under way
+            return None
+        if not countdown:
+            return {"airingAt": entry["airingAt"], "episode": entry["episode"]}
+        return {"airingAt": entry["airingAt"], "timeUntilAiring": until, "episode": entry["episode"]}
+
+    def fill(self, media_id: int, media: dict, countdown: bool = True) -> dict:
+        """The media with nextAiringEpisode from the index, unchanged when the index doesn't know the show"""
+        if media_id not in self._next:
+            return media
+        return {**media, "nextAiringEpisode": self.next_airing(media_id, countdown)}
+
+    def upcoming(self, limit: int = 50) -> list[dict]:
+        now = int(time.time())
+        entries = sorted(
+            (entry["airingAt"], media_id, entry["episode"])
+            for media_id, entry in self._next.items() if entry and entry["airingAt"] > now
+        )
+        return [
+            {"mediaId": media_id, "episode": episode, "airingAt": airing_at, "timeUntilAiring": airing_at - now}
+            for airing_at, media_id, episode in entries[:limit]
+        ]
+
+    async def subscribe(self, media_ids: Optional[set[int]] = None, heartbeat: float = 15.0,
+                        max_queue: int = 100) -> AsyncIterator[Optional[dict]]:
+        """Release events as they happen, only for media_ids when given; None after `heartbeat` idle seconds"""
+        queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if media_ids is None or event["mediaId"] in media_ids:
+                    yield event
+        finally:
+            self._subscribers.discard(queue)
+
+    def _publish(self, event: dict):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A client that stopped reading loses events rather than holding memory
+                self.stats["dropped_events"] += 1
+
+    def _due(self, now: float) -> list[int]:
+        """Pop every heap entry that has aired, announcing the ones still current"""
+        released = []
+        while self._heap and self._heap[0][0] <= now:
+            airing_at, media_id, episode = heapq.heappop(self._heap)
+            entry = self._next.get(media_id)
+            if entry is None or (entry["airingAt"], entry["episode"]) != (airing_at, episode):
+                continue
+            self._publish({"type": "episode", "mediaId": media_id, "episode": episode, "airedAt": airing_at})
+            self.stats["released"] += 1
+            released.append(media_id)
+        return released
+
+    async def _run(self):
+        retry: set[int] = set()
+        while True:
+            self._wake.clear()
+            now = time.time()
+            ids = set(self._due(now)) | retry | self._pending
+            retry = set()
+            batch = sorted(ids)
+            for start in range(0, len(batch), self.batch_size):
+                chunk = batch[start:start + self.batch_size]
+                try:
+                    found = await self.fetch(chunk)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # AniList down or the budget is gone, ask again later
+                    self.stats["errors"] += 1
+                    retry.update(chunk)
+                    continue
+                self.stats["refreshes"] += 1
+                self.stats["refreshed"] += len(chunk)
+                for media_id in chunk:
+                    self.update(media_id, found.get(media_id))
+                    entry = self._next.get(media_id)
+                    if entry is not None and entry["airingAt"] <= time.time():
+                        # AniList hasn't moved on to the following episode yet
+                        retry.add(media_id)
+
+            timeout = self.retry_after if retry else self.max_sleep
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
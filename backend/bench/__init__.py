@@ -0,0 +1,4 @@
+"""Local load-testing helpers for the backend.
+
+Run from the backend directory, e.g. ``python -m bench.catalog``.
+"""
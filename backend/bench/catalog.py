@@ -0,0 +1,69 @@
+"""Requests/sec of the catalog endpoints against the stub AniList server.
+
+Starts ``bench.stub_anilist`` and the backend ``main:app`` as uvicorn
+subprocesses, then drives ``/trending`` with N concurrent clients:
+
+    python -m bench.catalog --concurrency 50 200 1000 --duration 10
+
+--uncached gives every request a page of its own, so each one is an AniList
+call and the upstream connection pool is what gets measured.
+"""
+import argparse, asyncio, itertools, time
+import httpx
+from bench.servers import APP_PORT, STUB_ANILIST_PORT, running, wait_ready
+
+async def drive(url: str, concurrency: int, duration: float, uncached: bool = False) -> tuple[int, int]:
+    """Hammer url from concurrency workers, returns (ok, failed)"""
+    ok = failed = 0
+    pages = itertools.count(1)
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        async def worker():
+            nonlocal ok, failed
+            while time.monotonic() < deadline:
+                try:
+                    response = await client.get(url, params={"page": next(pages)} if uncached else None)
+                    if response.status_code == 200:
+                        ok += 1
+                    else:
+                        failed += 1
+                except httpx.HTTPError:
+                    failed += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return ok, failed
+
+async def run(concurrency_levels: list[int], duration: float, path: str, uncached: bool):
+    base = f"http://127.0.0.1:{APP_PORT}"
+    await wait_ready(f"http://127.0.0.1:{STUB_ANILIST_PORT}/docs")
+    await wait_ready(f"{base}/health")
+
+    print(f"{'clients':>8} {'req/s':>10} {'errors':>8}")
+    for concurrency in concurrency_levels:
+        started = time.monotonic()
+        ok, failed = await drive(base + path, concurrency, duration, uncached)
+        elapsed = time.monotonic() - started
+        print(f"{concurrency:>8} {ok / elapsed:>10.1f} {failed:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--path", default="/trending?per_page=12")
+    parser.add_argument("--uncached", action="store_true", help="a distinct page per request, all going upstream")
+    args = parser.parse_args()
+
+    app_env = {"ANILIST_URL": f"http://127.0.0.1:{STUB_ANILIST_PORT}"}
+    if args.uncached:
+        # The stub doesn't rate limit, neither should the governor
+        app_env["ANILIST_RATE_LIMIT"] = "1000000"
+    with running(
+        ("bench.stub_anilist:app", STUB_ANILIST_PORT, {}),
+        ("main:app", APP_PORT, app_env),
+    ):
+        asyncio.run(run(args.concurrency, args.duration, args.path, args.uncached))
+
+if __name__ == "__main__":
+    main()
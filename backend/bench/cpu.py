@@ -0,0 +1,88 @@
+"""Backend CPU time per GB relayed through ``/proxy``.
+
+Starts the fake CDN (unthrottled, so the proxy itself is the bottleneck) and
+the backend with the chunk cache off, then has N viewers read sequential
+ranges concurrently. CPU time is the backend process's user + system time
+from /proc, so this runs on Linux only:
+
+    python -m bench.cpu --streams 1 50 200 --total-mb 1024
+
+Extra backend settings (e.g. STREAM_MAX_CHUNK=65536) can be passed with --env.
+"""
+import argparse, asyncio, json, os, time
+from urllib.parse import quote
+import httpx
+from bench.servers import APP_PORT, FAKE_CDN_PORT, running, wait_ready
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the parenthesised command name; utime and stime are 14th and 15th overall
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+async def viewer(client: httpx.AsyncClient, url: str, size: int, budget: int, offset: int) -> int:
+    """Read sequential ranges from offset until budget bytes have arrived"""
+    received, position = 0, offset
+    while received < budget:
+        async with client.stream("GET", url, headers={"Range": f"bytes={position}-"}) as response:
+            async for chunk in response.aiter_raw():
+                received += len(chunk)
+                position += len(chunk)
+        if position >= size:
+            position = 0
+    return received
+
+async def measure(pid: int, streams: int, total: int, size: int) -> dict:
+    video = f"http://127.0.0.1:{FAKE_CDN_PORT}/cpu-{streams}.mp4"
+    url = f"http://127.0.0.1:{APP_PORT}/proxy?url={quote(video)}&ref=http://127.0.0.1"
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=streams)
+    async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+        # Warm the metadata cache so every stream measures the steady state
+        await client.get(url, headers={"Range": "bytes=0-0"})
+
+        budget = total // streams
+        cpu_before, started = cpu_seconds(pid), time.perf_counter()
+        received = await asyncio.gather(*(
+            viewer(client, url, size, budget, (i * size // streams) // 4096 * 4096) for i in range(streams)
+        ))
+        elapsed, cpu = time.perf_counter() - started, cpu_seconds(pid) - cpu_before
+
+    gigabytes = sum(received) / 1024 ** 3
+    return {
+        "streams": streams,
+        "gb": round(gigabytes, 3),
+        "cpu_s_per_gb": round(cpu / gigabytes, 2),
+        "mb_per_s": round(sum(received) / 1024 ** 2 / elapsed, 1),
+    }
+
+async def run(pid: int, args) -> list[dict]:
+    await wait_ready(f"http://127.0.0.1:{FAKE_CDN_PORT}/stats")
+    await wait_ready(f"http://127.0.0.1:{APP_PORT}/health")
+    return [await measure(pid, streams, args.total_mb * 1024 * 1024, args.size) for streams in args.streams]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 50, 200])
+    parser.add_argument("--total-mb", type=int, default=1024, help="bytes relayed per concurrency level")
+    parser.add_argument("--size", type=int, default=200 * 1024 * 1024)
+    parser.add_argument("--env", nargs="*", default=[], help="extra KEY=VALUE settings for the backend")
+    args = parser.parse_args()
+
+    most = max(args.streams)
+    app_env = {
+        "CHUNK_CACHE_MAX_BYTES": "0",
+        "PROXY_MAX_STREAMS": str(most),
+        "PROXY_MAX_STREAMS_PER_CLIENT": str(most),
+        "UPSTREAM_POOLS": json.dumps({"default": {"max_connections": most, "max_keepalive_connections": most}}),
+        **dict(setting.split("=", 1) for setting in args.env),
+    }
+    cdn_env = {"FAKE_CDN_LATENCY": "0", "FAKE_CDN_BANDWIDTH": "0", "FAKE_CDN_SIZE": str(args.size)}
+    with running(("bench.fake_cdn:app", FAKE_CDN_PORT, cdn_env), ("main:app", APP_PORT, app_env)) as procs:
+        for result in asyncio.run(run(procs[1].pid, args)):
+            print(
+                f"{result['streams']:>4} streams  {result['gb']:6.2f} GB  "
+                f"{result['cpu_s_per_gb']:6.2f} CPU s/GB  {result['mb_per_s']:7.1f} MB/s"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Range-capable fake video CDN.
+
+Serves a deterministic byte pattern at ``/video.mp4`` (any path works) with
+a simulated round trip and optional bandwidth cap. ``/hls/master.m3u8``
+serves a VOD HLS stream with two variants and ``*.ts`` segments:
+
+    FAKE_CDN_LATENCY=0.08 FAKE_CDN_BANDWIDTH=4000000 uvicorn bench.fake_cdn:app --port 9300
+"""
+import asyncio, os, re
+from fastapi import FastAPI
+from fastapi.requests import Request
+from fastapi.responses import Response, StreamingResponse
+
+LATENCY = float(os.getenv("FAKE_CDN_LATENCY", "0.05"))  # seconds before headers
+BANDWIDTH = int(os.getenv("FAKE_CDN_BANDWIDTH", "0"))  # bytes/s per stream, 0 = unlimited
+SIZE = int(os.getenv("FAKE_CDN_SIZE", str(500 * 1024 * 1024)))
+
+HLS_SEGMENTS = int(os.getenv("FAKE_CDN_HLS_SEGMENTS", "60"))
+HLS_SEGMENT_SIZE = int(os.getenv("FAKE_CDN_HLS_SEGMENT_SIZE", str(512 * 1024)))
+
+PATTERN = bytes(range(256)) * 4096  # 1 MB
+WRITE_SIZE = 64 * 1024
+
+app = FastAPI()
+stats = {"requests": 0, "head": 0, "bytes": 0}
+
+def content(start: int, end: int) -> bytes:
+    """Bytes start..end inclusive of the virtual file"""
+    offset = start % len(PATTERN)
+    length = end - start + 1
+    repeated = PATTERN * (2 + length // len(PATTERN))
+    return repeated[offset:offset + length]
+
+async def body(start: int, end: int):
+    position = start
+    while position <= end:
+        block_end = min(end, position + WRITE_SIZE - 1)
+        data = content(position, block_end)
+        if BANDWIDTH:
+            await asyncio.sleep(len(data) / BANDWIDTH)
+        stats["bytes"] += len(data)
+        yield data
+        position = block_end + 1
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+@app.get("/hls/master.m3u8")
+async def hls_master():
+    await asyncio.sleep(LATENCY)
+    stats["requests"] += 1
+    return Response(
+        "#EXTM3U\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360\nlow/index.m3u8\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720\nhigh/index.m3u8\n",
+        media_type="application/vnd.apple.mpegurl",
+    )
+
+@app.get("/hls/{variant}/index.m3u8")
+async def hls_media(variant: str):
+    await asyncio.sleep(LATENCY)
+    stats["requests"] += 1
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for index in range(HLS_SEGMENTS):
+        lines += ["#EXTINF:4.0,", f"seg{index}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl")
+
+@app.get("/hls/{variant}/seg{index}.ts")
+async def hls_segment(variant: str, index: int):
+    await asyncio.sleep(LATENCY)
+    stats["requests"] += 1
+    start = index * HLS_SEGMENT_SIZE
+    return StreamingResponse(
+        body(start, start + HLS_SEGMENT_SIZE - 1),
+        media_type="video/mp2t",
+        headers={"Content-Length": str(HLS_SEGMENT_SIZE)},
+    )
+
+@app.api_route("/{path:path}", methods=["GET", "HEAD"])
+async def serve(request: Request, path: str):
+    await asyncio.sleep(LATENCY)
+    headers = {"Accept-Ranges": "bytes", "ETag": '"fake-cdn-v1"', "Content-Type": "video/mp4"}
+
+    if request.method == "HEAD":
+        stats["head"] += 1
+        return Response(headers={**headers, "Content-Length": str(SIZE)})
+
+    stats["requests"] += 1
+    range_match = re.match(r"bytes=(\d*)-(\d*)", request.headers.get("range", ""))
+    if not range_match:
+        return StreamingResponse(body(0, SIZE - 1), headers={**headers, "Content-Length": str(SIZE)})
+
+    start_str, end_str = range_match.groups()
+    if start_str:
+        start, end = int(start_str), int(end_str) if end_str else SIZE - 1
+    else:
+        start, end = SIZE - int(end_str), SIZE - 1
+    end = min(end, SIZE - 1)
+    if start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{SIZE}"})
+
+    return StreamingResponse(
+        body(start, end),
+        status_code=206,
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{SIZE}", "Content-Length": str(end - start + 1)},
+    )
@@ -0,0 +1,84 @@
+"""Rebuffer events of a simulated player streaming through ``/proxy``.
+
+The player downloads ranges back to back while its buffer is below the
+target and plays at a fixed bitrate; it stalls when playback catches up with
+the download and resumes once a few seconds are buffered again. The fake CDN
+is throttled per stream, so each sequential 2 MB request pays latency plus
+transfer time:
+
+    python -m bench.rebuffer --readahead 0 1 --bitrate 2500000
+"""
+import argparse, asyncio, time
+from urllib.parse import quote
+import httpx
+from bench.servers import APP_PORT, FAKE_CDN_PORT, running, wait_ready
+
+TICK = 0.05
+
+async def play(bitrate: int, duration: float, buffer_target: float, resume_after: float) -> dict:
+    video = f"http://127.0.0.1:{FAKE_CDN_PORT}/movie.mp4"
+    url = f"http://127.0.0.1:{APP_PORT}/proxy?url={quote(video)}&ref=http://127.0.0.1"
+    total = int(bitrate * duration)
+    received = played = 0
+    playing = False
+    stalls, stalled_for, startup = 0, 0.0, None
+    started = time.monotonic()
+
+    async def download():
+        nonlocal received
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            while received < total:
+                if (received - played) / bitrate >= buffer_target:
+                    await asyncio.sleep(TICK)
+                    continue
+                async with client.stream("GET", url, headers={"Range": f"bytes={received}-"}) as response:
+                    async for chunk in response.aiter_raw():
+                        received += len(chunk)
+
+    downloader = asyncio.create_task(download())
+    last = time.monotonic()
+    while played < total:
+        await asyncio.sleep(TICK)
+        now = time.monotonic()
+        elapsed, last = now - last, now
+        if playing:
+            played = min(received, played + bitrate * elapsed)
+            if played >= received and played < total:
+                playing = False
+                stalls += 1
+        elif (received - played) / bitrate >= resume_after or received >= total:
+            playing = True
+            if startup is None:
+                startup = now - started
+        elif startup is not None:
+            stalled_for += elapsed
+    downloader.cancel()
+    return {"startup": startup or 0.0, "stalls": stalls, "stalled_for": stalled_for}
+
+async def run(args) -> dict:
+    await wait_ready(f"http://127.0.0.1:{FAKE_CDN_PORT}/stats")
+    await wait_ready(f"http://127.0.0.1:{APP_PORT}/health")
+    return await play(args.bitrate, args.duration, args.buffer, args.resume)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readahead", nargs="+", default=["0", "1"], help="PROXY_READAHEAD values to compare")
+    parser.add_argument("--bitrate", type=int, default=2_500_000, help="playback bytes/s")
+    parser.add_argument("--duration", type=float, default=40.0, help="seconds of video to play")
+    parser.add_argument("--buffer", type=float, default=10.0, help="player buffer target in seconds")
+    parser.add_argument("--resume", type=float, default=1.0, help="seconds buffered before playback resumes")
+    parser.add_argument("--latency", default="0.15", help="fake CDN round trip in seconds")
+    parser.add_argument("--bandwidth", default="3000000", help="fake CDN bytes/s per stream")
+    args = parser.parse_args()
+
+    cdn_env = {"FAKE_CDN_LATENCY": args.latency, "FAKE_CDN_BANDWIDTH": args.bandwidth}
+    print(f"{'readahead':>9} {'startup s':>10} {'stalls':>7} {'stalled s':>10}")
+    for mode in args.readahead:
+        # Disable the disk cache so only read-ahead differs between runs
+        app_env = {"PROXY_READAHEAD": mode, "CHUNK_CACHE_MAX_BYTES": "0"}
+        with running(("bench.fake_cdn:app", FAKE_CDN_PORT, cdn_env), ("main:app", APP_PORT, app_env)):
+            result = asyncio.run(run(args))
+        print(f"{mode:>9} {result['startup']:>10.2f} {result['stalls']:>7} {result['stalled_for']:>10.2f}")
+
+if __name__ == "__main__":
+    main()
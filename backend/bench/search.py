@@ -0,0 +1,79 @@
+"""Queries/sec and latency of the local search index.
+
+Builds a SearchIndex of synthetic titles in a temporary directory and runs
+a mix of queries against it in-process: whole words, prefixes as typed
+keystroke by keystroke, and misspellings that need the trigram fallback.
+
+    python -m bench.search --titles 20000 --queries 5000
+"""
+import argparse, asyncio, os, random, tempfile, time
+from bench.seek import percentile
+from search_index import SearchIndex
+
+SYLLABLES = "ka ki ku ke ko sa shi su se so ta chi tsu te to na ni nu ne no ha hi fu he ho ma mi mu me mo ya yu yo ra ri ru re ro wa n".split()
+ENGLISH = "Attack Titan Demon Slayer Hunter Knight Academy Dragon Spirit Shadow Garden Sword Online Frieren Journey Blade Moon Star Ghost Sky".split()
+
+def word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+def catalog(count: int, rng: random.Random) -> list[dict]:
+    return [
+        {
+            "id": media_id,
+            "title": {
+                "romaji": " ".join(word(rng) for _ in range(rng.randint(1, 4))),
+                "english": " ".join(rng.sample(ENGLISH, rng.randint(1, 3))) if rng.random() < 0.6 else None,
+            },
+            "synonyms": [word(rng)] if rng.random() < 0.3 else [],
+            "genres": ["Action"],
+            "popularity": rng.randint(0, 500000),
+            "updatedAt": 1700000000 + media_id,
+            "nextAiringEpisode": None,
+        }
+        for media_id in range(1, count + 1)
+    ]
+
+def misspell(text: str, rng: random.Random) -> str:
+    position = rng.randrange(len(text) - 1)
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+def queries(media: list[dict], count: int, rng: random.Random) -> dict[str, list[str]]:
+    titles = [item["title"]["english"] or item["title"]["romaji"] for item in media]
+    mix = {"word": [], "prefix": [], "typo": []}
+    for _ in range(count // 3):
+        title = rng.choice(titles)
+        mix["word"].append(title.split()[0])
+        mix["prefix"].append(title[:rng.randint(2, len(title))])
+        mix["typo"].append(misspell(title, rng) if len(title) > 3 else title)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--titles", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=6000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    media = catalog(args.titles, rng)
+    with tempfile.TemporaryDirectory() as directory:
+        index = SearchIndex(os.path.join(directory, "search.db"))
+        started = time.perf_counter()
+        asyncio.run(index.upsert(media))
+        print(f"indexed {len(index)} titles in {time.perf_counter() - started:.2f}s")
+
+        print(f"{'queries':>8} {'q/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'found':>7}")
+        for name, batch in queries(media, args.queries, rng).items():
+            latencies, found = [], 0
+            for query in batch:
+                started = time.perf_counter()
+                found += bool(index.search(query))
+                latencies.append(time.perf_counter() - started)
+            print(
+                f"{name:>8} {len(batch) / sum(latencies):>9.0f} {percentile(latencies, 50) * 1000:>8.2f}"
+                f" {percentile(latencies, 99) * 1000:>8.2f} {found / len(batch):>7.0%}"
+            )
+        index.close()
+
+if __name__ == "__main__":
+    main()
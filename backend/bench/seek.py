@@ -0,0 +1,71 @@
+"""Latency of a seek-heavy viewing session through ``/proxy``.
+
+Starts the fake CDN and the backend, then replays a session that buffers a
+few sequential ranges, seeks somewhere else, buffers again, and so on:
+
+    python -m bench.seek --requests 60 --seek-every 3
+"""
+import argparse, asyncio, random, statistics, time
+from urllib.parse import quote
+import httpx
+from bench.servers import APP_PORT, FAKE_CDN_PORT, running, wait_ready
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def session(requests: int, seek_every: int, size: int, seed: int) -> tuple[list[float], list[float]]:
+    """Returns (time to first byte, total time) per request in seconds"""
+    rng = random.Random(seed)
+    video = f"http://127.0.0.1:{FAKE_CDN_PORT}/video-{seed}.mp4"
+    url = f"http://127.0.0.1:{APP_PORT}/proxy?url={quote(video)}&ref=http://127.0.0.1"
+    ttfb, total = [], []
+    position = 0
+
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        for i in range(requests):
+            if i and i % seek_every == 0:
+                position = rng.randrange(0, size - 4 * 1024 * 1024)
+            started = time.perf_counter()
+            async with client.stream("GET", url, headers={"Range": f"bytes={position}-"}) as response:
+                first = None
+                received = 0
+                async for chunk in response.aiter_raw():
+                    if first is None:
+                        first = time.perf_counter()
+                    received += len(chunk)
+            ttfb.append((first or time.perf_counter()) - started)
+            total.append(time.perf_counter() - started)
+            position += received
+    return ttfb, total
+
+async def run(args):
+    await wait_ready(f"http://127.0.0.1:{FAKE_CDN_PORT}/stats")
+    await wait_ready(f"http://127.0.0.1:{APP_PORT}/health")
+    ttfb, total = await session(args.requests, args.seek_every, args.size, args.seed)
+    async with httpx.AsyncClient() as client:
+        cdn = (await client.get(f"http://127.0.0.1:{FAKE_CDN_PORT}/stats")).json()
+
+    print(f"requests: {len(total)}  upstream GETs: {cdn['requests']}  upstream HEADs: {cdn['head']}")
+    for name, values in (("ttfb", ttfb), ("total", total)):
+        print(
+            f"{name:>6} ms  p50 {percentile(values, 50) * 1000:7.1f}  p95 {percentile(values, 95) * 1000:7.1f}"
+            f"  mean {statistics.mean(values) * 1000:7.1f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--seek-every", type=int, default=3)
+    parser.add_argument("--latency", default="0.05", help="fake CDN round trip in seconds")
+    parser.add_argument("--bandwidth", default="0", help="fake CDN bytes/s per stream, 0 = unlimited")
+    parser.add_argument("--size", type=int, default=500 * 1024 * 1024)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    cdn_env = {"FAKE_CDN_LATENCY": args.latency, "FAKE_CDN_BANDWIDTH": args.bandwidth, "FAKE_CDN_SIZE": str(args.size)}
+    with running(("bench.fake_cdn:app", FAKE_CDN_PORT, cdn_env), ("main:app", APP_PORT, {})):
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""Start the backend and its local stand-ins as uvicorn subprocesses."""
+import asyncio, os, subprocess, sys, time
+from contextlib import contextmanager
+import httpx
+
+STUB_ANILIST_PORT = 9100
+APP_PORT = 9200
+FAKE_CDN_PORT = 9300
+STUB_RESOLVER_PORT = 9400
+
+def start_server(target: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", target, "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **env},
+    )
+
+async def wait_ready(url: str, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+@contextmanager
+def running(*servers: tuple[str, int, dict]):
+    """Run (target, port, env) servers for the duration of the block, yielding their processes"""
+    procs = [start_server(target, port, env) for target, port, env in servers]
+    try:
+        yield procs
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
@@ -0,0 +1,138 @@
+"""Stub of graphql.anilist.co that returns canned GraphQL responses.
+
+Run with ``uvicorn bench.stub_anilist:app --port 9100`` and point the backend
+at it with ``ANILIST_URL=http://127.0.0.1:9100``.
+"""
+import asyncio, os, re, time
+from typing import Optional
+from fastapi import FastAPI
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse
+
+# Simulated AniList round trip in seconds
+LATENCY = float(os.getenv("STUB_ANILIST_LATENCY", "0.05"))
+# Size of the fake catalog that paged queries walk through
+TITLES = int(os.getenv("STUB_ANILIST_TITLES", "5000"))
+# Requests per minute before answering 429 like AniList does, 0 for no limit
+RATE_LIMIT = int(os.getenv("STUB_ANILIST_RATE_LIMIT", "0"))
+# Every third title airs an episode each this many seconds, 0 for nothing airing
+AIRING_EVERY = int(os.getenv("STUB_ANILIST_AIRING_EVERY", "0"))
+
+# Aliased top-level fields, as in `trending: Page(...)`
+ALIASED_FIELD = re.compile(r"(\w+)\s*:\s*(Page|Viewer|MediaListCollection)\b")
+
+app = FastAPI()
+stats = {"requests": 0, "rate_limited": 0}
+window = {"started": 0.0, "count": 0}
+
+def fake_airing(media_id: int) -> Optional[dict]:
+    if not AIRING_EVERY or media_id % 3:
+        return None
+    # Staggered per title so releases trickle in rather than all at once
+    offset = media_id % AIRING_EVERY
+    cycle = (int(time.time()) - offset) // AIRING_EVERY + 1
+    airing_at = cycle * AIRING_EVERY + offset
+    return {"airingAt": airing_at, "timeUntilAiring": airing_at - int(time.time()), "episode": cycle % 12 + 1}
+
+def fake_media(media_id: int) -> dict:
+    return {
+        "id": media_id,
+        "title": {"romaji": f"Anime {media_id}", "english": f"Anime {media_id}"},
+        "coverImage": {"extraLarge": f"https://img.example/{media_id}.jpg"},
+        "bannerImage": f"https://img.example/banner/{media_id}.jpg",
+        "episodes": 12,
+        "status": "RELEASING",
+        "description": "Lorem ipsum dolor sit amet. " * 20,
+        "seasonYear": 2025,
+        "popularity": 100000 - media_id,
+        "averageScore": 80,
+        "genres": ["Action", "Fantasy"],
+        "nextAiringEpisode": fake_airing(media_id),
+        "synonyms": [f"Show {media_id}"],
+        "updatedAt": 1700000000 + media_id,
+    }
+
+def fake_page(per_page: int, page: int = 1) -> dict:
+    first = (page - 1) * per_page + 1
+    last = min(first + per_page, TITLES + 1)
+    return {
+        "pageInfo": {"total": TITLES, "currentPage": page, "lastPage": -(-TITLES // per_page), "hasNextPage": last <= TITLES},
+        "media": [fake_media(i) for i in range(first, last)],
+    }
+
+def fake_list() -> dict:
+    entries = [
+        {"id": i, "progress": 3, "status": "CURRENT", "updatedAt": 1700000000 + i, "media": fake_media(i)}
+        for i in range(1, 6)
+    ]
+    return {"lists": [{"entries": entries}]}
+
+def selected(data, query: str):
+    """Drop media fields the query doesn't name, so projected queries get smaller answers"""
+    if isinstance(data, list):
+        return [selected(item, query) for item in data]
+    if not isinstance(data, dict):
+        return data
+    if "title" in data and "id" in data:
+        return {key: value for key, value in data.items() if re.search(rf"\b{key}\b", query)}
+    return {key: selected(value, query) for key, value in data.items()}
+
+def resolve(field: str, variables: dict):
+    if field == "Viewer":
+        return {"id": 1, "name": "stub", "avatar": {"medium": None}}
+    if field == "MediaListCollection":
+        return fake_list()
+    return fake_page(variables.get("perPage", 20), variables.get("page", 1))
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    if not RATE_LIMIT or request.method != "POST":
+        return await call_next(request)
+    now = time.monotonic()
+    if now - window["started"] >= 60:
+        window.update(started=now, count=0)
+    window["count"] += 1
+    remaining = RATE_LIMIT - window["count"]
+    headers = {"X-RateLimit-Limit": str(RATE_LIMIT), "X-RateLimit-Remaining": str(max(0, remaining))}
+    if remaining < 0:
+        stats["rate_limited"] += 1
+        retry_after = str(int(60 - (now - window["started"])) + 1)
+        return JSONResponse({"errors": [{"message": "Too Many Requests.", "status": 429}]}, 429,
+                            {**headers, "Retry-After": retry_after})
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+@app.post("/")
+async def graphql(request: Request):
+    body = await request.json()
+    query = body["query"]
+    stats["requests"] += 1
+    await asyncio.sleep(LATENCY)
+    return selected(answer(query, body.get("variables") or {}), query)
+
+def answer(query: str, variables: dict) -> dict:
+    if "SaveMediaListEntry" in query:
+        return {"data": {"SaveMediaListEntry": {
+            "id": 1, "userId": 1, "progress": variables.get("progress"), "status": variables.get("status"),
+            "media": {"title": {"romaji": "Anime 1", "english": "Anime 1"}},
+        }}}
+    aliased = ALIASED_FIELD.findall(query)
+    if aliased:
+        return {"data": {alias: resolve(field, variables) for alias, field in aliased}}
+    if "MediaListCollection" in query:
+        return {"data": {"MediaListCollection": fake_list()}}
+    if "ids" in variables:
+        return {"data": {"Page": {"media": [fake_media(media_id) for media_id in variables["ids"]]}}}
+    if "search" in variables:
+        numbers = [int(word) for word in re.findall(r"\d+", variables["search"]) if 0 < int(word) <= TITLES]
+        return {"data": {"Page": {"media": [fake_media(number) for number in numbers]}}}
+    if re.search(r"\bMedia\s*\(", query):
+        return {"data": {"Media": fake_media(variables.get("id", 1))}}
+    if "Viewer" in query:
+        return {"data": {"Viewer": {"id": 1, "name": "stub", "avatar": {"medium": None}}}}
+    return {"data": {"Page": fake_page(variables.get("perPage", 20), variables.get("page", 1))}}
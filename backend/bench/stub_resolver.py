@@ -0,0 +1,57 @@
+"""Stub of the ani-cli stream resolver that returns signed fake sources.
+
+Run with ``uvicorn bench.stub_resolver:app --port 9400`` and point the
+backend at it with ``ANI_CLI_URL=http://127.0.0.1:9400/api/ani-cli/v2/stream``.
+"""
+import asyncio, os, time
+from fastapi import FastAPI
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse
+
+# Simulated scrape time in seconds
+LATENCY = float(os.getenv("STUB_RESOLVER_LATENCY", "2"))
+# Lifetime of the signed URLs handed out
+URL_TTL = int(os.getenv("STUB_RESOLVER_URL_TTL", "21600"))
+# Episodes past this have no sources yet
+EPISODES = int(os.getenv("STUB_RESOLVER_EPISODES", "12"))
+# Where the fake sources point, e.g. a bench.fake_cdn instance
+CDN = os.getenv("STUB_RESOLVER_CDN", "http://127.0.0.1:9300/video.mp4")
+
+app = FastAPI()
+stats = {"requests": 0, "episodes": {}}
+# Flipped through POST /fail to simulate a stuck or broken scraper
+mode = {"fail": None}
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+@app.post("/fail")
+def set_failure(kind: str = ""):
+    """kind is "error" (500s), "missing" (404s), "hang" (never answers) or empty to recover"""
+    mode["fail"] = kind or None
+    return mode
+
+@app.post("/api/ani-cli/v2/stream")
+async def stream(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    key = f"{body['anilist_id']}:{body['episode']}"
+    stats["episodes"][key] = stats["episodes"].get(key, 0) + 1
+
+    if mode["fail"] == "hang":
+        await asyncio.sleep(3600)
+    await asyncio.sleep(LATENCY)
+    if mode["fail"] == "error":
+        return JSONResponse({"detail": "scraper crashed"}, 500)
+    if mode["fail"] == "missing":
+        return JSONResponse({"detail": "episode not found"}, 404)
+    if body["episode"] > EPISODES:
+        return {"sources": []}
+
+    expires = int(time.time()) + URL_TTL
+    return {"sources": [
+        {"quality": quality, "url": f"{CDN}?q={quality}&ep={body['episode']}&expires={expires}",
+         "source": "stub", "referrer": "https://example.com"}
+        for quality in ("1080p", "720p")
+    ]}
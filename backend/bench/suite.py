@@ -0,0 +1,285 @@
+"""End-to-end load test of the backend against local stand-ins.
+
+Starts the stub AniList, the stub ani-cli resolver, the fake CDN and the
+backend, then runs virtual users through realistic scenarios for a fixed
+time:
+
+    home    POST /home, then open one of the titles (GET /anime/{id})
+    search  type a title keystroke by keystroke (GET /search/{prefix})
+    binge   GET /sources for an episode, stream it through /proxy with
+            seeks, move on to the next episode
+
+It reports p50/p95/p99 latency and throughput per request kind, the calls
+each stand-in served, and the backend's memory. Results can be saved as a
+baseline and later runs compared against it, exiting non-zero when
+something got worse by more than --tolerance:
+
+    python -m bench.suite --users 4 --duration 30 --save before
+    python -m bench.suite --users 4 --duration 30 --compare before
+
+Baselines are JSON files in bench/baselines/. Extra backend settings can be
+passed with --env, e.g. --env SOURCES_MAX_PREFETCHES=0.
+"""
+import argparse, asyncio, json, os, random, sys, tempfile, time
+from urllib.parse import quote
+import httpx
+from bench.seek import percentile
+from bench.servers import APP_PORT, FAKE_CDN_PORT, STUB_ANILIST_PORT, STUB_RESOLVER_PORT, running, wait_ready
+
+APP = f"http://127.0.0.1:{APP_PORT}"
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines")
+RANGE_SIZE = 1024 * 1024
+
+class Recorder:
+    """Latencies and failures per request kind"""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.bytes = 0
+
+    async def request(self, kind: str, client: httpx.AsyncClient, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            return None
+        self.bytes += len(response.content)
+        if response.status_code >= 400:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            return None
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        return response
+
+async def home_user(client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, deadline: float, think: float):
+    while time.monotonic() < deadline:
+        response = await recorder.request("home", client, "POST", f"{APP}/home", json={"per_page": 20})
+        # Catalog sections are {"media": [...], "pageInfo": ...}, the user fields are not lists of titles
+        media = [item for section in (response.json() if response else {}).values()
+                 if isinstance(section, dict) for item in section.get("media") or []
+                 if isinstance(item, dict) and "id" in item]
+        media_id = rng.choice(media)["id"] if media else rng.randint(1, 500)
+        await asyncio.sleep(think)
+        await recorder.request("anime", client, "GET", f"{APP}/anime/{media_id}")
+        await asyncio.sleep(think)
+
+async def search_user(client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, deadline: float, think: float):
+    while time.monotonic() < deadline:
+        title = f"Anime {rng.randint(1, 5000)}"
+        for length in range(2, len(title) + 1):
+            if time.monotonic() >= deadline:
+                return
+            await recorder.request("search", client, "GET", f"{APP}/search/{quote(title[:length])}")
+            # Keystrokes come faster than page views
+            await asyncio.sleep(think / 4)
+        await asyncio.sleep(think)
+
+async def binge_user(client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, deadline: float, think: float,
+                     ranges: int, seek_every: int, episodes: int):
+    anilist_id = rng.randint(1, 500)
+    episode = 1
+    while time.monotonic() < deadline:
+        params = {"anilist_id": anilist_id, "title": f"Anime {anilist_id}", "episode": episode}
+        response = await recorder.request("sources", client, "GET", f"{APP}/sources", params=params)
+        sources = (response.json().get("sources") or []) if response else []
+        playable = [source for source in sources if source.get("reachable", True)]
+        if playable:
+            source = playable[0]
+            url = f"{APP}/proxy?url={quote(source['url'])}&ref={quote(source.get('referrer') or '')}"
+            position = 0
+            for i in range(ranges):
+                if time.monotonic() >= deadline:
+                    return
+                if i and i % seek_every == 0:
+                    position = rng.randrange(0, 400) * RANGE_SIZE
+                headers = {"Range": f"bytes={position}-{position + RANGE_SIZE - 1}"}
+                await recorder.request("proxy", client, "GET", url, headers=headers)
+                position += RANGE_SIZE
+                await asyncio.sleep(think)
+        episode = episode % episodes + 1
+        if episode == 1:
+            anilist_id = rng.randint(1, 500)
+
+async def upstream_calls(client: httpx.AsyncClient) -> dict:
+    anilist = (await client.get(f"http://127.0.0.1:{STUB_ANILIST_PORT}/stats")).json()
+    resolver = (await client.get(f"http://127.0.0.1:{STUB_RESOLVER_PORT}/stats")).json()
+    cdn = (await client.get(f"http://127.0.0.1:{FAKE_CDN_PORT}/stats")).json()
+    return {
+        "anilist": anilist["requests"],
+        "anilist_429": anilist["rate_limited"],
+        "resolver": resolver["requests"],
+        "cdn": cdn["requests"] + cdn["head"],
+        "cdn_mb": round(cdn["bytes"] / 1024 / 1024, 1),
+    }
+
+def memory(pid: int) -> dict:
+    """Resident and peak resident set size in MB, from /proc so Linux only"""
+    values = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                values[key] = round(int(rest.split()[0]) / 1024, 1)
+    return {"rss_mb": values.get("VmRSS", 0.0), "peak_rss_mb": values.get("VmHWM", 0.0)}
+
+async def run(args, app_pid: int) -> dict:
+    for port in (STUB_ANILIST_PORT, STUB_RESOLVER_PORT, FAKE_CDN_PORT):
+        await wait_ready(f"http://127.0.0.1:{port}/stats")
+    await wait_ready(f"{APP}/health")
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+        deadline = time.monotonic() + args.duration
+        users = []
+        for scenario in args.scenarios:
+            for index in range(args.users):
+                rng = random.Random(f"{args.seed}:{scenario}:{index}")
+                if scenario == "home":
+                    users.append(home_user(client, recorder, rng, deadline, args.think))
+                elif scenario == "search":
+                    users.append(search_user(client, recorder, rng, deadline, args.think))
+                else:
+                    users.append(binge_user(client, recorder, rng, deadline, args.think,
+                                            args.ranges, args.seek_every, args.episodes))
+        started = time.perf_counter()
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - started
+        upstream = await upstream_calls(client)
+
+    requests = {
+        kind: {
+            "count": len(values),
+            "errors": recorder.errors.get(kind, 0),
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+        for kind, values in sorted(recorder.latencies.items())
+    }
+    for kind, count in recorder.errors.items():
+        requests.setdefault(kind, {"count": 0, "errors": count, "rps": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0})
+    total = sum(len(values) for values in recorder.latencies.values())
+    return {
+        "settings": {key: getattr(args, key) for key in (
+            "scenarios", "users", "duration", "think", "ranges", "seek_every", "episodes",
+            "anilist_latency", "anilist_rate_limit", "resolver_latency", "cdn_latency", "cdn_bandwidth", "env",
+        )},
+        "requests": requests,
+        "throughput": {"rps": round(total / elapsed, 2), "mb_per_s": round(recorder.bytes / elapsed / 1024 / 1024, 2)},
+        "upstream": upstream,
+        "memory": memory(app_pid),
+    }
+
+def report(result: dict):
+    print(f"{'request':>8} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for kind, row in result["requests"].items():
+        print(
+            f"{kind:>8} {row['count']:>7} {row['errors']:>7} {row['rps']:>8.2f}"
+            f" {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f}"
+        )
+    throughput = result["throughput"]
+    print(f"\nthroughput: {throughput['rps']} req/s, {throughput['mb_per_s']} MB/s")
+    print("upstream:   " + "  ".join(f"{key} {value}" for key, value in result["upstream"].items()))
+    print("memory:     " + "  ".join(f"{key} {value}" for key, value in result["memory"].items()))
+
+# (name, value, whether higher is worse) for each number compared against a baseline
+def compared(result: dict):
+    for kind, row in result["requests"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms", "errors"):
+            yield f"{kind}.{key}", row[key], True
+        yield f"{kind}.rps", row["rps"], False
+    yield "throughput.rps", result["throughput"]["rps"], False
+    for key, value in result["upstream"].items():
+        yield f"upstream.{key}", value, True
+    yield "memory.peak_rss_mb", result["memory"]["peak_rss_mb"], True
+
+def compare(result: dict, baseline: dict, tolerance: float, min_delta: float) -> list[str]:
+    """Lines describing each number that got worse than the baseline by more than tolerance"""
+    before = {name: value for name, value, _ in compared(baseline)}
+    regressions = []
+    print(f"\n{'metric':>22} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, value, higher_is_worse in compared(result):
+        if name not in before:
+            continue
+        old = before[name]
+        change = (value - old) / old if old else (0.0 if value == old else float("inf"))
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        # Small numbers (a few errors, fast requests) swing wildly in ratio from run to run
+        if worse and abs(value - old) < min_delta:
+            worse = False
+        print(f"{name:>22} {old:>10} {value:>10} {change:>+8.0%}{'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def baseline_path(name: str) -> str:
+    return name if name.endswith(".json") else os.path.join(BASELINES, f"{name}.json")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=("home", "search", "binge"), default=["home", "search", "binge"])
+    parser.add_argument("--users", type=int, default=4, help="virtual users per scenario")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--think", type=float, default=0.2, help="seconds a user waits between actions")
+    parser.add_argument("--ranges", type=int, default=12, help="1 MB ranges streamed per episode")
+    parser.add_argument("--seek-every", type=int, default=4)
+    parser.add_argument("--episodes", type=int, default=12, help="episodes binged before switching titles")
+    parser.add_argument("--anilist-latency", default="0.05", help="stub AniList round trip in seconds")
+    parser.add_argument("--anilist-rate-limit", default="0", help="stub AniList requests/min before 429s, 0 = none")
+    parser.add_argument("--resolver-latency", default="0.5", help="stub resolver scrape time in seconds")
+    parser.add_argument("--cdn-latency", default="0.05", help="fake CDN round trip in seconds")
+    parser.add_argument("--cdn-bandwidth", default="0", help="fake CDN bytes/s per stream, 0 = unlimited")
+    parser.add_argument("--env", nargs="*", default=[], help="extra backend settings as KEY=VALUE")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="NAME", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="NAME", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument("--min-delta", type=float, default=5.0, help="absolute change below which nothing is a regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        anilist_env = {"STUB_ANILIST_LATENCY": args.anilist_latency, "STUB_ANILIST_RATE_LIMIT": args.anilist_rate_limit}
+        resolver_env = {"STUB_RESOLVER_LATENCY": args.resolver_latency,
+                        "STUB_RESOLVER_CDN": f"http://127.0.0.1:{FAKE_CDN_PORT}/video.mp4"}
+        cdn_env = {"FAKE_CDN_LATENCY": args.cdn_latency, "FAKE_CDN_BANDWIDTH": args.cdn_bandwidth}
+        app_env = {
+            "ANILIST_URL": f"http://127.0.0.1:{STUB_ANILIST_PORT}",
+            "ANI_CLI_URL": f"http://127.0.0.1:{STUB_RESOLVER_PORT}/api/ani-cli/v2/stream",
+            # Fresh state every run so results don't depend on what an earlier run cached
+            "SEARCH_INDEX_PATH": os.path.join(directory, "search.db"),
+            "PROGRESS_QUEUE_PATH": os.path.join(directory, "progress.db"),
+            "CHUNK_CACHE_DIR": os.path.join(directory, "chunks"),
+            **dict(setting.split("=", 1) for setting in args.env),
+        }
+        servers = (
+            ("bench.stub_anilist:app", STUB_ANILIST_PORT, anilist_env),
+            ("bench.stub_resolver:app", STUB_RESOLVER_PORT, resolver_env),
+            ("bench.fake_cdn:app", FAKE_CDN_PORT, cdn_env),
+            ("main:app", APP_PORT, app_env),
+        )
+        with running(*servers) as procs:
+            result = asyncio.run(run(args, procs[-1].pid))
+
+    report(result)
+    if args.save:
+        path = baseline_path(args.save)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nsaved baseline to {path}")
+    if args.compare:
+        with open(baseline_path(args.compare)) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != result["settings"]:
+            print("\nwarning: baseline was recorded with different settings")
+        regressions = compare(result, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nno regressions beyond {args.tolerance:.0%}")
+
+if __name__ == "__main__":
+    main()
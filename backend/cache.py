@@ -0,0 +1,278 @@
+"""Caches for upstream calls.
+
+ResponseCache serves API responses with stale-while-revalidate; entries live
+in a pluggable backend: an in-process LRU by default, a SQLite file in WAL
+mode when CACHE_SQLITE_PATH is set (what the worker processes started by
+serve.py share), or any server speaking the Redis protocol when
+CACHE_REDIS_URL is set (needs the optional `redis` package). TTLCache is a
+plain bounded LRU for small hot-path metadata.
+"""
+import asyncio, hashlib, json, os, sqlite3, threading, time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # optional dependency
+    aioredis = None
+
+
+def make_key(namespace: str, query: str, variables: Optional[dict] = None) -> str:
+    """Stable cache key for a (query, variables) pair, whitespace-insensitive"""
+    normalized = json.dumps(
+        {"q": " ".join(query.split()), "v": variables or {}},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return f"{namespace}:{hashlib.sha1(normalized.encode()).hexdigest()}"
+
+
+class TTLCache:
+    """Small synchronous LRU with a fixed TTL, for hot-path lookups"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: Any) -> Any:
+        item = self._entries.get(key)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return item[1]
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None):
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Any):
+        self._entries.pop(key, None)
+
+    def __contains__(self, key: Any) -> bool:
+        """Whether key holds an unexpired value, without counting a hit or refreshing its LRU position"""
+        item = self._entries.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class MemoryBackend:
+    """Bounded in-process LRU store"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["stale_until"] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def set(self, key: str, entry: dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Shared store on a Redis-protocol server, entries are JSON encoded"""
+
+    def __init__(self, url: str, prefix: str = "yoru:"):
+        if aioredis is None:
+            raise RuntimeError("CACHE_REDIS_URL is set but the `redis` package is not installed")
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[dict]:
+        raw = await self.redis.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, entry: dict):
+        ttl_ms = max(1, int((entry["stale_until"] - time.time()) * 1000))
+        await self.redis.set(self.prefix + key, json.dumps(entry), px=ttl_ms)
+
+    async def delete(self, key: str):
+        await self.redis.delete(self.prefix + key)
+
+
+class SqliteBackend:
+    """
+    Store in a SQLite file that every process on the host opens. WAL mode
+    lets readers go on while one process writes, so lookups run inline on
+    the event loop and only writes go to a thread.
+    """
+
+    def __init__(self, path: str, max_entries: int = 50000, prune_every: int = 500):
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._reader = self._connect()
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._writes = 0
+        with self._write_lock:
+            self._writer.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, entry TEXT NOT NULL, stale_until REAL NOT NULL)"
+            )
+            self._writer.execute("CREATE INDEX IF NOT EXISTS entries_stale_until ON entries (stale_until)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Another process holding the write lock is waited for rather than raised
+        connection = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        return connection
+
+    async def get(self, key: str) -> Optional[dict]:
+        row = self._reader.execute(
+            "SELECT entry FROM entries WHERE key = ? AND stale_until > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    async def set(self, key: str, entry: dict):
+        await asyncio.to_thread(self._set, key, json.dumps(entry), entry["stale_until"])
+
+    def _set(self, key: str, encoded: str, stale_until: float):
+        with self._write_lock:
+            self._writer.execute(
+                "INSERT OR REPLACE INTO entries (key, entry, stale_until) VALUES (?, ?, ?)", (key, encoded, stale_until)
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                # Expired rows first, then whatever would go stale soonest past the cap
+                self._writer.execute("DELETE FROM entries WHERE stale_until <= ?", (time.time(),))
+                self._writer.execute(
+                    """
+                    DELETE FROM entries WHERE key IN (
+                        SELECT key FROM entries ORDER BY stale_until DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+
+    async def delete(self, key: str):
+        def delete():
+            with self._write_lock:
+                self._writer.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+        await asyncio.to_thread(delete)
+
+    def __len__(self) -> int:
+        return self._reader.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class ResponseCache:
+    """TTL cache that serves expired entries while refreshing them in the background"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "refreshes": 0, "refresh_errors": 0}
+        self._refreshing: dict[str, asyncio.Task] = {}
+
+    async def get_or_fetch(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        ttl: float,
+        stale_ttl: float = 0.0,
+    ) -> Any:
+        """
+        Return the cached value for key, calling fetch on a miss.
+
+        Within ttl the entry is fresh. For stale_ttl seconds after that it is
+        still served, but a background refresh is started so the next caller
+        gets new data. Exceptions from fetch propagate and are never cached.
+        """
+        cached = await self.peek(key)
+        if cached is not None:
+            value, fresh = cached
+            if not fresh:
+                self.refresh_in_background(key, lambda: self._fetch_and_store(key, fetch, ttl, stale_ttl))
+            return value
+
+        value = await fetch()
+        await self.store(key, value, ttl, stale_ttl)
+        return value
+
+    async def peek(self, key: str) -> Optional[tuple[Any, bool]]:
+        """
+        The cached value and whether it is still fresh, or None on a miss.
+        Refreshing a stale value is left to the caller.
+        """
+        try:
+            entry = await self.backend.get(key)
+        except Exception:
+            # A broken shared backend should degrade to a miss, not an outage
+            entry = None
+
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if time.time() < entry["expires_at"]:
+            self.stats["hits"] += 1
+            return entry["value"], True
+        self.stats["stale"] += 1
+        return entry["value"], False
+
+    async def invalidate(self, key: str):
+        await self.backend.delete(key)
+
+    async def store(self, key: str, value: Any, ttl: float, stale_ttl: float = 0.0):
+        now = time.time()
+        entry = {"value": value, "expires_at": now + ttl, "stale_until": now + ttl + stale_ttl}
+        try:
+            await self.backend.set(key, entry)
+        except Exception:
+            pass
+
+    def refresh_in_background(self, key: str, refresh: Callable[[], Awaitable[None]]):
+        """Run refresh unless one is already running under key; refresh stores its own results"""
+        if key in self._refreshing:
+            return
+
+        async def run():
+            try:
+                await refresh()
+                self.stats["refreshes"] += 1
+            except Exception:
+                # Keep serving the stale copy, the next request retries
+                self.stats["refresh_errors"] += 1
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.create_task(run())
+
+    async def _fetch_and_store(self, key: str, fetch: Callable[[], Awaitable[Any]], ttl: float, stale_ttl: float):
+        await self.store(key, await fetch(), ttl, stale_ttl)
+
+
+def create_cache() -> ResponseCache:
+    redis_url = os.getenv("CACHE_REDIS_URL")
+    if redis_url:
+        return ResponseCache(RedisBackend(redis_url))
+    sqlite_path = os.getenv("CACHE_SQLITE_PATH")
+    if sqlite_path:
+        return ResponseCache(SqliteBackend(sqlite_path, int(os.getenv("CACHE_MAX_ENTRIES", "50000"))))
+    return ResponseCache(MemoryBackend(int(os.getenv("CACHE_MAX_ENTRIES", "1024"))))
@@ -0,0 +1,229 @@
+"""On-disk cache of proxied video bytes in fixed-size, block-aligned chunks.
+
+A block is identified by the upstream object (URL plus ETag or length) and
+its index, so every viewer of the same file shares the same blocks. Files
+are evicted least-recently-used once the total size exceeds the cap.
+
+Worker processes started by serve.py share the directory: a block another
+process wrote is picked up the first time it is asked for. There, only the
+coordinator evicts, by sweeping the whole directory on a timer (`start`),
+so the cap holds for every process's blocks together.
+"""
+import asyncio, hashlib, mmap, os, tempfile, time
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+BLOCK_SIZE = 1024 * 1024 * 2  # 2MB, the same as the proxy's response cap
+READ_SIZE = 256 * 1024
+
+
+class ChunkStore:
+    def __init__(self, root: str, max_bytes: int, block_size: int = BLOCK_SIZE, evict_on_put: bool = True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        # False when another process sweeps the shared directory for everyone
+        self.evict_on_put = evict_on_put
+        self._task: Optional[asyncio.Task] = None
+        # block name -> size on disk, least recently used first
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evictions": 0, "bytes_served": 0}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def object_key(url: str, etag: Optional[str], content_length: int) -> str:
+        """Blocks are only shared while the upstream object is unchanged"""
+        return hashlib.sha256(f"{url}\n{etag or ''}\n{content_length}".encode()).hexdigest()[:40]
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def start(self, interval: float):
+        """Sweep the directory every `interval` seconds"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except OSError:
+                # A file vanished mid-scan, the next sweep sees the settled state
+                pass
+
+    async def sweep(self):
+        """Evict least recently used blocks by what is on disk, whichever process wrote them"""
+        removed = await asyncio.to_thread(self._sweep)
+        for name in removed:
+            self._forget(name)
+
+    def _sweep(self) -> list[str]:
+        found = self._scan()
+        total = sum(size for _, _, size in found)
+        removed = []
+        for _, name, size in found:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            total -= size
+            removed.append(name)
+            self.stats["evictions"] += 1
+        return removed
+
+    def has(self, key: str, index: int) -> bool:
+        return self._known(self._name(key, index))
+
+    def _known(self, name: str) -> bool:
+        """Whether the block is cached, adopting one another process wrote"""
+        if name in self._index:
+            return True
+        if self.evict_on_put:
+            # Nobody else writes here, the index is complete
+            return False
+        try:
+            size = os.stat(self._path(name)).st_size
+        except OSError:
+            return False
+        self._adopt(name, size)
+        return True
+
+    def _adopt(self, name: str, size: int):
+        self._index[name] = size
+        self._bytes += size
+
+    async def read(self, key: str, index: int, offset: int, end: int) -> Optional[Iterator[memoryview]]:
+        """
+        Bytes offset..end (inclusive, relative to the block) of a cached block,
+        as slices of a memory map: nothing is copied into Python, the socket
+        write reads straight from the page cache. Returns None on a miss.
+        """
+        name = self._name(key, index)
+        if name not in self._index and self.evict_on_put:
+            self.stats["misses"] += 1
+            return None
+        try:
+            mapped = await asyncio.to_thread(self._map, name)
+        except (OSError, ValueError):
+            # Never written, or deleted behind our back
+            self._forget(name)
+            self.stats["misses"] += 1
+            return None
+
+        if name not in self._index:
+            # Written by another process
+            self._adopt(name, len(mapped))
+        self._index.move_to_end(name)
+        self.stats["hits"] += 1
+        return self._iter_mapped(mapped, offset, min(end, len(mapped) - 1))
+
+    def _map(self, name: str) -> mmap.mmap:
+        with open(self._path(name), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Access time is what _scan orders by, whatever the mount's atime policy
+            os.utime(f.fileno())
+        return mapped
+
+    async def put(self, key: str, index: int, data: bytes):
+        """Store a complete block, evicting old blocks past the size cap"""
+        name = self._name(key, index)
+        if name in self._index or len(data) > self.max_bytes:
+            return
+        await asyncio.to_thread(self._write, name, data)
+        self._index[name] = len(data)
+        self._bytes += len(data)
+        self.stats["stored"] += 1
+        if self.evict_on_put:
+            await asyncio.to_thread(self._evict)
+
+    def _iter_mapped(self, mapped: mmap.mmap, start: int, end: int) -> Iterator[memoryview]:
+        view = memoryview(mapped)
+        try:
+            position = start
+            while position <= end:
+                piece = view[position:min(end + 1, position + READ_SIZE)]
+                self.stats["bytes_served"] += len(piece)
+                yield piece
+                position += len(piece)
+        finally:
+            try:
+                view.release()
+                mapped.close()
+            except BufferError:
+                # A slice is still on its way out, the map goes when the last one is dropped
+                pass
+
+    def _name(self, key: str, index: int) -> str:
+        return f"{key}-{index}"
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def _write(self, name: str, data: bytes):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never map a half-written block
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._index:
+            name, _ = next(iter(self._index.items()))
+            self._forget(name)
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+            self.stats["evictions"] += 1
+
+    def _forget(self, name: str):
+        size = self._index.pop(name, None)
+        if size is not None:
+            self._bytes -= size
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        """(last access, name, size) of every block on disk, oldest access first"""
+        found = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                    if filename.endswith(".tmp"):
+                        # Left by a crash, unless another process is writing it right now
+                        if stat.st_mtime < time.time() - 60:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    # Renamed or evicted by another process meanwhile
+                    continue
+                found.append((stat.st_atime, filename, stat.st_size))
+        return sorted(found)
+
+    def _load(self):
+        """Rebuild the index from disk, oldest access first"""
+        for _, name, size in self._scan():
+            self._index[name] = size
+            self._bytes += size
+        if self.evict_on_put:
+            self._evict()
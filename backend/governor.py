@@ -0,0 +1,284 @@
+"""Client-side rate limiting for AniList with priority classes.
+
+AniList allows a fixed number of requests per minute per client and
+answers 429 with Retry-After once it is exceeded, after which every call
+fails, logins and progress saves included. RateGovernor keeps a token
+bucket in step with the X-RateLimit-* headers and hands tokens out by
+priority. Each class keeps a reserve of the bucket free for the classes
+above it, so when the budget runs low, search autocomplete and catalog
+refreshes are shed first (their callers fall back to cached data) while
+saves and logins still get through.
+
+The limit is per client, not per process. When several worker processes
+run (see serve.py), they pass a SharedBucket so the tokens live in one
+SQLite file and every process draws on the same budget; priorities and
+queues stay per process.
+"""
+import asyncio, heapq, itertools, os, sqlite3, threading, time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Optional
+import httpx
+from metrics import Histogram
+
+
+class Priority(IntEnum):
+    MUTATION = 0
+    AUTH = 1
+    DETAIL = 2
+    LIST = 3
+    SEARCH = 4
+    BACKGROUND = 5
+
+
+@dataclass(frozen=True)
+class PriorityPolicy:
+    # Fraction of the bucket that must stay unused for higher classes
+    reserve: float
+    # Longest time to queue for a token before giving up, None waits indefinitely
+    max_wait: Optional[float]
+
+
+DEFAULT_POLICIES = {
+    Priority.MUTATION: PriorityPolicy(reserve=0.0, max_wait=30.0),
+    Priority.AUTH: PriorityPolicy(reserve=0.0, max_wait=10.0),
+    Priority.DETAIL: PriorityPolicy(reserve=0.1, max_wait=5.0),
+    Priority.LIST: PriorityPolicy(reserve=0.25, max_wait=2.0),
+    Priority.SEARCH: PriorityPolicy(reserve=0.4, max_wait=0.0),
+    Priority.BACKGROUND: PriorityPolicy(reserve=0.6, max_wait=None),
+}
+
+
+class BudgetExhausted(Exception):
+    """Not enough rate-limit budget for this priority right now"""
+
+
+class SharedBucket:
+    """
+    Token bucket state kept in a SQLite file so several processes spend one
+    budget. Each operation is one short write transaction that may wait on
+    another process, so the governor runs them in a worker thread; times
+    are wall clock since monotonic clocks aren't comparable across processes.
+    """
+
+    def __init__(self, path: str, name: str = "anilist"):
+        self.name = name
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        # One connection, used from whichever thread runs the operation
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+            "updated REAL NOT NULL, paused_until REAL NOT NULL)"
+        )
+
+    def _update(self, capacity: int, rate: float, change) -> tuple[float, float]:
+        """Refill, apply change(tokens, paused_until, now) -> (tokens, paused_until), and store the result"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._db.execute(
+                    "SELECT tokens, updated, paused_until FROM buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                tokens, updated, paused_until = row if row is not None else (float(capacity), now, 0.0)
+                tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+                tokens, paused_until = change(tokens, paused_until, now)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated, paused_until) VALUES (?, ?, ?, ?)",
+                    (self.name, tokens, now, paused_until),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return tokens, paused_until
+
+    def take(self, capacity: int, rate: float, floor: float) -> tuple[bool, float, float]:
+        """Take a token if at least floor would be left and the bucket isn't paused"""
+        taken = False
+
+        def change(tokens, paused_until, now):
+            nonlocal taken
+            taken = now >= paused_until and tokens - 1 >= floor
+            return (tokens - 1 if taken else tokens), paused_until
+
+        tokens, paused_until = self._update(capacity, rate, change)
+        return taken, tokens, paused_until
+
+    def limit_to(self, capacity: int, rate: float, remaining: float):
+        self._update(capacity, rate, lambda tokens, paused_until, now: (min(tokens, remaining), paused_until))
+
+    def pause(self, capacity: int, rate: float, until: float):
+        self._update(capacity, rate, lambda tokens, paused_until, now: (0.0, max(paused_until, until)))
+
+
+class RateGovernor:
+    def __init__(self, limit_per_minute: int = 90, policies: Optional[dict] = None,
+                 bucket: Optional[SharedBucket] = None):
+        self.policies = {**DEFAULT_POLICIES, **(policies or {})}
+        self.bucket = bucket
+        self._set_limit(limit_per_minute)
+        self.tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self.remaining: Optional[int] = None
+        self.wait_time = {priority: Histogram() for priority in Priority}
+        self.stats = {
+            "granted": {priority.name.lower(): 0 for priority in Priority},
+            "shed": {priority.name.lower(): 0 for priority in Priority},
+            "rate_limited": 0,
+        }
+
+    def _set_limit(self, limit_per_minute: int):
+        self.limit = limit_per_minute
+        self.capacity = max(1, limit_per_minute)
+        self.rate = limit_per_minute / 60.0
+
+    def _refill(self):
+        # With a shared bucket this is an estimate from the last sync; other
+        # processes may have spent some, which the next take finds out
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _sync(self, tokens: float, paused_until: float):
+        """Adopt the shared bucket's state, its pause given in wall-clock time"""
+        self.tokens = tokens
+        self._updated = time.monotonic()
+        self._paused_until = self._updated + max(0.0, paused_until - time.time())
+
+    def _available(self, priority: Priority) -> bool:
+        if time.monotonic() < self._paused_until:
+            return False
+        return self.tokens - 1 >= self.policies[priority].reserve * self.capacity
+
+    async def _try_take(self, priority: Priority) -> bool:
+        """Take a token when the class may have one, counting the grant"""
+        if not self._available(priority):
+            return False
+        if self.bucket is not None:
+            # Another process may have spent the token since the last sync
+            taken, tokens, paused_until = await asyncio.to_thread(
+                self.bucket.take, self.capacity, self.rate, self.policies[priority].reserve * self.capacity
+            )
+            self._sync(tokens, paused_until)
+            if not taken:
+                return False
+        else:
+            self.tokens -= 1
+        self.stats["granted"][priority.name.lower()] += 1
+        return True
+
+    def queue_depth(self) -> dict:
+        depth = {priority.name.lower(): 0 for priority in Priority}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                depth[Priority(priority).name.lower()] += 1
+        return depth
+
+    async def acquire(self, priority: Priority):
+        """Wait for a token, raising BudgetExhausted when the class's max_wait runs out"""
+        self._refill()
+        ahead = any(waiting <= priority and not future.done() for waiting, _, future in self._waiters)
+        if not ahead and await self._try_take(priority):
+            self.wait_time[priority].observe(0.0)
+            return
+
+        max_wait = self.policies[priority].max_wait
+        if max_wait == 0:
+            self.stats["shed"][priority.name.lower()] += 1
+            raise BudgetExhausted(f"No AniList budget for {priority.name.lower()} requests")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._ensure_dispatcher()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted just as the wait ran out, keep the token
+                self.wait_time[priority].observe(time.monotonic() - started)
+                return
+            future.cancel()
+            self.stats["shed"][priority.name.lower()] += 1
+            raise BudgetExhausted(f"Timed out waiting for AniList budget ({priority.name.lower()})")
+        except BaseException:
+            if not future.done():
+                future.cancel()
+            raise
+        self.wait_time[priority].observe(time.monotonic() - started)
+
+    async def observe(self, response: httpx.Response):
+        """Bring the bucket in line with the rate-limit headers of an AniList response"""
+        headers = response.headers
+        limit = headers.get("x-ratelimit-limit")
+        if limit and limit.isdigit() and int(limit) != self.limit:
+            self._set_limit(int(limit))
+        remaining = headers.get("x-ratelimit-remaining")
+        if remaining and remaining.lstrip("-").isdigit():
+            self.remaining = int(remaining)
+            self._refill()
+            # AniList's count is authoritative, it includes requests made before a restart
+            self.tokens = min(self.tokens, max(0, self.remaining))
+            if self.bucket is not None:
+                await asyncio.to_thread(self.bucket.limit_to, self.capacity, self.rate, max(0, self.remaining))
+        if response.status_code == 429:
+            self.stats["rate_limited"] += 1
+            retry_after = headers.get("retry-after", "60")
+            pause = float(retry_after) if retry_after.replace(".", "", 1).isdigit() else 60.0
+            self._paused_until = time.monotonic() + pause
+            self.tokens = 0.0
+            if self.bucket is not None:
+                await asyncio.to_thread(self.bucket.pause, self.capacity, self.rate, time.time() + pause)
+        self._changed.set()
+
+    def snapshot(self) -> dict:
+        self._refill()
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "tokens": round(self.tokens, 2),
+            "remaining": self.remaining,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            "queue_depth": self.queue_depth(),
+            "wait_time": {priority.name.lower(): histogram.snapshot() for priority, histogram in self.wait_time.items()},
+        }
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """Grant queued requests in priority order as the bucket refills"""
+        while self._waiters:
+            head = self._waiters[0]
+            priority, _, future = head
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            self._refill()
+            if await self._try_take(Priority(priority)):
+                # Others may have queued, or this one given up, while a shared take was running
+                self._waiters.remove(head)
+                heapq.heapify(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                continue
+
+            # Sleep until the head of the queue can go, or the headers change the picture
+            needed = self.policies[Priority(priority)].reserve * self.capacity + 1 - self.tokens
+            delay = max(self._paused_until - time.monotonic(), needed / self.rate if self.rate else 1.0, 0.01)
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
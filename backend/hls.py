@@ -0,0 +1,172 @@
+"""HLS (m3u8) proxying: playlist rewriting, segment caching and prefetch.
+
+Playlists are rewritten so every variant playlist, segment, key and init
+section is fetched back through the proxy with the right Referer. Rewritten
+URIs are relative (``hls?url=...`` and ``hls/segment?url=...``), so they
+resolve against whatever prefix the playlist itself was served under.
+"""
+import asyncio, re
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import quote, urljoin
+import httpx
+from cache import TTLCache
+from singleflight import SingleFlight
+
+PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+
+# Tags whose URI attribute points at another playlist rather than a resource
+PLAYLIST_URI_TAGS = ("#EXT-X-MEDIA", "#EXT-X-I-FRAME-STREAM-INF")
+URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+
+class SegmentCache:
+    """LRU of segment bodies bounded by total bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, tuple[bytes, str]] = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._entries
+
+    def get(self, key: tuple) -> Optional[tuple[bytes, str]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, key: tuple, data: bytes, content_type: str):
+        if key in self._entries or len(data) > self.max_bytes:
+            return
+        self._entries[key] = (data, content_type)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+
+def proxied_uri(endpoint: str, url: str, ref: str) -> str:
+    return f"{endpoint}?url={quote(url, safe='')}&ref={quote(ref, safe='')}"
+
+
+def rewrite_playlist(text: str, base_url: str, ref: str) -> tuple[str, list[str]]:
+    """
+    Point every URI in a master or media playlist back at the proxy.
+    Returns the rewritten playlist and the absolute segment URLs in order.
+    """
+    is_master = "#EXT-X-STREAM-INF" in text
+    lines, segments = [], []
+
+    def rewrite_attribute(line: str, endpoint: str) -> str:
+        return URI_ATTRIBUTE.sub(
+            lambda match: f'URI="{proxied_uri(endpoint, urljoin(base_url, match.group(1)), ref)}"', line
+        )
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            lines.append(line)
+        elif stripped.startswith("#"):
+            if 'URI="' in stripped:
+                # Keys and init sections are fetched like segments
+                endpoint = "hls" if stripped.startswith(PLAYLIST_URI_TAGS) else "hls/segment"
+                line = rewrite_attribute(stripped, endpoint)
+            lines.append(line)
+        else:
+            absolute = urljoin(base_url, stripped)
+            if is_master:
+                lines.append(proxied_uri("hls", absolute, ref))
+            else:
+                segments.append(absolute)
+                lines.append(proxied_uri("hls/segment", absolute, ref))
+
+    return "\n".join(lines) + "\n", segments
+
+
+class HlsProxy:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        flights: SingleFlight,
+        segment_cache_bytes: int = 256 * 1024 * 1024,
+        max_concurrency: int = 8,
+        prefetch_segments: int = 3,
+    ):
+        self.client = client
+        self.flights = flights
+        self.segments = SegmentCache(segment_cache_bytes)
+        self.playlists = TTLCache(max_entries=2048, ttl=60)
+        # segment url -> the segments that follow it in its playlist
+        self.upcoming = TTLCache(max_entries=50000, ttl=3600)
+        self.prefetch_segments = prefetch_segments
+        self._upstream = asyncio.Semaphore(max_concurrency)
+        self._prefetching: dict[tuple, asyncio.Task] = {}
+        self.stats = {"playlists_fetched": 0, "segments_fetched": 0, "prefetched": 0}
+
+    async def playlist(self, url: str, ref: str, headers: dict) -> str:
+        """The rewritten playlist at url, cached briefly"""
+        cached = self.playlists.get((url, ref))
+        if cached is not None:
+            return cached
+        return await self.flights.do(("hls-playlist", url, ref), lambda: self._fetch_playlist(url, ref, headers))
+
+    async def segment(self, url: str, ref: str, headers: dict) -> tuple[bytes, str]:
+        """Segment body and content type, from the cache or the upstream"""
+        cached = self.segments.get((url, ref))
+        if cached is None:
+            cached = await self._load_segment(url, ref, headers)
+        self._prefetch_after(url, ref, headers)
+        return cached
+
+    async def _fetch_playlist(self, url: str, ref: str, headers: dict) -> str:
+        response = await self.client.get(url, headers=headers)
+        response.raise_for_status()
+        self.stats["playlists_fetched"] += 1
+
+        text, segments = rewrite_playlist(response.text, str(response.url), ref)
+        for index, segment_url in enumerate(segments):
+            self.upcoming.set((segment_url, ref), segments[index + 1:index + 1 + self.prefetch_segments])
+
+        # VOD playlists never change; live ones are refreshed every couple of seconds
+        ttl = 300 if "#EXT-X-ENDLIST" in text or "#EXT-X-STREAM-INF" in text else 2
+        self.playlists.set((url, ref), text, ttl=ttl)
+        return text
+
+    async def _load_segment(self, url: str, ref: str, headers: dict) -> tuple[bytes, str]:
+        async def fetch():
+            async with self._upstream:
+                response = await self.client.get(url, headers=headers)
+            response.raise_for_status()
+            self.stats["segments_fetched"] += 1
+            entry = (response.content, response.headers.get("content-type", "video/mp2t"))
+            self.segments.put((url, ref), *entry)
+            return entry
+
+        # A viewer asking for a segment that is already being prefetched just waits for it
+        return await self.flights.do(("hls-segment", url, ref), fetch)
+
+    def _prefetch_after(self, url: str, ref: str, headers: dict):
+        for next_url in self.upcoming.get((url, ref)) or []:
+            key = (next_url, ref)
+            if key in self.segments or key in self._prefetching:
+                continue
+            task = asyncio.create_task(self._load_segment(next_url, ref, headers))
+            self._prefetching[key] = task
+            task.add_done_callback(lambda done, key=key: self._prefetch_done(key, done))
+            self.stats["prefetched"] += 1
+
+    def _prefetch_done(self, key: tuple, task: asyncio.Task):
+        self._prefetching.pop(key, None)
+        if not task.cancelled():
+            task.exception()
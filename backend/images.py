@@ -0,0 +1,213 @@
+"""Resized and re-encoded copies of AniList cover and banner images.
+
+GET /img fetches an upstream image once, keeps the original in a disk
+cache, and produces each requested variant (one of a fixed set of widths,
+WebP or AVIF or JPEG) in a process pool so decoding and encoding never run
+on the event loop. Variants go into the same size-capped disk cache and
+are served with immutable caching headers, since a (url, width, format)
+triple always yields the same bytes.
+
+Pillow is optional; without it /img still caches and serves the originals,
+just not resized.
+"""
+import asyncio, hashlib, io, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from urllib.parse import quote, urlsplit
+import httpx
+from chunkstore import ChunkStore
+from metrics import Histogram
+from singleflight import SingleFlight
+
+try:
+    from PIL import Image, features
+except ImportError:  # optional dependency
+    Image = None
+
+# Variants are snapped up to one of these so the cache holds a bounded set per image
+WIDTHS = (160, 320, 480, 720, 1080, 1600)
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg"}
+QUALITY = {"avif": 60, "webp": 80, "jpeg": 85}
+IMMUTABLE = "public, max-age=31536000, immutable"
+MAX_REDIRECTS = 5
+
+
+class ImageRejected(ValueError):
+    """The URL or the upstream response is not something /img will serve"""
+
+
+def snap_width(width: int) -> int:
+    return next((allowed for allowed in WIDTHS if allowed >= width), WIDTHS[-1])
+
+
+def sniff_type(data: bytes) -> Optional[str]:
+    """Media type of an encoded image from its magic bytes"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return None
+
+
+def supported_formats() -> tuple[str, ...]:
+    """Output formats this Pillow build can write, best first"""
+    if Image is None:
+        return ()
+    formats = ("avif",) if features.check("avif") else ()
+    return formats + (("webp",) if features.check("webp") else ()) + ("jpeg",)
+
+
+def transcode(data: bytes, width: int, format: str) -> bytes:
+    """Resize to at most `width` pixels wide and encode; runs in a worker process"""
+    with Image.open(io.BytesIO(data)) as image:
+        # Lets JPEG decode at a reduced scale instead of full size then shrinking
+        image.draft("RGB", (width, max(1, round(image.height * width / image.width))))
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha and format != "jpeg" else "RGB")
+        output = io.BytesIO()
+        image.save(output, format=format.upper(), quality=QUALITY[format])
+        return output.getvalue()
+
+
+class ImageProxy:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        flights: SingleFlight,
+        store: ChunkStore,
+        allowed_hosts: tuple[str, ...],
+        workers: int = 1,
+        max_source_bytes: int = 10 * 1024 * 1024,
+    ):
+        self.client = client
+        self.flights = flights
+        # Originals and variants alike, one "block" per image
+        self.store = store
+        self.allowed_hosts = allowed_hosts
+        self.workers = workers
+        self.max_source_bytes = max_source_bytes
+        self.formats = supported_formats()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.transcode_time = Histogram()
+        self.stats = {"hits": 0, "transcoded": 0, "originals_fetched": 0, "passthrough": 0, "errors": 0}
+
+    def allowed(self, url: str) -> bool:
+        parts = urlsplit(url)
+        return parts.scheme in ("http", "https") and parts.hostname in self.allowed_hosts
+
+    def choose_format(self, requested: Optional[str], accept: str) -> Optional[str]:
+        """The output format, None when images can't be re-encoded here"""
+        if not self.formats:
+            return None
+        if requested:
+            if requested not in self.formats:
+                raise ImageRejected(f"Unsupported format {requested!r}, expected one of {', '.join(self.formats)}")
+            return requested
+        # Best format the browser says it takes; JPEG is the one every browser does
+        return next((format for format in self.formats if MEDIA_TYPES[format] in accept), "jpeg")
+
+    async def get(self, url: str, width: int, format: Optional[str]) -> tuple[bytes, str]:
+        """Body and media type of the variant, produced on first request"""
+        if not self.allowed(url):
+            raise ImageRejected("Image host is not allowed")
+        if format is None:
+            original = await self._original(url)
+            self.stats["passthrough"] += 1
+            return original, sniff_type(original) or "application/octet-stream"
+
+        key = hashlib.sha256(f"{url}\n{width}\n{format}".encode()).hexdigest()[:40]
+        cached = await self._read(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached, MEDIA_TYPES[format]
+        data = await self.flights.do(("img", key), lambda: self._produce(key, url, width, format))
+        return data, MEDIA_TYPES[format]
+
+    async def _produce(self, key: str, url: str, width: int, format: str) -> bytes:
+        original = await self._original(url)
+        started = asyncio.get_running_loop().time()
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(self._executor(), transcode, original, width, format)
+        except Exception as e:
+            self.stats["errors"] += 1
+            raise ImageRejected("Upstream file is not a readable image") from e
+        self.transcode_time.observe(asyncio.get_running_loop().time() - started)
+        self.stats["transcoded"] += 1
+        await self.store.put(key, 0, data)
+        return data
+
+    async def _original(self, url: str) -> bytes:
+        key = hashlib.sha256(f"{url}\noriginal".encode()).hexdigest()[:40]
+        cached = await self._read(key)
+        if cached is not None:
+            return cached
+        return await self.flights.do(("img-original", key), lambda: self._fetch(key, url))
+
+    async def _fetch(self, key: str, url: str) -> bytes:
+        # Redirects are followed by hand so every hop has to be an allowed host too
+        for _ in range(MAX_REDIRECTS + 1):
+            async with self.client.stream("GET", url, follow_redirects=False) as response:
+                if response.is_redirect:
+                    url = str(response.url.join(response.headers["location"]))
+                    if not self.allowed(url):
+                        raise ImageRejected("Image redirects to a host that is not allowed")
+                    continue
+                response.raise_for_status()
+                declared = response.headers.get("content-length", "")
+                if declared.isdigit() and int(declared) > self.max_source_bytes:
+                    raise ImageRejected("Upstream image is too large")
+                pieces, size = [], 0
+                async for piece in response.aiter_bytes():
+                    size += len(piece)
+                    if size > self.max_source_bytes:
+                        raise ImageRejected("Upstream image is too large")
+                    pieces.append(piece)
+                content = b"".join(pieces)
+                if not response.headers.get("content-type", "").startswith("image/") and sniff_type(content) is None:
+                    raise ImageRejected("Upstream response is not an image")
+                break
+        else:
+            raise ImageRejected("Too many redirects")
+        self.stats["originals_fetched"] += 1
+        await self.store.put(key, 0, content)
+        return content
+
+    async def _read(self, key: str) -> Optional[bytes]:
+        pieces = await self.store.read(key, 0, 0, self.max_source_bytes)
+        return b"".join(pieces) if pieces is not None else None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned rather than forked, the server process has threads and open sockets
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def sized_url(self, base: str, url: Optional[str], width: int) -> Optional[str]:
+        """Where to load a width-`width` variant of url, or url itself when /img won't serve it"""
+        if not url or not self.allowed(url):
+            return url
+        return f"{base}?url={quote(url, safe='')}&w={snap_width(width)}"
+
+    def rewrite_media(self, media: dict, base: str, cover_width: int, banner_width: int) -> dict:
+        """A media object with its cover and banner pointing at sized variants"""
+        media = dict(media)
+        if isinstance(media.get("coverImage"), dict):
+            media["coverImage"] = {
+                size: self.sized_url(base, url, cover_width) for size, url in media["coverImage"].items()
+            }
+        if "bannerImage" in media:
+            media["bannerImage"] = self.sized_url(base, media["bannerImage"], banner_width)
+        return media
@@ -1,13 +1,97 @@
 from fastapi import FastAPI
 from fastapi.middleware import cors 
 from fastapi.requests import Request
-from fastapi.responses import StreamingResponse, Response
-import requests, httpx, re
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+import asyncio, hashlib, heapq, httpx, json, math, re, os, tempfile, time
+from contextlib import asynccontextmanager
 from fastapi import HTTPException
 from typing import Optional
 from pydantic import BaseModel
+from cache import TTLCache, create_cache, make_key
+from singleflight import SingleFlight
+from chunkstore import BLOCK_SIZE, ChunkStore
+from readahead import ReadAhead
+from hls import PLAYLIST_CONTENT_TYPE, HlsProxy
+from streams import StreamLimiter, StreamLimitExceeded, guard_stream
+from upstream import UpstreamPools, create_client, load_pool_configs
+from streaming import iter_adaptive, tuning_from_env
+from search_index import MEDIA_FIELDS, SYNC_QUERY, SearchIndex, SearchSync, search_result
+from progress_queue import ProgressQueue, Rejected, RetryLater
+from governor import BudgetExhausted, Priority, RateGovernor, SharedBucket
+from sources import CircuitBreaker, CircuitOpen, HttpResolver, ResolverError, SourceCache, load_resolvers
+from metrics import MetricsMiddleware, registry, stages
+from profiler import StackSampler
+from snapshots import SnapshotStore
+from airing import AiringSchedule
+from warming import Budget, Warmer
+from images import IMMUTABLE, ImageProxy, ImageRejected, snap_width
+from projection import InvalidProjection, Projection, parse_projection, project, selection
 
-app = FastAPI()
+ANILIST_URL = os.getenv("ANILIST_URL", "https://graphql.anilist.co")
+# Whatever ANILIST_URL points at gets AniList's connection pool settings
+ANILIST_HOST = httpx.URL(ANILIST_URL).host
+ANI_CLI_URL = os.getenv("ANI_CLI_URL", "http://localhost:8000/api/ani-cli/v2/stream")
+
+# Shared upstream client with a connection pool per host (see upstream.py),
+# opened and closed with the app
+client: Optional[httpx.AsyncClient] = None
+upstream_pools: Optional[UpstreamPools] = None
+# AniList calls past the pool's connection limit wait here in order, not in
+# the pool where they would time out; sized when the pools are built
+anilist_slots: Optional[asyncio.Semaphore] = None
+
+# serve.py runs one "coordinator" and several "worker" processes that share
+# their caches on disk; only the coordinator runs the background jobs that
+# call upstream on their own. A process started any other way does it all.
+WORKER_ROLE = os.getenv("WORKER_ROLE", "standalone")
+COORDINATOR = WORKER_ROLE != "worker"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, upstream_pools, anilist_slots
+    upstream_pools = UpstreamPools(load_pool_configs(aliases={ANILIST_HOST: "graphql.anilist.co"}))
+    client = create_client(upstream_pools)
+    anilist_slots = asyncio.Semaphore(upstream_pools.config_for(ANILIST_HOST).max_connections)
+    hls_proxy.client = client
+    source_cache.client = client
+    if image_proxy is not None:
+        image_proxy.client = client
+    if WORKER_ROLE == "coordinator":
+        # Workers leave eviction of the shared cache directories to this sweep
+        for store in shared_stores():
+            store.start(CACHE_SWEEP_INTERVAL)
+    if search_sync is not None:
+        search_sync.start()
+    if progress_queue is not None and COORDINATOR:
+        # Workers only journal saves, the coordinator flushes them
+        progress_queue.start()
+    if catalog_snapshots is not None:
+        catalog_snapshots.start()
+    if airing_schedule is not None:
+        airing_schedule.start()
+    if warmer is not None:
+        warmer.start()
+    try:
+        yield
+    finally:
+        if warmer is not None:
+            await warmer.stop()
+        if airing_schedule is not None:
+            await airing_schedule.stop()
+        if catalog_snapshots is not None:
+            await catalog_snapshots.stop()
+        if progress_queue is not None:
+            await progress_queue.stop()
+        if search_sync is not None:
+            await search_sync.stop()
+        for store in shared_stores():
+            await store.stop()
+        if image_proxy is not None:
+            image_proxy.close()
+        await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     cors.CORSMiddleware,
@@ -17,54 +101,416 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so CORS and error handling are timed too; exported at /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Every GraphQL call takes a token first, see governor.py for the priority classes.
+# ANILIST_BUDGET_PATH puts the bucket in a file every worker process draws on
+ANILIST_BUDGET_PATH = os.getenv("ANILIST_BUDGET_PATH")
+anilist_governor = RateGovernor(
+    int(os.getenv("ANILIST_RATE_LIMIT", "90")),
+    bucket=SharedBucket(ANILIST_BUDGET_PATH) if ANILIST_BUDGET_PATH else None,
+)
+
+@app.exception_handler(BudgetExhausted)
+async def budget_exhausted_handler(request: Request, exc: BudgetExhausted):
+    return JSONResponse({"detail": "AniList is busy, try again shortly"}, status_code=503, headers={"Retry-After": "5"})
+
+async def anilist_request(query: str, variables: Optional[dict] = None, access_token: Optional[str] = None,
+                          priority: Priority = Priority.DETAIL) -> httpx.Response:
+    """
+    POST a GraphQL query to AniList over the shared keep-alive client once
+    the governor grants it, raising BudgetExhausted when it is shed
+    """
+    payload = {"query": query}
+    if variables is not None:
+        payload["variables"] = variables
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    if access_token:
+        headers["Authorization"] = f"Bearer {access_token}"
+    await anilist_governor.acquire(priority)
+    async with anilist_slots:
+        with stages.time("anilist"):
+            response = await client.post(ANILIST_URL, headers=headers, json=payload)
+    await anilist_governor.observe(response)
+    return response
+
+class AniListError(Exception):
+    """AniList answered without usable data"""
+
+# Per-endpoint (fresh seconds, extra seconds an expired entry is served while it refreshes)
+CACHE_TTLS = {
+    "anime": (1800, 86400),
+    "trending": (600, 3600),
+    "popular": (3600, 86400),
+    "latest": (300, 1800),
+}
+
+response_cache = create_cache()
+
+# Shared by every upstream call site, keys are namespaced per call type
+flights = SingleFlight()
+
+async def cached_anilist(endpoint: str, query: str, variables: dict, priority: Priority) -> dict:
+    """Run an AniList query through the response cache and return its `data`"""
+    key = make_key(endpoint, query, variables)
+
+    async def fetch_once():
+        response = await anilist_request(query, variables, priority=priority)
+        if response.status_code != 200:
+            raise AniListError(f"AniList returned {response.status_code}")
+        data = response.json().get("data")
+        if data is None:
+            raise AniListError("AniList returned no data")
+        return data
+
+    async def fetch():
+        return await flights.do(key, fetch_once)
+
+    ttl, stale_ttl = CACHE_TTLS[endpoint]
+    return await response_cache.get_or_fetch(key, fetch, ttl, stale_ttl)
+
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
 
-@app.get("/search/{query}")
-def search_anime(query: str):
-    anilistQuery = '''
-        query ($search: String!) {
-            Page {
-                media(search: $search, type: ANIME) {
+@app.get("/stats")
+def get_stats():
+    return {
+        "worker": {"role": WORKER_ROLE, "pid": os.getpid()},
+        "cache": response_cache.stats,
+        "anilist": anilist_governor.snapshot(),
+        "singleflight": {**flights.stats, "in_flight": flights.in_flight},
+        "proxy_info_cache": {**content_info_cache.stats, "entries": len(content_info_cache)},
+        "chunk_store": {**chunk_store.stats, "blocks": len(chunk_store), "bytes": chunk_store.size} if chunk_store is not None else None,
+        "readahead": {**readahead.stats, "buffered_blocks": readahead.buffered_blocks} if readahead else None,
+        "streams": {
+            **stream_limiter.stats,
+            "active": stream_limiter.active,
+            "waiting": stream_limiter.waiting,
+            "clients": stream_limiter.clients,
+        },
+        "upstream": upstream_pools.snapshot() if upstream_pools else {},
+        "sources": source_cache.snapshot(),
+        "catalog_snapshots": catalog_snapshots.snapshot() if catalog_snapshots is not None else None,
+        "images": {
+            **image_proxy.stats,
+            "formats": list(image_proxy.formats),
+            "cache": {**image_proxy.store.stats, "files": len(image_proxy.store), "bytes": image_proxy.store.size},
+        } if image_proxy is not None else None,
+        "warming": warmer.snapshot() if warmer is not None else None,
+        "airing": {
+            **airing_schedule.stats,
+            "tracked": len(airing_schedule),
+            "subscribers": airing_schedule.subscribers,
+        } if airing_schedule is not None else None,
+        "hls": {**hls_proxy.stats, "segment_cache": {**hls_proxy.segments.stats, "bytes": hls_proxy.segments.size}},
+        "viewer_cache": {**viewer_cache.stats, "entries": len(viewer_cache)},
+        "list_cache": {**list_cache.stats, "entries": len(list_cache)},
+        "progress_queue": {**progress_queue.stats, "pending": len(progress_queue)} if progress_queue is not None else None,
+        "search": {
+            **search_index.stats,
+            "titles": len(search_index),
+            "ready": search_index.ready,
+            "sync": search_sync.stats if search_sync else None,
+        } if search_index is not None else None,
+    }
+
+def cache_samples(name: str, hits: int, misses: int, **others: int) -> list:
+    return [({"cache": name, "result": "hit"}, hits), ({"cache": name, "result": "miss"}, misses)] + [
+        ({"cache": name, "result": result}, count) for result, count in others.items()
+    ]
+
+def collect_app_metrics():
+    """Gauges and counters the components already keep, read when /metrics is scraped"""
+    caches = [
+        cache_samples("response", response_cache.stats["hits"], response_cache.stats["misses"], stale=response_cache.stats["stale"]),
+        cache_samples("viewer", **viewer_cache.stats),
+        cache_samples("list", **list_cache.stats),
+        cache_samples("content_info", **content_info_cache.stats),
+        cache_samples("hls_segment", hls_proxy.segments.stats["hits"], hls_proxy.segments.stats["misses"]),
+    ]
+    sources = source_cache.snapshot()
+    caches.append(cache_samples("sources", sources["cache_hits"], sources["cache_misses"]))
+    if chunk_store is not None:
+        caches.append(cache_samples("chunk_store", chunk_store.stats["hits"], chunk_store.stats["misses"]))
+    if image_proxy is not None:
+        caches.append(cache_samples("images", image_proxy.stats["hits"], image_proxy.stats["transcoded"]))
+    if search_index is not None:
+        stats = search_index.stats
+        caches.append(cache_samples("search_index", stats["hits"], stats["misses"], fuzzy_hit=stats["fuzzy_hits"]))
+    yield "cache_requests_total", "counter", "Cache lookups by result", [sample for samples in caches for sample in samples]
+
+    ratios = []
+    for samples in caches:
+        total = sum(count for _, count in samples)
+        misses = sum(count for labels, count in samples if labels["result"] == "miss")
+        ratios.append(({"cache": samples[0][0]["cache"]}, (total - misses) / total if total else 0))
+    yield "cache_hit_ratio", "gauge", "Share of cache lookups answered from the cache since start", ratios
+
+    yield "streams_active", "gauge", "Proxied video streams being relayed", [({}, stream_limiter.active)]
+    yield "streams_waiting", "gauge", "Proxied video streams queued for a slot", [({}, stream_limiter.waiting)]
+    yield "stream_clients", "gauge", "Clients with at least one stream", [({}, stream_limiter.clients)]
+    yield "streams_total", "counter", "Stream admission outcomes", [
+        ({"result": result}, count) for result, count in stream_limiter.stats.items()
+    ]
+    yield "singleflight_in_flight", "gauge", "Distinct upstream calls in flight", [({}, flights.in_flight)]
+    if chunk_store is not None:
+        yield "chunk_store_bytes", "gauge", "Bytes of video held in the chunk store", [({}, chunk_store.size)]
+        yield "chunk_store_served_bytes_total", "counter", "Bytes served from the chunk store", [
+            ({}, chunk_store.stats["bytes_served"])
+        ]
+
+    governor = anilist_governor.snapshot()
+    yield "anilist_tokens", "gauge", "AniList requests the rate governor can grant right now", [({}, governor["tokens"])]
+    yield "anilist_queue_depth", "gauge", "Requests waiting for AniList budget", [
+        ({"priority": priority}, depth) for priority, depth in governor["queue_depth"].items()
+    ]
+    yield "anilist_requests_total", "counter", "AniList budget decisions by priority", [
+        ({"priority": priority, "result": result}, governor[result][priority])
+        for result in ("granted", "shed") for priority in governor["granted"]
+    ]
+    yield "anilist_budget_wait_seconds", "histogram", "Time spent waiting for AniList budget", [
+        ({"priority": priority.name.lower()}, histogram) for priority, histogram in anilist_governor.wait_time.items()
+    ]
+
+    yield "source_resolver_seconds", "histogram", "Source resolver call time", [
+        ({"resolver": resolver.name}, resolver.latency) for resolver in source_resolvers
+    ]
+    yield "source_resolver_calls_total", "counter", "Source resolver calls by outcome", [
+        ({"resolver": resolver.name, "result": result}, count)
+        for resolver in source_resolvers for result, count in resolver.stats.items()
+    ]
+    yield "source_resolver_circuit_open", "gauge", "1 while a resolver's circuit breaker is not closed", [
+        ({"resolver": resolver.name}, int(resolver.breaker.state != "closed")) for resolver in source_resolvers
+    ]
+    yield "sources_time_to_first_seconds", "histogram", "Time until the first playable source of a fan-out", [
+        ({}, source_cache.time_to_first)
+    ]
+    if image_proxy is not None:
+        yield "image_transcode_seconds", "histogram", "Time to resize and encode an image variant in the pool", [
+            ({}, image_proxy.transcode_time)
+        ]
+        yield "image_cache_bytes", "gauge", "Bytes of originals and variants in the image cache", [
+            ({}, image_proxy.store.size)
+        ]
+    if airing_schedule is not None:
+        yield "airing_tracked", "gauge", "Shows in the airing schedule index", [({}, len(airing_schedule))]
+        yield "airing_subscribers", "gauge", "Clients listening for episode releases", [({}, airing_schedule.subscribers)]
+        yield "airing_released_total", "counter", "Episode release events published", [
+            ({}, airing_schedule.stats["released"])
+        ]
+    if warmer is not None:
+        yield "warm_attempts_total", "counter", "Warming attempts for newly aired episodes by outcome", [
+            ({"result": result}, warmer.stats[result]) for result in ("warmed", "not_ready", "errors", "skipped_budget")
+        ]
+        yield "warm_bytes_total", "counter", "Bytes pulled into the chunk cache ahead of viewers", [
+            ({}, warmer.stats["bytes"])
+        ]
+    if catalog_snapshots is not None:
+        stats = catalog_snapshots.stats
+        yield "catalog_snapshot_responses_total", "counter", "Catalog list requests by how the snapshot answered", [
+            ({"result": result}, stats[result]) for result in ("hits", "not_modified", "misses")
+        ]
+        yield "catalog_snapshot_sent_bytes_total", "counter", "Snapshot body bytes sent by content coding", [
+            ({"encoding": encoding}, sent) for encoding, sent in catalog_snapshots.bytes_sent.items()
+        ]
+    if progress_queue is not None:
+        yield "progress_pending", "gauge", "Progress saves waiting to be written to AniList", [({}, progress_queue.pending)]
+
+    if upstream_pools is not None:
+        yield from upstream_pools.collect()
+
+registry.register(collect_app_metrics)
+
+@app.get("/metrics")
+async def get_metrics():
+    # Async so collectors read component state on the event loop, never mid-update
+    if progress_queue is not None:
+        # Counted in a thread, the collector reads the result
+        await progress_queue.count()
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+# Stack sampling of the event loop, PROFILER=1 exposes it (see profiler.py)
+profiler = StackSampler(interval=float(os.getenv("PROFILER_INTERVAL", "0.005"))) if os.getenv("PROFILER", "0") == "1" else None
+
+@app.get("/debug/profile")
+async def get_profile(seconds: float = 10.0):
+    """Collapsed stacks of the event loop over the next `seconds`, for flame graph tools"""
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="Profiler is disabled, set PROFILER=1")
+    return PlainTextResponse(await profiler.profile(seconds))
+
+# Local index answering /search without AniList, SEARCH_INDEX=0 turns it off
+search_index = SearchIndex(
+    os.getenv("SEARCH_INDEX_PATH", os.path.join(tempfile.gettempdir(), "yoru-search.db")),
+) if os.getenv("SEARCH_INDEX", "1") == "1" else None
+
+AIRING_QUERY = '''
+        query ($ids: [Int], $perPage: Int) {
+            Page(perPage: $perPage) {
+                media(id_in: $ids, type: ANIME) {
                     id
-                    title {
-                        romaji
-                        english
-                    }
-                    coverImage {
-                        extraLarge
-                    }
-                    bannerImage
-                    episodes
-                    status
-                    description
-                    seasonYear
                     nextAiringEpisode {
                         airingAt
-                        timeUntilAiring
                         episode
                     }
                 }
             }
         }
+'''
+
+async def fetch_next_airing(ids: list[int]) -> dict:
+    response = await anilist_request(AIRING_QUERY, {"ids": ids, "perPage": len(ids)}, priority=Priority.BACKGROUND)
+    if response.status_code != 200:
+        raise AniListError(f"AniList returned {response.status_code}")
+    data = response.json().get("data")
+    if data is None:
+        raise AniListError("AniList returned no data")
+    return {media["id"]: media["nextAiringEpisode"] for media in data["Page"]["media"]}
+
+AIRING_RETRY_AFTER = float(os.getenv("AIRING_RETRY_AFTER", "60"))
+AIRING_RECHECK_AFTER = 6 * 3600.0
+
+def airing_key(media_id: int) -> str:
+    return make_key("airing", AIRING_QUERY, {"id": media_id})
+
+async def publish_next_airing(ids: list[int]) -> dict:
+    """fetch_next_airing, leaving each answer in the shared cache for the other processes"""
+    found = await fetch_next_airing(ids)
+    for media_id in ids:
+        await response_cache.store(airing_key(media_id), found.get(media_id), AIRING_RECHECK_AFTER)
+    return found
+
+async def shared_next_airing(ids: list[int]) -> dict:
+    """
+    Next airings as the coordinator last published them. AniList is only
+    asked about shows nobody has looked up yet, or that aired a while ago
+    without the coordinator moving on to the following episode.
+    """
+    found, unknown = {}, []
+    overdue = time.time() - 2 * AIRING_RETRY_AFTER
+    for media_id in ids:
+        cached = await response_cache.peek(airing_key(media_id))
+        if cached is None or (cached[0] and cached[0]["airingAt"] < overdue):
+            unknown.append(media_id)
+        elif cached[0]:
+            found[media_id] = cached[0]
+    if unknown:
+        found.update(await publish_next_airing(unknown))
+    return found
+
+AIRING_FETCH = {"standalone": fetch_next_airing, "coordinator": publish_next_airing, "worker": shared_next_airing}
+
+# When each tracked show airs next, refreshed as episodes air and pushed to
+# GET /airing/events (see airing.py); AIRING_SCHEDULE=0 turns it off. Every
+# process keeps its own index for its subscribers, see AIRING_FETCH for how
+# they share the lookups
+airing_schedule = AiringSchedule(
+    AIRING_FETCH[WORKER_ROLE],
+    max_sleep=float(os.getenv("AIRING_MAX_SLEEP", "60")),
+    retry_after=AIRING_RETRY_AFTER,
+    recheck_after=AIRING_RECHECK_AFTER,
+    max_tracked=int(os.getenv("AIRING_MAX_TRACKED", "20000")),
+) if os.getenv("AIRING_SCHEDULE", "1") == "1" else None
+
+@app.get("/airing/upcoming")
+async def get_upcoming_episodes(limit: int = 50):
+    if airing_schedule is None:
+        raise HTTPException(status_code=404, detail="Airing schedule is disabled")
+    return airing_schedule.upcoming(min(limit, 500))
+
+@app.get("/airing/events")
+async def stream_airing_events(media: Optional[str] = None):
+    """
+    Server-sent "episode released" events, for the comma separated media ids
+    in `media` or for every tracked show
+    """
+    if airing_schedule is None:
+        raise HTTPException(status_code=404, detail="Airing schedule is disabled")
+    media_ids = {int(media_id) for media_id in media.split(",") if media_id.strip().isdigit()} if media else None
+    if media_ids:
+        airing_schedule.watch(media_ids)
+
+    async def events():
+        async for event in airing_schedule.subscribe(media_ids, heartbeat=15):
+            # A comment line while idle keeps proxies from closing the stream
+            yield ": keep-alive\n\n" if event is None else f"event: episode\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def fetch_search_page(page: int, sort: str) -> dict:
+    response = await anilist_request(SYNC_QUERY, {"page": page, "perPage": 50, "sort": [sort]}, priority=Priority.BACKGROUND)
+    if response.status_code != 200:
+        raise AniListError(f"AniList returned {response.status_code}")
+    data = response.json().get("data")
+    if data is None:
+        raise AniListError("AniList returned no data")
+    if airing_schedule is not None:
+        airing_schedule.track(data["Page"]["media"])
+    return data["Page"]
+
+search_sync = SearchSync(
+    search_index,
+    fetch_search_page,
+    interval=float(os.getenv("SEARCH_SYNC_INTERVAL", "600")),
+    page_delay=float(os.getenv("SEARCH_SYNC_PAGE_DELAY", "2")),
+    max_pages=int(os.getenv("SEARCH_SYNC_MAX_PAGES", "400")),
+) if search_index is not None and COORDINATOR and os.getenv("SEARCH_SYNC", "1") == "1" else None
+
+def requested_projection(fields: Optional[str], view: Optional[str]) -> Optional[Projection]:
+    """The `fields`/`view` query parameters as a projection, 400 when they name anything unknown"""
+    try:
+        return parse_projection(fields, view)
+    except InvalidProjection as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/search/{query}")
+async def search_anime(query: str, fields: Optional[str] = None, view: Optional[str] = None):
+    projection = requested_projection(fields, view)
+    local = search_index.search(query) if search_index is not None else []
+    if local and search_index.ready:
+        return [search_result(item, projection) for item in local]
+
+    anilistQuery = f'''
+        query ($search: String!) {{
+            Page {{
+                media(search: $search, type: ANIME) {{
+{MEDIA_FIELDS}
+                }}
+            }}
+        }}
     '''
 
     variables = {
         'search': query
     }
 
-    url = 'https://graphql.anilist.co'
+    async def fetch():
+        response = await anilist_request(anilistQuery, variables, priority=Priority.SEARCH)
+        if response.status_code != 200:
+            raise AniListError(f"AniList returned {response.status_code}")
+        return response.json()
 
-    response = requests.post(url, json={'query': anilistQuery, 'variables': variables})
+    try:
+        data = await flights.do(make_key("search", anilistQuery, variables), fetch)
+    except (AniListError, BudgetExhausted):
+        # Autocomplete is shed first, whatever the index has beats nothing
+        return [search_result(item, projection) for item in local]
 
-    return response.json()["data"]["Page"]["media"]
+    # Always the full index fields, the results go into the index too; the projection only trims the reply
+    media = data["data"]["Page"]["media"]
+    if search_index is not None:
+        # Whatever the index missed is there for the next person typing it
+        await search_index.upsert(media)
+    return [search_result(item, projection) for item in media]
 
-@app.get("/anime/{id}")
-def get_anime(id: int):
-    anilistQuery = '''
-        query ($id: Int) {
-            Media (id: $id) {
+# What /anime/{id} selects when the client asks for no projection
+ANIME_FIELDS = '''
                 title {
                     romaji
                     english
@@ -85,35 +531,51 @@ def get_anime(id: int):
                     timeUntilAiring
                     episode
                 }
-            }
-        }
+'''
+
+@app.get("/anime/{id}")
+async def get_anime(id: int, fields: Optional[str] = None, view: Optional[str] = None):
+    projection = requested_projection(fields, view)
+    anilistQuery = f'''
+        query ($id: Int) {{
+            Media (id: $id) {{
+{ANIME_FIELDS if projection is None else selection(projection)}
+            }}
+        }}
     '''
 
     variables = {
         'id': id
     }
 
-    url = 'https://graphql.anilist.co'
+    try:
+        data = await cached_anilist("anime", anilistQuery, variables, Priority.DETAIL)
+    except (AniListError, BudgetExhausted):
+        return {"error": "Anime not found"}
 
-    response = requests.post(url, json={'query': anilistQuery, 'variables': variables})
+    media = data["Media"]
+    if airing_schedule is not None and (projection is None or "nextAiringEpisode" in dict(projection)):
+        if id not in airing_schedule:
+            airing_schedule.update(id, media.get("nextAiringEpisode"))
+        # The cached answer's countdown is as old as the cache entry, the index keeps it current
+        media = airing_schedule.fill(id, media)
+    return media
 
-    if response.status_code != 200:
-        return {"error": "Anime not found"}
+# Media filters of the homepage catalog sections, see catalog_query
+CATALOG_FILTERS = {
+    "trending": "sort: TRENDING_DESC, type: ANIME",
+    "popular": "sort: POPULARITY_DESC, type: ANIME",
+    "latest": "sort: UPDATED_AT_DESC, type: ANIME, status: RELEASING, isAdult: false",
+}
 
-    return response.json()["data"]["Media"]
+CATALOG_ERRORS = {
+    "trending": "Could not fetch trending anime",
+    "popular": "Could not fetch popular anime",
+    "latest": "Could not fetch latest anime",
+}
 
-@app.get("/trending")
-def get_trending_anime(page: int = 1, per_page: int = 20):
-    anilistQuery = '''
-        query ($page: Int, $perPage: Int) {
-            Page(page: $page, perPage: $perPage) {
-                pageInfo {
-                    total
-                    currentPage
-                    lastPage
-                    hasNextPage
-                }
-                media(sort: TRENDING_DESC, type: ANIME) {
+# What the catalog lists select when the client asks for no projection
+CATALOG_FIELDS = '''
                     id
                     title {
                         romaji
@@ -129,153 +591,161 @@ def get_trending_anime(page: int = 1, per_page: int = 20):
                     seasonYear
                     averageScore
                     genres
-                }
-            }
-        }
-    '''
-
-    variables = {
-        'page': page,
-        'perPage': per_page
-    }
-
-    url = 'https://graphql.anilist.co'
+'''
 
-    response = requests.post(url, json={'query': anilistQuery, 'variables': variables})
-
-    if response.status_code != 200:
-        return {"error": "Could not fetch trending anime"}
-
-    data = response.json()["data"]["Page"]
-    return {
-        "media": data["media"],
-        "pageInfo": data["pageInfo"]
-    }
-
-@app.get("/popular")
-def get_popular_anime(page: int = 1, per_page: int = 20):
-    anilistQuery = '''
-        query ($page: Int, $perPage: Int) {
-            Page(page: $page, perPage: $perPage) {
-                pageInfo {
+def catalog_selection(endpoint: str, projection: Optional[Projection] = None) -> str:
+    return f'''
+            Page(page: $page, perPage: $perPage) {{
+                pageInfo {{
                     total
                     currentPage
                     lastPage
                     hasNextPage
-                }
-                media(sort: POPULARITY_DESC, type: ANIME) {
-                    id
-                    title {
-                        romaji
-                        english
-                    }
-                    coverImage {
-                        extraLarge
-                    }
-                    bannerImage
-                    episodes
-                    status
-                    description
-                    seasonYear
-                    averageScore
-                    genres
-                }
-            }
-        }
+                }}
+                media({CATALOG_FILTERS[endpoint]}) {{
+{CATALOG_FIELDS if projection is None else selection(projection)}
+                }}
+            }}
     '''
 
+def catalog_query(endpoint: str, projection: Optional[Projection] = None) -> str:
+    return f"query ($page: Int, $perPage: Int) {{ {catalog_selection(endpoint, projection)} }}"
+
+def catalog_section(page: dict, projection: Optional[Projection] = None, countdown: bool = True) -> dict:
+    media = page["media"]
+    if airing_schedule is not None and (projection is None or "nextAiringEpisode" in dict(projection)):
+        # Lists don't select nextAiringEpisode, the airing index looks it up once and keeps it current
+        airing_schedule.watch(item["id"] for item in media)
+        media = [airing_schedule.fill(item["id"], item, countdown) for item in media]
+    if image_proxy is not None and IMG_REWRITE_BASE:
+        media = [image_proxy.rewrite_media(item, IMG_REWRITE_BASE, IMG_COVER_WIDTH, IMG_BANNER_WIDTH) for item in media]
+    return {
+        "media": media,
+        "pageInfo": page["pageInfo"]
+    }
+
+async def get_catalog(endpoint: str, page: int, per_page: int, priority: Priority = Priority.LIST,
+                      projection: Optional[Projection] = None, countdown: bool = True) -> dict:
     variables = {
         'page': page,
         'perPage': per_page
     }
 
-    url = 'https://graphql.anilist.co'
+    try:
+        # The projection is part of the query text, so each one is cached on its own
+        data = (await cached_anilist(endpoint, catalog_query(endpoint, projection), variables, priority))["Page"]
+    except (AniListError, BudgetExhausted):
+        return {"error": CATALOG_ERRORS[endpoint]}
 
-    response = requests.post(url, json={'query': anilistQuery, 'variables': variables})
+    return catalog_section(data, projection, countdown)
 
-    if response.status_code != 200:
-        return {"error": "Could not fetch popular anime"}
+# Snapshot bodies carry airingAt without timeUntilAiring, a countdown would
+# make every rebuild a new body (and ETag); clients count down from airingAt
+async def refresh_catalog(endpoint: str, page: int, per_page: int, view: Optional[str]) -> dict:
+    return await get_catalog(endpoint, page, per_page, Priority.BACKGROUND, parse_projection(view=view), countdown=False)
 
-    data = response.json()["data"]["Page"]
-    return {
-        "media": data["media"],
-        "pageInfo": data["pageInfo"]
-    }
+async def cached_catalog(endpoint: str, page: int, per_page: int, view: Optional[str]) -> dict:
+    """A catalog page from the response cache alone, which the coordinator's refresh_catalog keeps current"""
+    projection = parse_projection(view=view)
+    cached = await response_cache.peek(
+        make_key(endpoint, catalog_query(endpoint, projection), {'page': page, 'perPage': per_page})
+    )
+    if cached is None:
+        return {"error": CATALOG_ERRORS[endpoint]}
+    return catalog_section(cached[0]["Page"], projection, countdown=False)
 
-@app.get("/latest")
-def get_latest_anime(page: int = 1, per_page: int = 20):
-    anilistQuery = '''
-        query ($page: Int, $perPage: Int) {
-            Page(page: $page, perPage: $perPage) {
-                pageInfo {
-                    total
-                    currentPage
-                    lastPage
-                    hasNextPage
-                }
-                media(sort: UPDATED_AT_DESC, type: ANIME, status: RELEASING, isAdult: false) {
-                    id
-                    title {
-                        romaji
-                        english
-                    }
-                    coverImage {
-                        extraLarge
-                    }
-                    bannerImage
-                    episodes
-                    status
-                    description
-                    seasonYear
-                    averageScore
-                    genres
-                }
-            }
-        }
-    '''
+# The first pages of each list, serialized and compressed ahead of time and
+# sent with ETags (see snapshots.py); CATALOG_SNAPSHOT_PAGES=0 turns it off
+CATALOG_SNAPSHOT_PAGES = int(os.getenv("CATALOG_SNAPSHOT_PAGES", "3"))
+catalog_snapshots = SnapshotStore(
+    ("trending", "popular", "latest"),
+    refresh_catalog if COORDINATOR else cached_catalog,
+    views=(None, "card"),
+    pages=CATALOG_SNAPSHOT_PAGES,
+    per_page=int(os.getenv("CATALOG_SNAPSHOT_PER_PAGE", "20")),
+    interval=float(os.getenv("CATALOG_SNAPSHOT_INTERVAL", "60")),
+) if CATALOG_SNAPSHOT_PAGES > 0 else None
 
-    variables = {
-        'page': page,
-        'perPage': per_page
-    }
+async def catalog_response(request: Request, endpoint: str, page: int, per_page: int,
+                           fields: Optional[str], view: Optional[str]):
+    projection = requested_projection(fields, view)
+    # Snapshots exist per named view, arbitrary field lists always take the query path
+    if catalog_snapshots is not None and not fields:
+        response = catalog_snapshots.respond(request, endpoint, page, per_page, view)
+        if response is not None:
+            return response
+    return await get_catalog(endpoint, page, per_page, projection=projection)
 
-    url = 'https://graphql.anilist.co'
+@app.get("/trending")
+async def get_trending_anime(request: Request, page: int = 1, per_page: int = 20,
+                             fields: Optional[str] = None, view: Optional[str] = None):
+    return await catalog_response(request, "trending", page, per_page, fields, view)
 
-    response = requests.post(url, json={'query': anilistQuery, 'variables': variables})
+@app.get("/popular")
+async def get_popular_anime(request: Request, page: int = 1, per_page: int = 20,
+                            fields: Optional[str] = None, view: Optional[str] = None):
+    return await catalog_response(request, "popular", page, per_page, fields, view)
 
-    if response.status_code != 200:
-        return {"error": "Could not fetch latest anime"}
+@app.get("/latest")
+async def get_latest_anime(request: Request, page: int = 1, per_page: int = 20,
+                           fields: Optional[str] = None, view: Optional[str] = None):
+    return await catalog_response(request, "latest", page, per_page, fields, view)
 
-    data = response.json()["data"]["Page"]
-    return {
-        "media": data["media"],
-        "pageInfo": data["pageInfo"]
-    }
+# The ani-cli scraper plus any resolvers in SOURCE_RESOLVERS, each with a hard
+# deadline and left alone for a while after repeated failures
+source_resolvers = [
+    HttpResolver(
+        "ani-cli",
+        ANI_CLI_URL,
+        deadline=float(os.getenv("SOURCES_DEADLINE", "20")),
+        breaker=CircuitBreaker(
+            threshold=int(os.getenv("SOURCES_BREAKER_THRESHOLD", "5")),
+            reset_after=float(os.getenv("SOURCES_BREAKER_RESET", "30")),
+        ),
+    ),
+    *load_resolvers(os.getenv("SOURCE_RESOLVERS", "")),
+]
+
+# Resolved sources, kept until their signed URLs expire (see sources.py)
+source_cache = SourceCache(
+    source_resolvers,
+    max_entries=int(os.getenv("SOURCES_CACHE_SIZE", "2000")),
+    ttl=float(os.getenv("SOURCES_CACHE_TTL", "1800")),
+    max_prefetches=int(os.getenv("SOURCES_MAX_PREFETCHES", "4")),
+    probe_timeout=float(os.getenv("SOURCES_PROBE_TIMEOUT", "3")),
+)
 
 @app.get("/sources")
-def get_anime_sources(anilist_id: int, title: str, episode: int, dub: bool = False):
-    try: 
-        response = requests.post("http://localhost:8000/api/ani-cli/v2/stream", json={
-            "anilist_id": anilist_id,
-            "title": title,
-            "episode": episode,
-            "dub": dub
-        })
-        if response.status_code != 200:
-            return {"error": "Sources not found"}
-        
-        json_response = response.json()
-    except Exception as e:
+async def get_anime_sources(anilist_id: int, title: str, episode: int, dub: bool = False):
+    """Sources as soon as one is playable; "complete" is false while other resolvers are still running"""
+    if warmer is not None:
+        warmer.record_view(anilist_id, title)
+    try:
+        return await source_cache.get(anilist_id, title, episode, dub)
+    except (ResolverError, CircuitOpen) as e:
         return {"error": str(e)}
 
-    return json_response
+@app.get("/sources/stream")
+async def stream_anime_sources(request: Request, anilist_id: int, title: str, episode: int, dub: bool = False):
+    """
+    Each source as a line of JSON the moment it is confirmed playable, then
+    {"done": true} or {"error": ...}. Sent as server-sent events instead
+    when the client accepts text/event-stream.
+    """
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    if warmer is not None:
+        warmer.record_view(anilist_id, title)
 
-# Create a persistent client with optimized settings
-client = httpx.AsyncClient(
-    follow_redirects=True, 
-    timeout=httpx.Timeout(connect=10.0, read=30.0, write=30.0, pool=10.0),
-    limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
-)
+    async def events():
+        async for event in source_cache.stream(anilist_id, title, episode, dub):
+            line = json.dumps(event)
+            yield f"data: {line}\n\n" if sse else line + "\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 def parse_range_header(range_header: str, content_length: int) -> tuple[int, int]:
     """Parse HTTP Range header and return start, end positions"""
@@ -314,49 +784,366 @@ def parse_range_header(range_header: str, content_length: int) -> tuple[int, int
     
     return start, end
 
-async def get_content_info(url: str, headers: dict) -> tuple[int, str]:
-    """Get content length and type with a HEAD request"""
+# Upstream metadata per (url, Referer), so seeks and buffer ranges don't
+# pay for a HEAD before any bytes flow
+content_info_cache = TTLCache(
+    max_entries=int(os.getenv("PROXY_INFO_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("PROXY_INFO_CACHE_TTL", "600")),
+)
+
+MAX_CHUNK_SIZE = 1024 * 1024 * 2  # 2MB max per proxied response
+
+# Size of the chunks relayed to viewers, adapted per stream (see streaming.py)
+stream_tuning = tuning_from_env()
+
+# Disk cache of proxied bytes shared by every viewer, CHUNK_CACHE_MAX_BYTES=0 turns it off
+CHUNK_CACHE_MAX_BYTES = int(os.getenv("CHUNK_CACHE_MAX_BYTES", str(1024 ** 3)))
+chunk_store = ChunkStore(
+    os.getenv("CHUNK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "yoru-chunks")),
+    CHUNK_CACHE_MAX_BYTES,
+    evict_on_put=WORKER_ROLE == "standalone",
+) if CHUNK_CACHE_MAX_BYTES > 0 else None
+
+# Resized WebP/AVIF copies of AniList images from a disk cache of their own
+# (see images.py); IMG_CACHE_MAX_BYTES=0 turns /img off
+IMG_CACHE_MAX_BYTES = int(os.getenv("IMG_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+image_proxy = ImageProxy(
+    client,  # replaced by the real client in lifespan
+    flights,
+    ChunkStore(
+        os.getenv("IMG_CACHE_DIR", os.path.join(tempfile.gettempdir(), "yoru-images")),
+        IMG_CACHE_MAX_BYTES,
+        evict_on_put=WORKER_ROLE == "standalone",
+    ),
+    allowed_hosts=tuple(os.getenv("IMG_ALLOWED_HOSTS", "s4.anilist.co,img.anili.st").split(",")),
+    workers=int(os.getenv("IMG_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))),
+) if IMG_CACHE_MAX_BYTES > 0 else None
+
+# Under serve.py the workers share these directories and only the coordinator
+# evicts from them, by sweeping each every CACHE_SWEEP_INTERVAL seconds
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "30"))
+
+def shared_stores() -> list[ChunkStore]:
+    return [store for store in (chunk_store, image_proxy.store if image_proxy is not None else None) if store is not None]
+
+# Where browsers reach /img (the frontend serves the backend under /api). When
+# set, catalog lists point covers and banners at sized variants instead of AniList
+IMG_REWRITE_BASE = os.getenv("IMG_REWRITE_BASE", "")
+IMG_COVER_WIDTH = int(os.getenv("IMG_COVER_WIDTH", "384"))
+IMG_BANNER_WIDTH = int(os.getenv("IMG_BANNER_WIDTH", "1600"))
+
+@app.get("/img")
+async def get_image(request: Request, url: str, w: int = 480, format: Optional[str] = None):
+    """
+    The image at url at most w pixels wide (snapped to a fixed set of widths),
+    as WebP or AVIF when the browser takes them, or as asked with format=
+    """
+    if image_proxy is None:
+        raise HTTPException(status_code=404, detail="Image proxy is disabled")
     try:
-        head_response = await client.head(url, headers=headers)
-        content_length = int(head_response.headers.get("content-length", 0))
-        content_type = head_response.headers.get("content-type", "video/mp4")
-        return content_length, content_type
-    except:
-        # Fallback to GET with small range if HEAD fails
+        chosen = image_proxy.choose_format(format, request.headers.get("accept", ""))
+        data, media_type = await image_proxy.get(url, snap_width(w), chosen)
+    except ImageRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail="Failed to fetch image")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Image request failed: {str(e)}")
+
+    headers = {"Cache-Control": IMMUTABLE, "Access-Control-Allow-Origin": "*"}
+    if format is None:
+        headers["Vary"] = "Accept"
+    return Response(data, media_type=media_type, headers=headers)
+
+# Optional background prefetch of the blocks after the one a viewer asked for
+readahead = ReadAhead(
+    BLOCK_SIZE,
+    max_depth=int(os.getenv("READAHEAD_MAX_BLOCKS", "4")),
+    max_streams=int(os.getenv("READAHEAD_MAX_STREAMS", "32")),
+) if os.getenv("PROXY_READAHEAD", "0") == "1" else None
+
+# Both the chunk cache and read-ahead work in whole blocks
+BLOCK_ALIGNED = chunk_store is not None or readahead is not None
+
+# Fetch from the start of the block when the client starts this close to it,
+# so the whole block can be cached without delaying the first byte much
+BLOCK_ALIGN_SLACK = 256 * 1024
+
+def content_info_from_response(response: httpx.Response) -> dict:
+    """Extract length, type, validators and range support from an upstream response"""
+    headers = response.headers
+    content_range = headers.get("content-range", "")
+    # Extract total length from "bytes 0-1023/123456789" format
+    total_match = re.search(r'/(\d+)', content_range)
+    if total_match:
+        content_length = int(total_match.group(1))
+    elif response.request.method == "HEAD" or response.status_code == 200:
+        content_length = int(headers.get("content-length", 0))
+    else:
+        content_length = 0
+
+    return {
+        "content_length": content_length,
+        "content_type": headers.get("content-type", "video/mp4"),
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "accepts_ranges": response.status_code == 206 or headers.get("accept-ranges", "").lower() == "bytes",
+    }
+
+def remember_content_info(url: str, headers: dict, info: dict):
+    # An unknown length tells us nothing, let the next request probe again
+    if info["content_length"] > 0:
+        content_info_cache.set((url, headers.get("Referer")), info)
+
+async def get_content_info(url: str, headers: dict) -> dict:
+    """Get content info from the metadata cache, probing upstream on a miss"""
+    info = content_info_cache.get((url, headers.get("Referer")))
+    if info is None:
+        # Concurrent misses for the same URL share one probe
+        info = await flights.do(("content-info", url, headers.get("Referer")), lambda: probe_content_info(url, headers))
+        remember_content_info(url, headers, info)
+    return info
+
+async def probe_content_info(url: str, headers: dict) -> dict:
+    """Get content info with a HEAD request, confirmed with a small ranged GET when HEAD can't tell"""
+    with stages.time("content_info"):
+        info = None
+        try:
+            head_response = await client.head(url, headers=headers)
+            info = content_info_from_response(head_response)
+            if info["accepts_ranges"]:
+                return info
+            # Not every server advertises ranges, a ranged GET settles it
+        except Exception:
+            # HEAD failed, the ranged GET has to do
+            pass
         range_headers = {**headers, "Range": "bytes=0-1023"}
-        response = await client.get(url, headers=range_headers)
-        content_range = response.headers.get("content-range", "")
-        if content_range:
-            # Extract total length from "bytes 0-1023/123456789" format
-            total_match = re.search(r'/(\d+)', content_range)
-            if total_match:
-                content_length = int(total_match.group(1))
-            else:
-                content_length = 0
-        else:
-            content_length = 0
-        content_type = response.headers.get("content-type", "video/mp4")
-        return content_length, content_type
+        try:
+            # Streamed, so a server ignoring the range doesn't send us the whole file
+            async with client.stream("GET", url, headers=range_headers) as response:
+                return content_info_from_response(response)
+        except Exception:
+            if info is None:
+                raise
+            return info
 
-async def stream_chunk(url: str, headers: dict, start: int, end: int, chunk_size: int = 8192):
+def range_response_headers(start: int, end: int, content_length: int, content_type: str) -> dict:
+    return {
+        "Content-Range": f"bytes {start}-{end}/{content_length}",
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+        "Content-Type": content_type,
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Headers": "Range",
+        "Cache-Control": "public, max-age=3600",
+    }
+
+async def stream_full(url: str, headers: dict):
+    """Relay the whole upstream file"""
+    async with client.stream("GET", url, headers=headers) as response:
+        async for chunk in iter_adaptive(response, stream_tuning):
+            yield chunk
+
+async def stream_chunk(url: str, headers: dict, start: int, end: int):
     """Stream content in chunks for the specified range"""
-    range_header = f"bytes={start}-{end}"
-    request_headers = {**headers, "Range": range_header}
-    
-    async with client.stream("GET", url, headers=request_headers) as response:
-        if response.status_code not in [206, 200]:  # 206 Partial Content or 200 OK
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch content")
-        
-        async for chunk in response.aiter_bytes(chunk_size):
+    response = await open_range(url, headers, start, end, allow_full=True)
+    # A 200 carries the whole file, skip to the range
+    async for chunk in relay_and_store(response, 0 if response.status_code == 200 else start, start, end):
+        yield chunk
+
+def clip_range_end(start: int, end: int) -> int:
+    """Cap a response at about MAX_CHUNK_SIZE, ending on a block boundary when working in blocks"""
+    if not BLOCK_ALIGNED:
+        return min(end, start + MAX_CHUNK_SIZE - 1)
+    # Ending on a boundary makes the player's next request block-aligned
+    block_end = (start // BLOCK_SIZE + 1) * BLOCK_SIZE - 1
+    if block_end - start + 1 < BLOCK_ALIGN_SLACK:
+        block_end += BLOCK_SIZE
+    return min(end, block_end)
+
+def aligned_fetch_start(start: int) -> int:
+    block_start = start - start % BLOCK_SIZE
+    if BLOCK_ALIGNED and start - block_start <= BLOCK_ALIGN_SLACK:
+        return block_start
+    return start
+
+async def open_range(url: str, headers: dict, start: int, end: int, allow_full: bool = False) -> httpx.Response:
+    """
+    Start an upstream ranged GET and return once its headers have arrived.
+    With allow_full, an upstream that ignores the range and answers 200
+    with the whole file is returned too, for the caller to skip into.
+    """
+    request = client.build_request("GET", url, headers={**headers, "Range": f"bytes={start}-{end}"})
+    response = await client.send(request, stream=True)
+    if response.status_code == 200:
+        # Later requests for this URL take the plain passthrough path
+        info = content_info_cache.get((url, headers.get("Referer")))
+        if info is not None:
+            content_info_cache.set((url, headers.get("Referer")), {**info, "accepts_ranges": False})
+        if allow_full:
+            return response
+    if response.status_code != 206:
+        await response.aclose()
+        raise HTTPException(status_code=502, detail="Upstream did not honour the range request")
+    return response
+
+async def relay_and_store(response: httpx.Response, fetch_start: int, start: int, end: int,
+                          key: Optional[str] = None, content_length: int = 0):
+    """
+    Relay bytes start..end of an upstream response whose body begins at
+    fetch_start, storing every complete block that passes through under key.
+    """
+    try:
+        position = fetch_start
+        # Blocks are only stored from their first byte
+        block_index = -(-fetch_start // BLOCK_SIZE)
+        block_start = block_index * BLOCK_SIZE
+        block = bytearray()
+
+        async for data in iter_adaptive(response, stream_tuning):
+            data_end = position + len(data) - 1
+            lo, hi = max(position, start), min(data_end, end)
+            if lo == position and hi == data_end:
+                yield data
+            elif lo <= hi:
+                yield memoryview(data)[lo - position:hi - position + 1]
+
+            if key is not None and data_end >= block_start:
+                block += memoryview(data)[max(0, block_start - position):]
+                while len(block) >= BLOCK_SIZE or (block and block_start + len(block) == content_length):
+                    await chunk_store.put(key, block_index, bytes(block[:BLOCK_SIZE]))
+                    del block[:BLOCK_SIZE]
+                    block_index += 1
+                    block_start += BLOCK_SIZE
+            position = data_end + 1
+            if position > end:
+                # A body that runs past the range (a 200 with the whole file) isn't read any further
+                break
+    finally:
+        await response.aclose()
+
+async def fetch_block(url: str, headers: dict, info: dict, index: int) -> bytes:
+    """Download one whole block, keeping a copy in the chunk cache"""
+    start = index * BLOCK_SIZE
+    end = min(start + BLOCK_SIZE, info["content_length"]) - 1
+    response = await open_range(url, headers, start, end)
+    try:
+        data = await response.aread()
+    finally:
+        await response.aclose()
+    if chunk_store is not None and len(data) == end - start + 1:
+        await chunk_store.put(ChunkStore.object_key(url, info["etag"], info["content_length"]), index, data)
+    return data
+
+def start_readahead(stream, url: str, headers: dict, info: dict, key: Optional[str], start: int, end: int):
+    """Tell read-ahead the viewer is at start..end so it prefetches what comes next"""
+    if readahead is None or stream is None:
+        return
+    readahead.advance(
+        stream,
+        start // BLOCK_SIZE,
+        end // BLOCK_SIZE,
+        (info["content_length"] - 1) // BLOCK_SIZE,
+        lambda index: fetch_block(url, headers, info, index),
+        cached=lambda index: key is not None and chunk_store.has(key, index),
+    )
+
+async def stream_range(url: str, headers: dict, info: dict, start: int, end: int, stream=None):
+    """
+    Stream start..end, serving prefetched and cached blocks first and only
+    fetching the gaps upstream. stream identifies the viewer for read-ahead.
+    """
+    if not BLOCK_ALIGNED:
+        async for chunk in stream_chunk(url, headers, start, end):
             yield chunk
+        return
 
-@app.get("/proxy")
-async def proxy_video(request: Request, url: str, ref: str = "https://example.com"):
+    key = ChunkStore.object_key(url, info["etag"], info["content_length"]) if chunk_store is not None else None
+    start_readahead(stream, url, headers, info, key, start, end)
+
+    try:
+        position = start
+        while position <= end:
+            index = position // BLOCK_SIZE
+            block_start = index * BLOCK_SIZE
+            block_last = min(end, block_start + BLOCK_SIZE - 1)
+
+            prefetched = await readahead.take(stream, index) if readahead is not None and stream is not None else None
+            if prefetched is not None:
+                yield memoryview(prefetched)[position - block_start:block_last - block_start + 1]
+                position = block_last + 1
+                continue
+
+            cached = await chunk_store.read(key, index, position - block_start, block_last - block_start) if key else None
+            if cached is not None:
+                for piece in cached:
+                    yield piece
+                position = block_last + 1
+                continue
+
+            # Fetch the whole run of missing blocks with one upstream request
+            last_index = index
+            while (last_index + 1) * BLOCK_SIZE <= end and not (key and chunk_store.has(key, last_index + 1)):
+                last_index += 1
+            run_end = min(end, (last_index + 1) * BLOCK_SIZE - 1)
+            fetch_start = aligned_fetch_start(position) if key else position
+
+            response = await open_range(url, headers, fetch_start, run_end, allow_full=True)
+            if response.status_code == 200:
+                # The 206 is already on its way; read the whole file up to the range rather than fail mid-body
+                async for piece in relay_and_store(response, 0, position, end):
+                    yield piece
+                return
+            async for piece in relay_and_store(response, fetch_start, position, run_end, key, info["content_length"]):
+                yield piece
+            position = run_end + 1
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client disconnected or seeked away mid-response
+        if readahead is not None and stream is not None:
+            readahead.abandon(stream)
+        raise
+
+async def proxy_first_range(url: str, headers: dict, range_header: Optional[str], stream=None) -> Optional[StreamingResponse]:
     """
-    Optimized video proxy with proper range request handling for fast streaming
+    Serve a request for a URL with no cached metadata by opening the upstream
+    range directly and learning the total length from its Content-Range.
+    Returns None when the request has to go through the probing path instead.
     """
-    # Base headers for the upstream request
-    base_headers = {
+    # Suffix ranges (bytes=-500) need the total length before we can ask upstream
+    range_match = re.match(r'bytes=(\d+)-(\d+)?$', range_header or "bytes=0-")
+    if not range_match:
+        return None
+
+    start = int(range_match.group(1))
+    end = clip_range_end(start, int(range_match.group(2)) if range_match.group(2) else start + MAX_CHUNK_SIZE)
+    if end < start:
+        return None
+
+    fetch_start = aligned_fetch_start(start)
+    request = client.build_request("GET", url, headers={**headers, "Range": f"bytes={fetch_start}-{end}"})
+    response = await client.send(request, stream=True)
+
+    info = content_info_from_response(response)
+    remember_content_info(url, headers, info)
+
+    served = re.match(r'bytes (\d+)-(\d+)/\d+', response.headers.get("content-range", ""))
+    if response.status_code != 206 or not served or int(served.group(1)) != fetch_start:
+        await response.aclose()
+        return None
+
+    end = min(end, int(served.group(2)))
+    key = ChunkStore.object_key(url, info["etag"], info["content_length"]) if chunk_store is not None else None
+    start_readahead(stream, url, headers, info, key, start, end)
+    return StreamingResponse(
+        relay_and_store(response, fetch_start, start, end, key, info["content_length"]),
+        status_code=206,  # Partial Content
+        headers=range_response_headers(start, end, info["content_length"], info["content_type"]),
+        media_type=info["content_type"]
+    )
+
+def proxy_headers(ref: str) -> dict:
+    """Base headers for upstream media requests"""
+    return {
         "Referer": ref,
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.6099.199 Safari/537.36",
         "Accept": "video/webm,video/ogg,video/*;q=0.9,application/ogg;q=0.7,audio/*;q=0.6,*/*;q=0.5",
@@ -365,13 +1152,138 @@ async def proxy_video(request: Request, url: str, ref: str = "https://example.co
         "Cache-Control": "no-cache",
     }
 
+async def warming_candidates() -> list[list[tuple[int, str]]]:
+    """The trending and latest lists as (id, title) in list order, titles as the frontend shows them"""
+    lists = []
+    for endpoint in ("trending", "latest"):
+        section = await get_catalog(endpoint, 1, 50, Priority.BACKGROUND, parse_projection(view="card"))
+        if "error" in section:
+            raise AniListError(section["error"])
+        lists.append([(item["id"], item["title"]["english"] or item["title"]["romaji"]) for item in section["media"]])
+    return lists
+
+async def warm_resolve(anilist_id: int, title: str, episode: int) -> list[dict]:
+    # The following episode hasn't aired, resolving it ahead would only spend the budget
+    result = await source_cache.get(anilist_id, title, episode, False, prefetch_next=False)
+    return [source for source in result["sources"] if source.get("reachable", True)]
+
+async def warm_source(source: dict, max_bytes: int) -> int:
+    """
+    Pull the start of a source, the part every viewer requests first, into
+    the chunk cache in whole blocks; returns the bytes downloaded
+    """
+    url, headers = source["url"], proxy_headers(source.get("referrer") or "https://example.com")
+    if ".m3u8" in url:
+        # Segments are only cached once a playlist names them, warm the playlist itself
+        await hls_proxy.playlist(url, headers["Referer"], headers)
+        return 0
+    info = await get_content_info(url, headers)
+    if chunk_store is None or not info["accepts_ranges"] or info["content_length"] <= 0:
+        return 0
+    key = ChunkStore.object_key(url, info["etag"], info["content_length"])
+    fetched = 0
+    for index in range(math.ceil(min(max_bytes, info["content_length"]) / BLOCK_SIZE)):
+        if not chunk_store.has(key, index):
+            fetched += len(await fetch_block(url, headers, info, index))
+    return fetched
+
+# Resolves and caches fresh episodes of the top shows as they air (see
+# warming.py); needs the airing schedule, WARMING=0 turns it off
+warmer = Warmer(
+    airing_schedule,
+    warming_candidates,
+    warm_resolve,
+    warm_source,
+    resolve_budget=Budget(float(os.getenv("WARM_MAX_RESOLVES_PER_HOUR", "60"))),
+    byte_budget=Budget(float(os.getenv("WARM_MAX_BYTES_PER_HOUR", str(1024 * 1024 * 1024)))),
+    top_n=int(os.getenv("WARM_TOP_N", "20")),
+    warm_bytes=int(os.getenv("WARM_BYTES", str(8 * 1024 * 1024))),
+    retry_delays=tuple(float(delay) for delay in os.getenv("WARM_RETRY_DELAYS", "0,120,300,600,1200").split(",")),
+    lists_interval=float(os.getenv("WARM_LISTS_INTERVAL", "600")),
+    concurrency=int(os.getenv("WARM_CONCURRENCY", "2")),
+) if airing_schedule is not None and COORDINATOR and os.getenv("WARMING", "1") == "1" else None
+
+# Concurrent upstream streams, so one viewer scrubbing a timeline can't starve the rest
+stream_limiter = StreamLimiter(
+    max_streams=int(os.getenv("PROXY_MAX_STREAMS", "16")),
+    max_per_client=int(os.getenv("PROXY_MAX_STREAMS_PER_CLIENT", "4")),
+    max_queue=int(os.getenv("PROXY_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("PROXY_QUEUE_TIMEOUT", "5")),
+)
+
+# Only enable behind a reverse proxy that sets X-Forwarded-For itself
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+
+def client_id(request: Request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+@app.get("/proxy")
+async def proxy_video(request: Request, url: str, ref: str = "https://example.com"):
+    """
+    Optimized video proxy with proper range request handling for fast streaming
+    """
+    client_key = client_id(request)
+    try:
+        slot = await stream_limiter.acquire(client_key)
+    except StreamLimitExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    try:
+        response = await build_proxy_response(request, url, ref, client_key)
+    except BaseException:
+        slot.release()
+        raise
+
+    if not isinstance(response, StreamingResponse):
+        slot.release()
+        return response
+
+    # The slot is held until the upstream stream finishes or the client goes away
+    def on_disconnect():
+        stream_limiter.stats["disconnected"] += 1
+
+    response.body_iterator = guard_stream(response.body_iterator, request.is_disconnected, slot.release, on_disconnect)
+    return response
+
+async def build_proxy_response(request: Request, url: str, ref: str, client_key: str) -> Response:
+    # Base headers for the upstream request
+    base_headers = proxy_headers(ref)
+
+    # Read-ahead state is per viewer and video
+    stream_id = (client_key, url, ref)
+
     try:
-        # Get content info (length and type)
-        content_length, content_type = await get_content_info(url, base_headers)
-        
         # Check if client is requesting a specific range
         range_header = request.headers.get("range")
-        
+
+        # Get content info (length and type)
+        info = content_info_cache.get((url, ref))
+        if info is None:
+            # First request for this URL: skip the probe and stream the range straight away
+            first_response = await proxy_first_range(url, base_headers, range_header, stream_id)
+            if first_response is not None:
+                return first_response
+            info = await get_content_info(url, base_headers)
+        content_length, content_type = info["content_length"], info["content_type"]
+
+        if not info["accepts_ranges"]:
+            # A 206 can't be produced faithfully from an upstream without ranges, relay the whole file
+            return StreamingResponse(
+                stream_full(url, base_headers),
+                status_code=200,
+                media_type=content_type,
+                headers={
+                    **({"Content-Length": str(content_length)} if content_length > 0 else {}),
+                    "Accept-Ranges": "none",
+                    "Access-Control-Allow-Origin": "*",
+                    "Cache-Control": "public, max-age=3600",
+                },
+            )
+
         if range_header and content_length > 0:
             # Handle partial content request (seeking/buffering)
             try:
@@ -379,24 +1291,12 @@ async def proxy_video(request: Request, url: str, ref: str = "https://example.co
                 
                 # Limit chunk size for faster initial loading
                 # For seeking: load only what's requested + small buffer
-                max_chunk_size = 1024 * 1024 * 2  # 2MB max per request
-                if (end - start + 1) > max_chunk_size:
-                    end = start + max_chunk_size - 1
-                
-                response_headers = {
-                    "Content-Range": f"bytes {start}-{end}/{content_length}",
-                    "Accept-Ranges": "bytes",
-                    "Content-Length": str(end - start + 1),
-                    "Content-Type": content_type,
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": "Range",
-                    "Cache-Control": "public, max-age=3600",
-                }
+                end = clip_range_end(start, end)
                 
                 return StreamingResponse(
-                    stream_chunk(url, base_headers, start, end),
+                    stream_range(url, base_headers, info, start, end, stream_id),
                     status_code=206,  # Partial Content
-                    headers=response_headers,
+                    headers=range_response_headers(start, end, content_length, content_type),
                     media_type=content_type
                 )
                 
@@ -408,35 +1308,19 @@ async def proxy_video(request: Request, url: str, ref: str = "https://example.co
             # No range requested - serve initial chunk for fast playback start
             if content_length > 0:
                 # Serve only first 2MB for initial load
-                initial_chunk_size = min(content_length, 1024 * 1024 * 2)  # 2MB
-                start, end = 0, initial_chunk_size - 1
-                
-                response_headers = {
-                    "Content-Range": f"bytes {start}-{end}/{content_length}",
-                    "Accept-Ranges": "bytes", 
-                    "Content-Length": str(end - start + 1),
-                    "Content-Type": content_type,
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Headers": "Range",
-                    "Cache-Control": "public, max-age=3600",
-                }
+                start, end = 0, clip_range_end(0, content_length - 1)
                 
                 return StreamingResponse(
-                    stream_chunk(url, base_headers, start, end),
+                    stream_range(url, base_headers, info, start, end, stream_id),
                     status_code=206,  # Partial Content
-                    headers=response_headers,
+                    headers=range_response_headers(start, end, content_length, content_type),
                     media_type=content_type
                 )
             
             else:
                 # Fallback: stream entire content (for cases where length is unknown)
-                async def stream_full():
-                    async with client.stream("GET", url, headers=base_headers) as response:
-                        async for chunk in response.aiter_bytes(8192):
-                            yield chunk
-                
                 return StreamingResponse(
-                    stream_full(),
+                    stream_full(url, base_headers),
                     status_code=200,
                     media_type=content_type,
                     headers={
@@ -450,6 +1334,98 @@ async def proxy_video(request: Request, url: str, ref: str = "https://example.co
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+hls_proxy = HlsProxy(
+    client,  # replaced by the real client in lifespan
+    flights,
+    segment_cache_bytes=int(os.getenv("HLS_SEGMENT_CACHE_BYTES", str(256 * 1024 * 1024))),
+    max_concurrency=int(os.getenv("HLS_MAX_CONCURRENCY", "8")),
+    prefetch_segments=int(os.getenv("HLS_PREFETCH_SEGMENTS", "3")),
+)
+
+@app.get("/proxy/hls")
+async def proxy_hls_playlist(url: str, ref: str = "https://example.com"):
+    """
+    HLS master or media playlist with every URI rewritten to go back through the proxy
+    """
+    try:
+        playlist = await hls_proxy.playlist(url, ref, proxy_headers(ref))
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail="Failed to fetch playlist")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Proxy request failed: {str(e)}")
+
+    return Response(
+        playlist,
+        media_type=PLAYLIST_CONTENT_TYPE,
+        headers={"Access-Control-Allow-Origin": "*", "Cache-Control": "no-cache"},
+    )
+
+@app.get("/proxy/hls/segment")
+async def proxy_hls_segment(request: Request, url: str, ref: str = "https://example.com"):
+    """
+    HLS segment, key or init section, served from the segment cache when possible
+    """
+    headers = proxy_headers(ref)
+    range_header = request.headers.get("range")
+    if range_header:
+        # EXT-X-BYTERANGE segments share one URL, pass those ranges straight through
+        return await proxy_hls_range(request, url, {**headers, "Range": range_header})
+
+    try:
+        data, content_type = await hls_proxy.segment(url, ref, headers)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail="Failed to fetch segment")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Proxy request failed: {str(e)}")
+
+    return Response(
+        data,
+        media_type=content_type,
+        headers={"Access-Control-Allow-Origin": "*", "Cache-Control": "public, max-age=3600"},
+    )
+
+async def proxy_hls_range(request: Request, url: str, headers: dict) -> StreamingResponse:
+    """Relay a ranged segment request as it arrives, holding a stream slot like /proxy"""
+    client_key = client_id(request)
+    try:
+        slot = await stream_limiter.acquire(client_key)
+    except StreamLimitExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    try:
+        upstream = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except httpx.RequestError as e:
+        slot.release()
+        raise HTTPException(status_code=502, detail=f"Proxy request failed: {str(e)}")
+    except BaseException:
+        slot.release()
+        raise
+
+    async def relay():
+        try:
+            async for chunk in iter_adaptive(upstream, stream_tuning):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    def on_disconnect():
+        stream_limiter.stats["disconnected"] += 1
+
+    passthrough = {"Access-Control-Allow-Origin": "*"}
+    if "content-range" in upstream.headers:
+        passthrough["Content-Range"] = upstream.headers["content-range"]
+    # Relayed raw unless encoded, when httpx decodes it and the length no longer holds
+    if "content-length" in upstream.headers and upstream.headers.get("content-encoding", "identity") == "identity":
+        passthrough["Content-Length"] = upstream.headers["content-length"]
+    return StreamingResponse(
+        guard_stream(relay(), request.is_disconnected, slot.release, on_disconnect),
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "video/mp2t"),
+        headers=passthrough,
+        # The relay closes it when the client leaves mid-body, this after a complete response
+        background=BackgroundTask(upstream.aclose),
+    )
+
 # AniList Authentication Models
 class UpdateProgressRequest(BaseModel):
     media_id: int
@@ -460,12 +1436,13 @@ class UpdateProgressRequest(BaseModel):
 class AniListUserRequest(BaseModel):
     access_token: str
 
-# AniList Authentication Endpoints
-@app.post("/anilist/user")
-async def get_anilist_user(request: AniListUserRequest):
-    """Get AniList user information from access token"""
-    query = """
-        query {
+class HomeRequest(BaseModel):
+    access_token: Optional[str] = None
+    # Viewer id from /anilist/user, lets continue watching join the same round trip
+    user_id: Optional[int] = None
+    per_page: int = 20
+
+VIEWER_SELECTION = """
             Viewer {
                 id
                 name
@@ -473,66 +1450,9 @@ async def get_anilist_user(request: AniListUserRequest):
                     medium
                 }
             }
-        }
-    """
-    
-    try:
-        response = await client.post(
-            "https://graphql.anilist.co",
-            headers={
-                "Authorization": f"Bearer {request.access_token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            json={"query": query}
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid access token")
-            
-        data = response.json()
-        
-        if "errors" in data:
-            raise HTTPException(status_code=401, detail="Authentication failed")
-            
-        return data["data"]["Viewer"]
-        
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=502, detail=f"AniList request failed: {str(e)}")
+"""
 
-@app.post("/continue-watching")
-async def get_continue_watching(request: AniListUserRequest):
-    """Get user's continue watching list from AniList"""
-    
-    # First get user info
-    user_query = """
-        query {
-            Viewer {
-                id
-            }
-        }
-    """
-    
-    try:
-        user_response = await client.post(
-            "https://graphql.anilist.co",
-            headers={
-                "Authorization": f"Bearer {request.access_token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            json={"query": user_query}
-        )
-        
-        if user_response.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid access token")
-            
-        user_data = user_response.json()
-        user_id = user_data["data"]["Viewer"]["id"]
-        
-        # Get continue watching list
-        continue_query = """
-            query ($userId: Int) {
+CONTINUE_WATCHING_SELECTION = """
                 MediaListCollection(userId: $userId, type: ANIME, status: CURRENT) {
                     lists {
                         entries {
@@ -556,55 +1476,263 @@ async def get_continue_watching(request: AniListUserRequest):
                         }
                     }
                 }
-            }
-        """
-        
-        response = await client.post(
-            "https://graphql.anilist.co",
-            headers={
-                "Authorization": f"Bearer {request.access_token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            json={
-                "query": continue_query,
-                "variables": {"userId": user_id}
-            }
-        )
-        
+"""
+
+# Most recently updated entries returned by the continue-watching endpoints
+CONTINUE_WATCHING_LIMIT = int(os.getenv("CONTINUE_WATCHING_LIMIT", "50"))
+
+def continue_watching_entries(collection: Optional[dict]) -> list:
+    """The most recently updated entries of a MediaListCollection"""
+    lists = (collection or {}).get("lists") or []
+    entries = (entry for list_item in lists for entry in list_item["entries"])
+    return heapq.nlargest(CONTINUE_WATCHING_LIMIT, entries, key=lambda x: x.get("updatedAt", 0))
+
+def token_key(access_token: str) -> str:
+    """Cache key for an access token, so raw tokens are never kept"""
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+# Token -> viewer, so the Viewer lookup isn't repeated on every call
+viewer_cache = TTLCache(
+    max_entries=int(os.getenv("VIEWER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("VIEWER_CACHE_TTL", "300")),
+)
+
+# Viewer id -> (when it was requested, continue-watching entries), dropped
+# when that viewer saves progress
+LIST_CACHE_TTL = float(os.getenv("LIST_CACHE_TTL", "300"))
+list_cache = TTLCache(
+    max_entries=int(os.getenv("LIST_CACHE_SIZE", "10000")),
+    ttl=LIST_CACHE_TTL,
+)
+
+def list_saved_key(user_id: int) -> str:
+    return f"list-saved:{user_id}"
+
+async def mark_list_saved(user_id: int):
+    """Drop the viewer's cached list, in the other worker processes too"""
+    list_cache.pop(user_id)
+    if WORKER_ROLE != "standalone":
+        # The save may have been flushed by another process, which can't reach this one's list_cache
+        await response_cache.store(list_saved_key(user_id), time.time(), LIST_CACHE_TTL)
+
+async def cached_list(user_id: int) -> Optional[list]:
+    """The viewer's cached entries, None when missing or requested before their last save"""
+    cached = list_cache.get(user_id)
+    if cached is None:
+        return None
+    requested_at, entries = cached
+    if WORKER_ROLE != "standalone":
+        saved = await response_cache.peek(list_saved_key(user_id))
+        if saved is not None and saved[0] >= requested_at:
+            list_cache.pop(user_id)
+            return None
+    return entries
+
+async def get_viewer(access_token: str) -> dict:
+    """The token's viewer, raising 401 when AniList rejects the token"""
+    key = token_key(access_token)
+    viewer = viewer_cache.get(key)
+    if viewer is not None:
+        return viewer
+
+    async def fetch():
+        response = await anilist_request(f"query {{ {VIEWER_SELECTION} }}", access_token=access_token, priority=Priority.AUTH)
         if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to fetch continue watching")
-            
+            raise HTTPException(status_code=401, detail="Invalid access token")
+
         data = response.json()
-        
+
         if "errors" in data:
-            return {"entries": []}
-            
-        # Extract entries from the nested structure
-        entries = []
-        if data["data"]["MediaListCollection"]["lists"]:
-            for list_item in data["data"]["MediaListCollection"]["lists"]:
-                entries.extend(list_item["entries"])
-        
-        # Sort by most recently updated
-        entries.sort(key=lambda x: x.get("updatedAt", 0), reverse=True)
-        
-        return {"entries": entries}
-        
+            raise HTTPException(status_code=401, detail="Authentication failed")
+
+        viewer_cache.set(key, data["data"]["Viewer"])
+        return data["data"]["Viewer"]
+
+    return await flights.do(("viewer", key), fetch)
+
+async def get_list_entries(access_token: str, user_id: int) -> list:
+    """Continue-watching entries of a viewer already checked against the token"""
+    entries = await cached_list(user_id)
+    if entries is not None:
+        return entries
+
+    requested_at = time.time()
+    response = await anilist_request(
+        f"query ($userId: Int) {{ {CONTINUE_WATCHING_SELECTION} }}", {"userId": user_id}, access_token, Priority.LIST
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Failed to fetch continue watching")
+
+    data = response.json()
+
+    if "errors" in data:
+        return []
+
+    entries = continue_watching_entries(data["data"]["MediaListCollection"])
+    list_cache.set(user_id, (requested_at, entries))
+    return entries
+
+async def with_pending_progress(entries: list, user_id: int) -> list:
+    """Entries with the saves still waiting in the progress queue applied"""
+    pending = await progress_queue.pending_for(user_id) if progress_queue is not None else {}
+    if not pending:
+        return entries
+
+    merged = []
+    for entry in entries:
+        update = pending.get(entry["media"]["id"])
+        if update is None:
+            merged.append(entry)
+        elif update["status"] == "CURRENT":
+            merged.append({**entry, **update})
+        # Completed shows drop off the CURRENT list
+    return heapq.nlargest(CONTINUE_WATCHING_LIMIT, merged, key=lambda x: x.get("updatedAt", 0))
+
+# AniList Authentication Endpoints
+@app.post("/anilist/user")
+async def get_anilist_user(request: AniListUserRequest):
+    """Get AniList user information from access token"""
+    try:
+        return await get_viewer(request.access_token)
     except httpx.RequestError as e:
         raise HTTPException(status_code=502, detail=f"AniList request failed: {str(e)}")
 
-@app.post("/anilist/update-progress")
-async def update_progress(request: UpdateProgressRequest):
-    """Update anime watching progress on AniList"""
-    
-    # Determine status based on progress
-    status = "COMPLETED" if request.episode >= request.total_episodes else "CURRENT"
-    
-    mutation = """
+@app.post("/continue-watching")
+async def get_continue_watching(request: AniListUserRequest):
+    """Get user's continue watching list from AniList"""
+    try:
+        viewer = await get_viewer(request.access_token)
+        entries = await get_list_entries(request.access_token, viewer["id"])
+        return {"entries": await with_pending_progress(entries, viewer["id"])}
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"AniList request failed: {str(e)}")
+
+def home_query(endpoints: list[str], with_viewer: bool, with_list: bool) -> str:
+    """One aliased document selecting each requested homepage section"""
+    definitions, selections = [], []
+    if endpoints:
+        definitions += ["$page: Int", "$perPage: Int"]
+        selections += [f"{endpoint}: {catalog_selection(endpoint)}" for endpoint in endpoints]
+    if with_viewer:
+        selections.append(f"viewer: {VIEWER_SELECTION}")
+    if with_list:
+        definitions.append("$userId: Int")
+        selections.append(f"continueWatching: {CONTINUE_WATCHING_SELECTION}")
+    header = f"query ({', '.join(definitions)})" if definitions else "query"
+    return f"{header} {{ {''.join(selections)} }}"
+
+async def fetch_home_sections(endpoints: list[str], variables: dict, access_token: Optional[str] = None,
+                              with_viewer: bool = False, user_id: Optional[int] = None) -> dict:
+    """
+    Fetch the given catalog sections, the viewer and the list of user_id in
+    one request, caching each catalog section under the same key its own
+    endpoint uses. Sections AniList could not resolve come back None.
+    """
+    query = home_query(endpoints, with_viewer, user_id is not None)
+    query_variables = {**(variables if endpoints else {}), **({"userId": user_id} if user_id is not None else {})}
+
+    async def fetch():
+        # Signing in goes with the auth class, a plain homepage with the lists
+        priority = Priority.AUTH if with_viewer else Priority.LIST
+        response = await anilist_request(query, query_variables or None, access_token, priority)
+        # A rejected token still comes back as JSON with some sections null, an outage may not be JSON at all
+        if response.status_code >= 500 or response.status_code == 429:
+            raise AniListError(f"AniList returned {response.status_code}")
+        try:
+            data = response.json().get("data")
+        except ValueError as e:
+            raise AniListError(f"AniList returned {response.status_code}") from e
+        if not data:
+            raise AniListError(f"AniList returned {response.status_code}")
+        for endpoint in endpoints:
+            if data.get(endpoint) is not None:
+                await response_cache.store(
+                    make_key(endpoint, catalog_query(endpoint), variables), {"Page": data[endpoint]}, *CACHE_TTLS[endpoint]
+                )
+        return data
+
+    if access_token:
+        return await fetch()
+    return await flights.do(make_key("home", query, query_variables), fetch)
+
+@app.post("/home")
+async def get_home(request: HomeRequest):
+    """
+    Everything the homepage shows, for one AniList round trip at most: the
+    catalog sections that are not cached plus, given an access token, the
+    viewer and their continue-watching list, merged into one aliased query.
+    """
+    variables = {
+        'page': 1,
+        'perPage': request.per_page
+    }
+    cached = dict(zip(CATALOG_FILTERS, await asyncio.gather(
+        *(response_cache.peek(make_key(endpoint, catalog_query(endpoint), variables)) for endpoint in CATALOG_FILTERS)
+    )))
+    missing = [endpoint for endpoint, entry in cached.items() if entry is None]
+    stale = [endpoint for endpoint, entry in cached.items() if entry is not None and not entry[1]]
+    pages = {endpoint: entry[0]["Page"] for endpoint, entry in cached.items() if entry is not None}
+
+    token = request.access_token
+    viewer = viewer_cache.get(token_key(token)) if token else None
+    entries = await cached_list(viewer["id"]) if viewer is not None else None
+    # Without a cached viewer the stored id is a guess, checked against the viewer in the response
+    list_user = (viewer["id"] if viewer is not None else request.user_id) if token and entries is None else None
+    with_viewer = bool(token) and viewer is None
+
+    data = {}
+    requested_at = time.time()
+    if missing or with_viewer or list_user is not None:
+        # Stale sections ride along for free when a request is made anyway
+        wanted = missing + stale
+        try:
+            data = await fetch_home_sections(wanted, variables, token, with_viewer, list_user)
+        except (AniListError, BudgetExhausted, httpx.RequestError):
+            pass
+        failed = [endpoint for endpoint in missing if data.get(endpoint) is None]
+        if token and failed:
+            # A rejected token fails the whole document, the catalog doesn't need it
+            try:
+                data.update(await fetch_home_sections(failed, variables))
+            except (AniListError, BudgetExhausted, httpx.RequestError):
+                pass
+    elif stale:
+        response_cache.refresh_in_background(
+            make_key("home", ",".join(stale), variables), lambda: fetch_home_sections(stale, variables)
+        )
+
+    for endpoint in CATALOG_FILTERS:
+        if data.get(endpoint) is not None:
+            pages[endpoint] = data[endpoint]
+    result = {
+        endpoint: catalog_section(pages[endpoint]) if endpoint in pages else {"error": CATALOG_ERRORS[endpoint]}
+        for endpoint in CATALOG_FILTERS
+    }
+
+    if with_viewer and data.get("viewer") is not None:
+        viewer = data["viewer"]
+        viewer_cache.set(token_key(token), viewer)
+    result["user"] = viewer
+    result["continueWatching"] = None
+    if viewer is not None:
+        if entries is None and list_user == viewer["id"] and data.get("continueWatching") is not None:
+            entries = continue_watching_entries(data["continueWatching"])
+            list_cache.set(viewer["id"], (requested_at, entries))
+        elif entries is None:
+            # First visit after logging in, the list needs the viewer's id
+            try:
+                entries = await get_list_entries(token, viewer["id"])
+            except (HTTPException, BudgetExhausted, httpx.RequestError):
+                entries = []
+        result["continueWatching"] = {"entries": await with_pending_progress(entries, viewer["id"])}
+
+    return result
+
+SAVE_PROGRESS_MUTATION = """
         mutation ($mediaId: Int, $progress: Int, $status: MediaListStatus) {
             SaveMediaListEntry (mediaId: $mediaId, progress: $progress, status: $status) {
                 id
+                userId
                 progress
                 status
                 media {
@@ -616,44 +1744,84 @@ async def update_progress(request: UpdateProgressRequest):
             }
         }
     """
-    
+
+async def save_progress(access_token: str, media_id: int, progress: int, status: str) -> dict:
+    """Run SaveMediaListEntry, raising RetryLater for failures worth retrying and Rejected otherwise"""
     try:
-        response = await client.post(
-            "https://graphql.anilist.co",
-            headers={
-                "Authorization": f"Bearer {request.access_token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            json={
-                "query": mutation,
-                "variables": {
-                    "mediaId": request.media_id,
-                    "progress": request.episode,
-                    "status": status
-                }
-            }
+        response = await anilist_request(
+            SAVE_PROGRESS_MUTATION,
+            {"mediaId": media_id, "progress": progress, "status": status},
+            access_token,
+            Priority.MUTATION,
         )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to update progress")
-            
-        data = response.json()
-        
-        if "errors" in data:
-            error_msg = data["errors"][0]["message"] if data["errors"] else "Unknown error"
-            raise HTTPException(status_code=400, detail=f"AniList error: {error_msg}")
-            
-        result = data["data"]["SaveMediaListEntry"]
-        
+    except httpx.RequestError as e:
+        raise RetryLater(f"AniList request failed: {str(e)}") from e
+    except BudgetExhausted as e:
+        raise RetryLater(str(e)) from e
+
+    if response.status_code == 429:
+        raise RetryLater("Rate limited by AniList", float(response.headers.get("retry-after", "60")))
+    if response.status_code >= 500:
+        raise RetryLater("Failed to update progress")
+    if response.status_code != 200:
+        raise Rejected("Failed to update progress")
+
+    data = response.json()
+
+    if "errors" in data:
+        error_msg = data["errors"][0]["message"] if data["errors"] else "Unknown error"
+        raise Rejected(f"AniList error: {error_msg}")
+
+    return data["data"]["SaveMediaListEntry"]
+
+# Saves are acknowledged at once and written behind, PROGRESS_QUEUE=0 writes them synchronously
+progress_queue = ProgressQueue(
+    os.getenv("PROGRESS_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "yoru-progress.db")),
+    save_progress,
+    on_saved=mark_list_saved,
+    settle=float(os.getenv("PROGRESS_SETTLE", "5")),
+    max_wait=float(os.getenv("PROGRESS_MAX_WAIT", "60")),
+    pace=float(os.getenv("PROGRESS_PACE", "1")),
+    # Saves journaled by the workers don't wake the coordinator's flusher
+    poll=float(os.getenv("PROGRESS_POLL", "2")) if WORKER_ROLE == "coordinator" else None,
+) if os.getenv("PROGRESS_QUEUE", "1") == "1" else None
+
+@app.post("/anilist/update-progress")
+async def update_progress(request: UpdateProgressRequest):
+    """Update anime watching progress on AniList"""
+    
+    # Determine status based on progress
+    status = "COMPLETED" if request.episode >= request.total_episodes else "CURRENT"
+    message = f"Updated progress: Episode {request.episode}/{request.total_episodes} - Status: {status}"
+
+    if progress_queue is not None:
+        try:
+            viewer = await get_viewer(request.access_token)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=502, detail=f"AniList request failed: {str(e)}")
+
+        await progress_queue.enqueue(viewer["id"], request.media_id, request.episode, status, request.access_token)
         return {
             "success": True,
-            "message": f"Updated progress: Episode {request.episode}/{request.total_episodes} - Status: {status}",
-            "data": result
+            "queued": True,
+            "message": message,
+            "data": {"userId": viewer["id"], "mediaId": request.media_id, "progress": request.episode, "status": status}
         }
-        
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=502, detail=f"AniList request failed: {str(e)}")
+
+    try:
+        result = await save_progress(request.access_token, request.media_id, request.episode, status)
+    except RetryLater as e:
+        raise HTTPException(status_code=502 if e.__cause__ is not None else 400, detail=str(e))
+    except Rejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # The cached list no longer matches what AniList has, the queue does this for its own saves
+    await mark_list_saved(result["userId"])
+
+    return {
+        "success": True,
+        "message": message,
+        "data": result
+    }
 
 @app.get("/anilist/oauth-url")
 def get_oauth_url():
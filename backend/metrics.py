@@ -0,0 +1,234 @@
+"""In-process metric primitives and the Prometheus text exposition.
+
+Metrics live in a Registry as labeled families of counters, gauges and
+histograms, updated on the hot path without locks (everything runs on the
+event loop). Values that components already keep in their `stats` dicts
+are read at scrape time by collectors instead of being counted twice.
+MetricsMiddleware times every request per route template.
+"""
+import bisect, time
+from typing import Any, Callable, Iterable, Optional
+
+# Seconds, tuned for upstream waits and round trips
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes, from a JSON response to a whole episode
+SIZE_BUCKETS = (1024, 16384, 262144, 1048576, 4194304, 16777216, 67108864, 268435456, 1073741824)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style"""
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative, running = {}, 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running += count
+            cumulative["+Inf" if bound == float("inf") else str(bound)] = running
+        return {"buckets": cumulative, "sum": round(self.sum, 6), "count": self.count}
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Gauge(Counter):
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class Timer:
+    """Context manager observing the seconds its block took"""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Family:
+    """A metric split by label values, one child per combination"""
+
+    def __init__(self, name: str, kind: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children: dict[tuple, Any] = {}
+
+    def labels(self, *values) -> Any:
+        child = self._children.get(values)
+        if child is None:
+            if self.kind == "histogram":
+                child = Histogram(self.buckets)
+            else:
+                child = Gauge() if self.kind == "gauge" else Counter()
+            self._children[values] = child
+        return child
+
+    def time(self, *values) -> Timer:
+        return Timer(self.labels(*values))
+
+    def samples(self) -> list[tuple[dict, Any]]:
+        return [(dict(zip(self.labelnames, values)), child) for values, child in self._children.items()]
+
+
+# (name, kind, help, [(labels, number or Histogram)]) produced by a collector at scrape time
+Collected = tuple[str, str, str, list[tuple[dict, Any]]]
+
+
+class Registry:
+    def __init__(self, prefix: str = "yoru_"):
+        self.prefix = prefix
+        self._families: list[Family] = []
+        self._collectors: list[Callable[[], Iterable[Collected]]] = []
+
+    def _add(self, family: Family) -> Family:
+        self._families.append(family)
+        return family
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Family:
+        return self._add(Family(self.prefix + name, "counter", help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple = ()) -> Family:
+        return self._add(Family(self.prefix + name, "gauge", help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Family:
+        return self._add(Family(self.prefix + name, "histogram", help, labelnames, buckets))
+
+    def register(self, collector: Callable[[], Iterable[Collected]]):
+        """Add a callable whose metrics are read when /metrics is scraped; names get the prefix"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for family in self._families:
+            _render(lines, family.name, family.kind, family.help, family.samples())
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                _render(lines, self.prefix + name, kind, help, samples)
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict, extra: Optional[tuple] = None) -> str:
+    pairs = [*labels.items(), *([extra] if extra else [])]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _render(lines: list[str], name: str, kind: str, help: str, samples: list[tuple[dict, Any]]):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        if isinstance(value, Histogram):
+            running = 0
+            for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{name}_bucket{_labels(labels, ('le', le))} {running}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value.sum)}")
+            lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        else:
+            value = value.value if isinstance(value, Counter) else value
+            lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "Requests answered, by route and status", ("route", "method", "status"))
+http_duration = registry.histogram(
+    "http_request_duration_seconds", "Time until the last byte of the response was sent", ("route", "method")
+)
+http_response_start = registry.histogram(
+    "http_response_start_seconds", "Time until the response status and headers were sent", ("route", "method")
+)
+http_response_bytes = registry.histogram(
+    "http_response_bytes", "Body bytes sent per request", ("route",), SIZE_BUCKETS
+)
+http_in_flight = registry.gauge("http_requests_in_flight", "Requests being answered, streams included")
+errors = registry.counter("errors_total", "Exceptions by where they surfaced and their type", ("where", "type"))
+stages = registry.histogram("stage_seconds", "Time spent in named steps of request handling", ("stage",))
+
+
+def count_error(where: str, error: BaseException):
+    errors.labels(where, type(error).__name__).inc()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and body bytes per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        method = scope["method"]
+        status = 500
+        sent = 0
+        route: Optional[str] = None
+
+        def route_name() -> str:
+            # The router stores the matched route in the scope, unmatched paths share one label
+            nonlocal route
+            if route is None:
+                matched = scope.get("route")
+                route = getattr(matched, "path", None) or "unmatched"
+            return route
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                http_response_start.labels(route_name(), method).observe(time.perf_counter() - started)
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        in_flight = http_in_flight.labels()
+        in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            count_error("request", e)
+            raise
+        finally:
+            in_flight.dec()
+            name = route_name()
+            http_requests.labels(name, method, str(status)).inc()
+            http_duration.labels(name, method).observe(time.perf_counter() - started)
+            http_response_bytes.labels(name).observe(sent)
@@ -0,0 +1,51 @@
+"""Opt-in sampling profiler for the event loop thread.
+
+A background thread wakes every `interval` seconds, grabs the loop
+thread's current Python stack and counts it. The result is in the
+collapsed-stack format flame graph tools read (one "frame;frame;frame
+count" line per distinct stack), so hot paths on the loop show up
+without instrumenting them. Nothing runs between profiles; main.py only
+exposes it (GET /debug/profile) when PROFILER=1.
+"""
+import asyncio, sys, threading
+from collections import Counter
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005, max_seconds: float = 60.0):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = asyncio.Lock()
+
+    async def profile(self, seconds: float) -> str:
+        """Sample the calling thread (the event loop) for `seconds`, one profile at a time"""
+        seconds = min(seconds, self.max_seconds)
+        async with self._lock:
+            stacks: Counter = Counter()
+            done = threading.Event()
+            thread = threading.Thread(
+                target=self._sample, args=(threading.get_ident(), stacks, done), name="stack-sampler", daemon=True
+            )
+            thread.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                done.set()
+                await asyncio.to_thread(thread.join)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def _sample(self, target: int, stacks: Counter, done: threading.Event):
+        while not done.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                stacks[collapse(frame)] += 1
+
+
+def collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
@@ -0,0 +1,235 @@
+"""Write-behind queue for AniList progress updates.
+
+Progress saves are journaled in SQLite and acknowledged straight away. The
+journal holds one row per (user, media): a newer save for the same show
+replaces the pending one, so skipping through five episodes costs a single
+mutation. A row is flushed once it has been quiet for `settle` seconds (or
+has waited `max_wait`). Flushes are paced `pace` seconds apart and
+retried with backoff, and the whole queue pauses when AniList says it is
+rate limited.
+
+The journal keeps the access token of each pending save so writes survive
+a restart; the file is created readable by its owner only. Several
+processes may journal into the same file while only one runs the flusher;
+give that one a `poll` interval so it notices saves it wasn't woken for.
+Another process holding the write lock is waited for, so every query runs
+in a worker thread rather than on the event loop.
+"""
+import asyncio, os, sqlite3, threading, time
+from typing import Awaitable, Callable, Optional
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pending (
+        user_id INTEGER NOT NULL,
+        media_id INTEGER NOT NULL,
+        progress INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        access_token TEXT NOT NULL,
+        first_queued REAL NOT NULL,
+        updated REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, media_id)
+    );
+"""
+
+
+class RetryLater(Exception):
+    """The save failed but may succeed later, after retry_after seconds if AniList said so"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Rejected(Exception):
+    """AniList refused the save for good, e.g. the token was revoked"""
+
+
+class ProgressQueue:
+    def __init__(
+        self,
+        path: str,
+        save: Callable[[str, int, int, str], Awaitable[None]],
+        on_saved: Optional[Callable[[int], Awaitable[None]]] = None,
+        settle: float = 5.0,
+        max_wait: float = 60.0,
+        pace: float = 1.0,
+        max_attempts: int = 8,
+        poll: Optional[float] = None,
+    ):
+        self.path = path
+        # (access_token, media_id, progress, status), raises RetryLater or Rejected
+        self.save = save
+        self.on_saved = on_saved
+        self.settle = settle
+        self.max_wait = max_wait
+        self.pace = pace
+        self.max_attempts = max_attempts
+        self.poll = poll
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+        # One connection, used from whichever thread runs the query
+        self._lock = threading.Lock()
+        # Rows in the journal when last counted, see count()
+        self.pending = 0
+        self._wake = asyncio.Event()
+        self._paused_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"queued": 0, "coalesced": 0, "saved": 0, "retried": 0, "rejected": 0, "gave_up": 0, "rate_limited": 0}
+
+    def __len__(self) -> int:
+        # Blocking, for callers already off the event loop such as /stats
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    async def count(self) -> int:
+        self.pending = await asyncio.to_thread(len, self)
+        return self.pending
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def enqueue(self, user_id: int, media_id: int, progress: int, status: str, access_token: str):
+        """Journal a save, replacing any pending one for the same show"""
+        replaced = await asyncio.to_thread(self._journal, user_id, media_id, progress, status, access_token)
+        self.stats["coalesced" if replaced else "queued"] += 1
+        self._wake.set()
+
+    def _journal(self, user_id: int, media_id: int, progress: int, status: str, access_token: str) -> bool:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                replaced = self._db.execute(
+                    "SELECT 1 FROM pending WHERE user_id = ? AND media_id = ?", (user_id, media_id)
+                ).fetchone()
+                self._db.execute(
+                    """
+                    INSERT INTO pending (user_id, media_id, progress, status, access_token, first_queued, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, media_id) DO UPDATE SET
+                        progress = excluded.progress, status = excluded.status,
+                        access_token = excluded.access_token, updated = excluded.updated,
+                        attempts = 0, next_attempt = 0
+                    """,
+                    (user_id, media_id, progress, status, access_token, now, now),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return replaced is not None
+
+    async def pending_for(self, user_id: int) -> dict[int, dict]:
+        """Unsaved progress of a user by media id, for overlaying on what AniList returns"""
+        rows = await asyncio.to_thread(
+            self._query, "SELECT media_id, progress, status, updated FROM pending WHERE user_id = ?", (user_id,)
+        )
+        return {
+            media_id: {"progress": progress, "status": status, "updatedAt": int(updated)}
+            for media_id, progress, status, updated in rows
+        }
+
+    def _query(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    async def _next_due(self, now: float) -> Optional[tuple]:
+        rows = await asyncio.to_thread(
+            self._query,
+            """
+            SELECT user_id, media_id, progress, status, access_token, updated, attempts FROM pending
+            WHERE next_attempt <= ? AND (updated <= ? OR first_queued <= ?)
+            ORDER BY first_queued LIMIT 1
+            """,
+            (now, now - self.settle, now - self.max_wait),
+        )
+        return rows[0] if rows else None
+
+    async def _seconds_until_due(self, now: float) -> Optional[float]:
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT MIN(MAX(next_attempt, MIN(updated + ?, first_queued + ?))) FROM pending",
+            (self.settle, self.max_wait),
+        )
+        due = rows[0][0]
+        return None if due is None else max(0.0, due - now)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            row = await self._next_due(now)
+            if row is None:
+                self._wake.clear()
+                timeout = await self._seconds_until_due(now)
+                if self.poll is not None:
+                    timeout = self.poll if timeout is None else min(timeout, self.poll)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._flush(*row)
+            await asyncio.sleep(self.pace)
+
+    async def _flush(self, user_id: int, media_id: int, progress: int, status: str, access_token: str,
+                     updated: float, attempts: int):
+        try:
+            await self.save(access_token, media_id, progress, status)
+        except Rejected:
+            self.stats["rejected"] += 1
+            await self._remove(user_id, media_id, updated)
+            return
+        except Exception as error:
+            retry_after = error.retry_after if isinstance(error, RetryLater) else None
+            if retry_after is not None:
+                # The limit is per client, so every pending save has to wait
+                self.stats["rate_limited"] += 1
+                self._paused_until = time.time() + retry_after
+            if attempts + 1 >= self.max_attempts:
+                self.stats["gave_up"] += 1
+                await self._remove(user_id, media_id, updated)
+                return
+            self.stats["retried"] += 1
+            backoff = retry_after if retry_after is not None else min(300.0, 2.0 ** attempts)
+            await asyncio.to_thread(
+                self._query,
+                "UPDATE pending SET attempts = ?, next_attempt = ? WHERE user_id = ? AND media_id = ? AND updated = ?",
+                (attempts + 1, time.time() + backoff, user_id, media_id, updated),
+            )
+            return
+
+        self.stats["saved"] += 1
+        await self._remove(user_id, media_id, updated)
+        if self.on_saved is not None:
+            await self.on_saved(user_id)
+
+    async def _remove(self, user_id: int, media_id: int, updated: float):
+        # A newer save that arrived while this one was in flight stays queued
+        await asyncio.to_thread(
+            self._query,
+            "DELETE FROM pending WHERE user_id = ? AND media_id = ? AND updated = ?", (user_id, media_id, updated)
+        )
+
+    def close(self):
+        self._db.close()
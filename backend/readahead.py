@@ -0,0 +1,147 @@
+"""Background read-ahead of the next proxy blocks for each viewer.
+
+After a viewer asks for blocks first..last, blocks last+1..last+k are fetched
+in the background into a small per-stream buffer so the next range request
+can be answered without waiting on the upstream. k follows the viewer's
+consumption rate relative to the upstream's throughput.
+"""
+import asyncio, math, time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, Optional
+
+# Weight of the newest sample in the rate averages
+EWMA_ALPHA = 0.3
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # Blocks that fail or get dropped before anyone takes them are not errors
+    if not task.cancelled():
+        task.exception()
+
+
+def ewma(previous: Optional[float], sample: float) -> float:
+    return sample if previous is None else previous + EWMA_ALPHA * (sample - previous)
+
+
+class StreamState:
+    def __init__(self):
+        self.blocks: dict[int, asyncio.Task] = {}
+        self.next_index: Optional[int] = None
+        self.last_request: Optional[float] = None
+        self.last_span = 1  # blocks covered by the previous request
+        self.consumption_rate: Optional[float] = None  # bytes/s the viewer asks for
+        self.upstream_rate: Optional[float] = None  # bytes/s a block fetch delivers
+
+    def cancel(self, indexes=None):
+        for index in list(self.blocks if indexes is None else indexes):
+            task = self.blocks.pop(index, None)
+            if task is not None:
+                task.cancel()
+
+
+class ReadAhead:
+    def __init__(self, block_size: int, max_depth: int = 4, max_streams: int = 32, idle_timeout: float = 30.0):
+        self.block_size = block_size
+        self.max_depth = max_depth
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self._streams: OrderedDict[Hashable, StreamState] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "prefetched": 0, "seeks": 0, "cancelled": 0}
+
+    @property
+    def buffered_blocks(self) -> int:
+        return sum(len(state.blocks) for state in self._streams.values())
+
+    def advance(
+        self,
+        stream: Hashable,
+        first_index: int,
+        last_index: int,
+        max_index: int,
+        fetch: Callable[[int], Awaitable[bytes]],
+        cached: Callable[[int], bool] = lambda index: False,
+    ):
+        """
+        Record that a viewer asked for blocks first..last and start
+        prefetching the blocks after it, up to max_index. Blocks that
+        cached() reports as already available elsewhere are skipped.
+        """
+        self._expire_idle()
+        now = time.monotonic()
+        state = self._streams.get(stream)
+        if state is None:
+            state = self._streams[stream] = StreamState()
+            while len(self._streams) > self.max_streams:
+                _, evicted = self._streams.popitem(last=False)
+                evicted.cancel()
+        self._streams.move_to_end(stream)
+
+        if state.next_index is not None and first_index != state.next_index and first_index not in state.blocks:
+            # The viewer jumped elsewhere, nothing buffered is useful anymore
+            self.stats["seeks"] += 1
+            self.stats["cancelled"] += len(state.blocks)
+            state.cancel()
+            state.consumption_rate = None
+        elif state.last_request is not None and state.next_index is not None:
+            elapsed = max(now - state.last_request, 1e-3)
+            state.consumption_rate = ewma(state.consumption_rate, state.last_span * self.block_size / elapsed)
+
+        # Blocks behind the viewer will never be asked for again
+        state.cancel([index for index in state.blocks if index < first_index])
+        state.last_request = now
+        state.last_span = last_index - first_index + 1
+        state.next_index = last_index + 1
+
+        wanted = range(last_index + 1, min(last_index + self._depth(state), max_index) + 1)
+        for index in wanted:
+            if index not in state.blocks and not cached(index):
+                task = asyncio.create_task(self._fetch(state, fetch, index))
+                task.add_done_callback(_retrieve_exception)
+                state.blocks[index] = task
+                self.stats["prefetched"] += 1
+
+        # Keep the per-stream buffer bounded
+        beyond = [index for index in state.blocks if index > last_index + self.max_depth]
+        self.stats["cancelled"] += len(beyond)
+        state.cancel(beyond)
+
+    async def take(self, stream: Hashable, index: int) -> Optional[bytes]:
+        """The prefetched block, waiting for it if it is still in flight"""
+        state = self._streams.get(stream)
+        task = state.blocks.pop(index, None) if state is not None else None
+        if task is None:
+            self.stats["misses"] += 1
+            return None
+        try:
+            data = await task
+        except Exception:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return data
+
+    def abandon(self, stream: Hashable):
+        """The viewer went away mid-response, stop fetching for it"""
+        state = self._streams.pop(stream, None)
+        if state is not None:
+            self.stats["cancelled"] += len(state.blocks)
+            state.cancel()
+
+    def _depth(self, state: StreamState) -> int:
+        if state.consumption_rate is None or state.upstream_rate is None:
+            return min(2, self.max_depth)
+        # Enough blocks in flight to cover one upstream fetch at the viewer's pace
+        needed = math.ceil(state.consumption_rate / state.upstream_rate) + 1
+        return max(1, min(self.max_depth, needed))
+
+    async def _fetch(self, state: StreamState, fetch: Callable[[int], Awaitable[bytes]], index: int) -> bytes:
+        started = time.monotonic()
+        data = await fetch(index)
+        state.upstream_rate = ewma(state.upstream_rate, len(data) / max(time.monotonic() - started, 1e-3))
+        return data
+
+    def _expire_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for stream, state in list(self._streams.items()):
+            if state.last_request is not None and state.last_request < deadline:
+                self.abandon(stream)
@@ -0,0 +1,324 @@
+"""Local full-text index of the AniList catalog for instant `/search`.
+
+Media is kept in SQLite: one row per title with every field `/search` can
+project (see projection.py), plus an FTS5 table over titles and synonyms
+that answers word-prefix queries ("frier" finds Frieren), ordered by
+popularity. When nothing matches, each query word that is not a known word
+is swapped for common indexed words within one deletion of it (catching
+typos and swapped letters) and the query is retried.
+
+SearchSync fills the index in the background. A full pass walks the catalog
+by popularity. After that, incremental passes walk it by most recently
+updated and stop at the previous watermark. Titles AniList returns for
+queries the index missed are added as they come.
+"""
+import asyncio, itertools, json, os, re, sqlite3, threading, time, unicodedata
+from typing import Awaitable, Callable, Optional
+from projection import FIELDS, Projection, parse_projection, project, selection
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+# Fields stored for every title: all a projection may ask for, so /search can
+# answer any of them from the index, plus what the sync itself needs
+MEDIA_FIELDS = selection(tuple(FIELDS.items())) + "\nsynonyms\nupdatedAt"
+# Bumped whenever MEDIA_FIELDS grows, so titles stored without the new fields get a full pass
+FIELDS_VERSION = 2
+
+# What /search returns when the client asks for no projection
+DEFAULT_RESULT = parse_projection("title,coverImage,bannerImage,episodes,status,description,seasonYear,nextAiringEpisode")
+
+SYNC_QUERY = f"""
+        query ($page: Int, $perPage: Int, $sort: [MediaSort]) {{
+            Page(page: $page, perPage: $perPage) {{
+                pageInfo {{
+                    hasNextPage
+                }}
+                media(type: ANIME, sort: $sort) {{
+{MEDIA_FIELDS}
+                }}
+            }}
+        }}
+"""
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS media (
+        id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        popularity INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS media_words USING fts5(
+        titles, synonyms, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS media_words_terms USING fts5vocab(media_words, 'row');
+    CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value REAL NOT NULL);
+"""
+
+
+def normalize(word: str) -> str:
+    """Lowercase without diacritics, as the unicode61 tokenizer stores words"""
+    decomposed = unicodedata.normalize("NFKD", word.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def deletes(word: str) -> set[str]:
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+class Vocabulary:
+    """
+    Indexed words with approximate document counts. Two words within one
+    deletion of each other share an entry in _deletes, which covers a
+    single inserted, dropped, substituted or swapped letter.
+    """
+
+    def __init__(self, min_length: int = 3):
+        self.min_length = min_length
+        self.counts: dict[str, int] = {}
+        self._deletes: dict[str, list[str]] = {}
+
+    def add(self, word: str, count: int = 1):
+        if word in self.counts:
+            self.counts[word] += count
+            return
+        self.counts[word] = count
+        if len(word) >= self.min_length:
+            for variant in deletes(word):
+                self._deletes.setdefault(variant, []).append(word)
+
+    def corrections(self, word: str, limit: int = 3) -> list[str]:
+        """The most common indexed words close to an unknown word"""
+        if word in self.counts or len(word) < self.min_length:
+            return []
+        candidates = set(self._deletes.get(word, ()))
+        for variant in deletes(word):
+            if variant in self.counts and len(variant) >= self.min_length:
+                candidates.add(variant)
+            candidates.update(self._deletes.get(variant, ()))
+        return sorted(candidates, key=lambda candidate: (-self.counts[candidate], candidate))[:limit]
+
+
+def media_names(media: dict) -> tuple[str, str]:
+    title = media.get("title") or {}
+    titles = " ".join(filter(None, (title.get("romaji"), title.get("english"))))
+    return titles, " ".join(media.get("synonyms") or [])
+
+
+def search_result(media: dict, projection: Optional[Projection] = None) -> dict:
+    """Stored media trimmed to a projection or the default result, airing countdown brought up to date"""
+    result = project(media, projection or DEFAULT_RESULT)
+    airing = result.get("nextAiringEpisode")
+    if airing and airing.get("airingAt"):
+        result["nextAiringEpisode"] = {**airing, "timeUntilAiring": airing["airingAt"] - int(time.time())}
+    return result
+
+
+class SearchIndex:
+    def __init__(self, path: str, limit: int = 50):
+        self.path = path
+        self.limit = limit
+        # Built from the index on the first misspelled query, then kept up to date by upsert
+        self._words: Optional[Vocabulary] = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Reads run inline on the event loop, writes in a worker thread on their own connection
+        self._reader = self._connect()
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        with self._write_lock:
+            self._writer.executescript(SCHEMA)
+        self.stats = {"queries": 0, "hits": 0, "fuzzy_hits": 0, "misses": 0, "upserted": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        return connection
+
+    def __len__(self) -> int:
+        return self._reader.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def search(self, query: str) -> list[dict]:
+        """
+        Stored media of the titles matching every word of query as a prefix,
+        else with misspelled words corrected; see search_result
+        """
+        self.stats["queries"] += 1
+        words = [normalize(word) for word in WORD.findall(query)]
+        if not words:
+            return []
+
+        results = self._prefix_search(words)
+        if results:
+            self.stats["hits"] += 1
+            return results
+
+        results = self._corrected_search(words)
+        self.stats["fuzzy_hits" if results else "misses"] += 1
+        return results
+
+    def _prefix_search(self, words: list[str]) -> list[dict]:
+        match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+        rows = self._reader.execute(
+            """
+            SELECT media.data FROM media_words JOIN media ON media.id = media_words.rowid
+            WHERE media_words MATCH ? ORDER BY media.popularity DESC LIMIT ?
+            """,
+            (match, self.limit),
+        ).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def _corrected_search(self, words: list[str], max_attempts: int = 8) -> list[dict]:
+        """Retry with close indexed words in place of unknown ones, the first combination that matches wins"""
+        vocabulary = self._vocabulary()
+        options = [[word] if word in vocabulary.counts else vocabulary.corrections(word) or [word] for word in words]
+        # The last word may be a correctly spelled prefix of something longer
+        if words[-1] not in options[-1]:
+            options[-1].insert(0, words[-1])
+
+        attempts = (list(attempt) for attempt in itertools.product(*options) if list(attempt) != words)
+        for attempt in itertools.islice(attempts, max_attempts):
+            results = self._prefix_search(attempt)
+            if results:
+                return results
+        return []
+
+    def _vocabulary(self) -> Vocabulary:
+        if self._words is None:
+            self._words = Vocabulary()
+            for term, documents in self._reader.execute("SELECT term, doc FROM media_words_terms"):
+                self._words.add(term, documents)
+        return self._words
+
+    async def upsert(self, media: list[dict]):
+        if media:
+            await asyncio.to_thread(self._upsert, media)
+            if self._words is not None:
+                for item in media:
+                    for word in WORD.findall(" ".join(media_names(item))):
+                        self._words.add(normalize(word))
+
+    def _upsert(self, media: list[dict]):
+        with self._write_lock:
+            writer = self._writer
+            writer.execute("BEGIN")
+            try:
+                for item in media:
+                    titles, synonyms = media_names(item)
+                    writer.execute(
+                        "INSERT OR REPLACE INTO media (id, data, popularity, updated_at) VALUES (?, ?, ?, ?)",
+                        (item["id"], json.dumps(item), item.get("popularity") or 0, item.get("updatedAt") or 0),
+                    )
+                    writer.execute("DELETE FROM media_words WHERE rowid = ?", (item["id"],))
+                    writer.execute(
+                        "INSERT INTO media_words (rowid, titles, synonyms) VALUES (?, ?, ?)", (item["id"], titles, synonyms)
+                    )
+                writer.execute("COMMIT")
+            except BaseException:
+                writer.execute("ROLLBACK")
+                raise
+        self.stats["upserted"] += len(media)
+
+    def get_state(self, key: str, default: float = 0.0) -> float:
+        row = self._reader.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    async def set_state(self, key: str, value: float):
+        def write():
+            with self._write_lock:
+                self._writer.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+        await asyncio.to_thread(write)
+
+    @property
+    def ready(self) -> bool:
+        """A full pass has completed, so a miss means AniList is worth asking"""
+        return self.get_state("full_sync_at") > 0
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class SearchSync:
+    """
+    Background job keeping a SearchIndex in step with AniList, one page at
+    a time with a pause in between to stay well inside the rate limit.
+    """
+
+    def __init__(
+        self,
+        index: SearchIndex,
+        fetch_page: Callable[[int, str], Awaitable[dict]],
+        interval: float = 600.0,
+        full_interval: float = 7 * 86400.0,
+        page_delay: float = 2.0,
+        max_pages: int = 400,
+    ):
+        self.index = index
+        # (page, sort) -> AniList Page with pageInfo and media
+        self.fetch_page = fetch_page
+        self.interval = interval
+        self.full_interval = full_interval
+        self.page_delay = page_delay
+        self.max_pages = max_pages
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"passes": 0, "pages": 0, "errors": 0}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                stale = time.time() - self.index.get_state("full_sync_at") > self.full_interval
+                if stale or self.index.get_state("fields_version") < FIELDS_VERSION:
+                    await self.full_pass()
+                else:
+                    await self.incremental_pass()
+                self.stats["passes"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # AniList down or rate limited, try again next interval
+                self.stats["errors"] += 1
+            await asyncio.sleep(self.interval)
+
+    async def full_pass(self):
+        started = time.time()
+        newest = 0
+        for page in range(1, self.max_pages + 1):
+            data = await self._page(page, "POPULARITY_DESC")
+            newest = max([newest] + [media.get("updatedAt") or 0 for media in data["media"]])
+            if not data["pageInfo"]["hasNextPage"]:
+                break
+            await asyncio.sleep(self.page_delay)
+        await self.index.set_state("watermark", max(newest, self.index.get_state("watermark")))
+        await self.index.set_state("full_sync_at", started)
+        await self.index.set_state("fields_version", FIELDS_VERSION)
+
+    async def incremental_pass(self):
+        watermark = self.index.get_state("watermark")
+        newest = watermark
+        for page in range(1, self.max_pages + 1):
+            data = await self._page(page, "UPDATED_AT_DESC")
+            updated = [media.get("updatedAt") or 0 for media in data["media"]]
+            newest = max([newest] + updated)
+            if not data["pageInfo"]["hasNextPage"] or min(updated, default=0) <= watermark:
+                break
+            await asyncio.sleep(self.page_delay)
+        await self.index.set_state("watermark", newest)
+
+    async def _page(self, page: int, sort: str) -> dict:
+        data = await self.fetch_page(page, sort)
+        await self.index.upsert(data["media"])
+        self.stats["pages"] += 1
+        return data
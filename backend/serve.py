@@ -0,0 +1,119 @@
+"""Run the backend as several processes sharing one port and their caches.
+
+    python serve.py --port 8080             # one process per core
+    python serve.py --port 8080 --workers 4
+
+Each process binds its own listening socket with SO_REUSEPORT, so the
+kernel spreads new connections across them and no process accepts for
+another. Process 0 is the coordinator: it serves requests like the rest,
+and it is the only one running the background jobs that call upstream on
+their own (search sync, catalog refresh, cache warming, flushing progress
+saves). The others build their catalog snapshots from what the
+coordinator's refresh leaves in the shared cache.
+
+Shared through files in --state-dir, unless already configured:
+
+    CACHE_SQLITE_PATH    AniList responses and next-airing lookups (cache.py)
+    ANILIST_BUDGET_PATH  the AniList rate-limit bucket (governor.py)
+
+The search index, progress journal, video chunks and images were files
+already and are shared as they are. Connection pools, resolved sources and
+the small per-user TTL caches stay per process.
+
+A process that dies is started again; SIGINT or SIGTERM stops them all.
+"""
+import argparse, multiprocessing, os, signal, socket, sys, tempfile, time
+from multiprocessing.connection import wait
+
+
+def bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(role: str, host: str, port: int, env: dict, log_level: str):
+    # Before main is imported, it reads its settings at import time
+    os.environ.update(env)
+    os.environ["WORKER_ROLE"] = role
+    import uvicorn
+
+    config = uvicorn.Config("main:app", log_level=log_level, timeout_graceful_shutdown=10)
+    uvicorn.Server(config).run(sockets=[bind(host, port)])
+
+
+def shared_env(state_dir: str) -> dict:
+    env = {
+        "CACHE_SQLITE_PATH": os.path.join(state_dir, "cache.db"),
+        "ANILIST_BUDGET_PATH": os.path.join(state_dir, "budget.db"),
+        # Every process would otherwise size its image pool for the whole machine
+        "IMG_WORKERS": "1",
+    }
+    return {key: os.environ.get(key, value) for key, value in env.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--state-dir", default=os.path.join(tempfile.gettempdir(), "yoru-shared"))
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("serve.py needs SO_REUSEPORT (Linux, macOS or a BSD), run uvicorn main:app instead")
+    # Fail here rather than in every worker when the port is taken
+    bind(args.host, args.port).close()
+    os.makedirs(args.state_dir, exist_ok=True)
+    env = shared_env(args.state_dir)
+
+    # Spawned rather than forked, so every worker imports main afresh with the shared settings
+    context = multiprocessing.get_context("spawn")
+    roles = ["coordinator"] + ["worker"] * (max(1, args.workers) - 1)
+    processes: dict[int, multiprocessing.Process] = {}
+    started_at: dict[int, float] = {}
+    stopping = False
+
+    def start(slot: int):
+        process = context.Process(
+            target=run_worker, args=(roles[slot], args.host, args.port, env, args.log_level), name=f"yoru-{slot}"
+        )
+        process.start()
+        processes[slot] = process
+        started_at[slot] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for slot in range(len(roles)):
+        start(slot)
+    print(f"Serving on {args.host}:{args.port} with {len(roles)} processes, state in {args.state_dir}", flush=True)
+
+    while not stopping:
+        wait([process.sentinel for process in processes.values()], timeout=1.0)
+        for slot, process in list(processes.items()):
+            if stopping or process.is_alive():
+                continue
+            print(f"{roles[slot]} {process.pid} exited with {process.exitcode}, restarting", flush=True)
+            # Don't spin on a process that dies while starting up
+            time.sleep(max(0.0, 1.0 - (time.monotonic() - started_at[slot])))
+            start(slot)
+
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + 15
+    for process in processes.values():
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Coalesce concurrent identical upstream calls into one in-flight request."""
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    Callers asking for the same key while a call is in flight share its
+    result instead of issuing their own upstream request.
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["calls"] += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+
+        # A caller that disconnects must not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def _finish(self, key: Hashable, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved when every waiter has gone away
+            future.exception()
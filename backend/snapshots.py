@@ -0,0 +1,189 @@
+"""Prebuilt, precompressed response bodies for endpoints everyone gets alike.
+
+The catalog lists (/trending, /popular, /latest) return the same JSON to
+every user. A SnapshotStore keeps their first pages materialized: a
+background refresher fetches each page, serializes it once (with orjson
+when installed) and compresses it ahead of time with gzip and, when the
+brotli package is installed, brotli. Handlers pick the encoding the client
+accepts and send those bytes as they are, and a matching If-None-Match is
+answered with an empty 304. A refresh that produces the same body keeps the
+existing snapshot, so ETags stay stable until the data actually changes.
+"""
+import asyncio, gzip, hashlib, json, time
+from typing import Awaitable, Callable, Optional
+from fastapi.requests import Request
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Preferred first when the client accepts several
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def dumps(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    # Same output as JSONResponse
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def accepted_encodings(header: str) -> set[str]:
+    """Content codings named in an Accept-Encoding header, minus those refused with q=0"""
+    accepted = set()
+    for part in header.lower().split(","):
+        name, _, params = part.partition(";")
+        name = name.strip()
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+class Snapshot:
+    """One serialized body with its compressed variants and strong ETags"""
+
+    def __init__(self, payload):
+        self.body = dumps(payload)
+        self.digest = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self.built_at = time.time()
+        self.variants: dict[str, bytes] = {"identity": self.body, "gzip": gzip.compress(self.body, 9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(self.body, quality=11)
+
+    def etag(self, encoding: str) -> str:
+        # Each representation gets its own strong ETag, they share the digest
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip().removeprefix("W/").strip('"')
+            if tag.split("-", 1)[0] == self.digest:
+                return True
+        return False
+
+    def choose(self, accept_encoding: str) -> str:
+        accepted = accepted_encodings(accept_encoding)
+        return next((encoding for encoding in ENCODINGS if encoding in accepted), "identity")
+
+
+class SnapshotStore:
+    """
+    Snapshots of the first `pages` pages of each endpoint in each of
+    `views` (None being the full payload), rebuilt every `interval`
+    seconds. `fetch(endpoint, page, per_page, view)` returns the payload;
+    one containing "error" keeps the previous snapshot.
+    """
+
+    def __init__(
+        self,
+        endpoints: tuple[str, ...],
+        fetch: Callable[[str, int, int, Optional[str]], Awaitable[dict]],
+        views: tuple[Optional[str], ...] = (None,),
+        pages: int = 3,
+        per_page: int = 20,
+        interval: float = 60.0,
+        cache_control: str = "public, no-cache",
+    ):
+        self.endpoints = endpoints
+        self.fetch = fetch
+        self.views = views
+        self.pages = pages
+        self.per_page = per_page
+        self.interval = interval
+        self.cache_control = cache_control
+        self._snapshots: dict[tuple[str, Optional[str], int], Snapshot] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"hits": 0, "not_modified": 0, "misses": 0, "builds": 0, "unchanged": 0, "errors": 0}
+        self.bytes_sent = {encoding: 0 for encoding in ("identity", *ENCODINGS)}
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        for endpoint in self.endpoints:
+            for view in self.views:
+                for page in range(1, self.pages + 1):
+                    try:
+                        await self._build(endpoint, view, page)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        # Upstream trouble, keep serving the last good snapshot
+                        self.stats["errors"] += 1
+
+    async def _build(self, endpoint: str, view: Optional[str], page: int):
+        payload = await self.fetch(endpoint, page, self.per_page, view)
+        if "error" in payload:
+            self.stats["errors"] += 1
+            return
+        current = self._snapshots.get((endpoint, view, page))
+        if current is not None and current.body == dumps(payload):
+            self.stats["unchanged"] += 1
+            return
+        # Brotli at its best quality takes a while on a big page, keep it off the loop
+        self._snapshots[(endpoint, view, page)] = await asyncio.to_thread(Snapshot, payload)
+        self.stats["builds"] += 1
+
+    def respond(self, request: Request, endpoint: str, page: int, per_page: int,
+                view: Optional[str] = None) -> Optional[Response]:
+        """The prebuilt response for this page, or None when there is no snapshot of it"""
+        snapshot = self._snapshots.get((endpoint, view, page)) if per_page == self.per_page else None
+        if snapshot is None:
+            self.stats["misses"] += 1
+            return None
+
+        encoding = snapshot.choose(request.headers.get("accept-encoding", ""))
+        headers = {"ETag": snapshot.etag(encoding), "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if snapshot.matches(request.headers.get("if-none-match", "")):
+            self.stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+
+        self.stats["hits"] += 1
+        body = snapshot.variants[encoding]
+        self.bytes_sent[encoding] += len(body)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "entries": len(self._snapshots),
+            "encodings": list(ENCODINGS),
+            "bytes_sent": dict(self.bytes_sent),
+        }
@@ -0,0 +1,476 @@
+"""Episode source resolution: resolver fan-out, caching and next-episode pre-resolution.
+
+Sources come from a registry of resolvers, the ani-cli service plus any
+listed in SOURCE_RESOLVERS, either inline JSON or a path to a JSON file:
+
+    [{"name": "mirror", "url": "http://10.0.0.5:8000/api/ani-cli/v2/stream", "deadline": 10},
+     {"name": "local", "callable": "my_resolvers:resolve"}]
+
+HTTP resolvers take the same request as ani-cli and answer {"sources": [...]};
+a callable is `async (anilist_id, title, episode, dub) -> list[dict]`.
+
+Every resolver is asked at once, each with its own deadline and circuit
+breaker. Each source that comes back gets a cheap reachability probe and
+is handed to readers the moment it passes, so playback can start on the
+first playable source while slower resolvers are still working. The
+complete list, ranked by each resolver's success rate and latency, is
+cached per (anilist_id, episode, dub) until its first signed URL expires.
+Whenever an episode resolves, the next one is resolved in the background.
+"""
+import abc, asyncio, calendar, importlib, json, time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from urllib.parse import parse_qsl, urlsplit
+import httpx
+from cache import TTLCache
+from metrics import Histogram
+
+# Query parameters CDNs put absolute unix expiry times in
+EXPIRY_PARAMS = ("expires", "expire", "expiry", "exp", "e", "validto", "deadline")
+
+
+class CircuitOpen(Exception):
+    """The resolver failed too often recently and is not being called"""
+
+
+class ResolverError(Exception):
+    """The resolver answered without usable sources"""
+
+
+class SourcesNotFound(ResolverError):
+    """The resolver is healthy but has nothing for this episode"""
+
+
+class CircuitBreaker:
+    """
+    Closed until `threshold` consecutive failures, then open for
+    `reset_after` seconds. After that one trial call is let through
+    (half-open): success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+        self._trial = False
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """Unix time a signed URL stops working, if it says so"""
+    params = {key.lower(): value for key, value in parse_qsl(urlsplit(url).query)}
+    for name in EXPIRY_PARAMS:
+        value = params.get(name, "")
+        if value.isdigit() and int(value) > 1_000_000_000:
+            # Some CDNs sign in milliseconds
+            return int(value) / 1000 if int(value) > 100_000_000_000 else float(value)
+    # AWS-style signatures: issue time plus a lifetime in seconds
+    if params.get("x-amz-expires", "").isdigit() and "x-amz-date" in params:
+        try:
+            issued = calendar.timegm(time.strptime(params["x-amz-date"], "%Y%m%dT%H%M%SZ"))
+        except ValueError:
+            return None
+        return issued + int(params["x-amz-expires"])
+    return None
+
+
+def sources_ttl(sources: list[dict], default: float, margin: float) -> float:
+    """How long a resolved source list can be served: until its first URL expires, with a margin"""
+    expiries = [expiry for expiry in (url_expiry(source.get("url") or "") for source in sources) if expiry is not None]
+    if not expiries:
+        return default
+    return min(default, min(expiries) - margin - time.time())
+
+
+class SourceResolver(abc.ABC):
+    """One place sources come from, with its own deadline, circuit breaker and track record"""
+
+    def __init__(self, name: str, deadline: float = 20.0, breaker: Optional[CircuitBreaker] = None,
+                 smoothing: float = 0.2):
+        self.name = name
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        # Weight of the latest call in the moving averages below
+        self.smoothing = smoothing
+        self.success_rate = 1.0
+        # Share of answers with sources that had at least one passing the reachability probe
+        self.playable_rate = 1.0
+        self.typical_latency: Optional[float] = None
+        self.latency = Histogram()
+        self.stats = {"calls": 0, "failures": 0, "timeouts": 0, "rejected": 0}
+
+    @property
+    def score(self) -> float:
+        """Ranking among resolvers: likely to answer with something playable, and quickly"""
+        # Untried resolvers count as taking half their deadline
+        latency = self.typical_latency if self.typical_latency is not None else self.deadline / 2
+        return self.success_rate * self.playable_rate / (latency + 0.1)
+
+    @abc.abstractmethod
+    async def _fetch(self, client: httpx.AsyncClient, anilist_id: int, title: str, episode: int,
+                     dub: bool) -> list[dict]:
+        """The raw source list from this resolver, before any probing"""
+
+    async def resolve(self, client: httpx.AsyncClient, anilist_id: int, title: str, episode: int,
+                      dub: bool) -> list[dict]:
+        """Sources tagged with this resolver's name, raising CircuitOpen, SourcesNotFound or ResolverError"""
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise CircuitOpen(f"Source resolver {self.name} is unavailable, try again shortly")
+
+        self.stats["calls"] += 1
+        started = time.monotonic()
+        try:
+            sources = await asyncio.wait_for(self._fetch(client, anilist_id, title, episode, dub), self.deadline)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            self._record(False, started)
+            raise ResolverError(f"Source resolver {self.name} timed out")
+        except SourcesNotFound:
+            # An answer all the same, it mustn't trip the breaker
+            self._record(True, started)
+            raise
+        except Exception as e:
+            self._record(False, started)
+            if isinstance(e, ResolverError):
+                raise
+            raise ResolverError(f"Source resolver {self.name} failed: {e}") from e
+
+        self._record(True, started)
+        return [{**source, "resolver": self.name} for source in sources if source.get("url")]
+
+    def _record(self, ok: bool, started: float):
+        elapsed = time.monotonic() - started
+        self.latency.observe(elapsed)
+        self.success_rate += self.smoothing * (ok - self.success_rate)
+        if self.typical_latency is None:
+            self.typical_latency = elapsed
+        else:
+            self.typical_latency += self.smoothing * (elapsed - self.typical_latency)
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+
+    def record_playable(self, playable: bool):
+        self.playable_rate += self.smoothing * (playable - self.playable_rate)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "success_rate": round(self.success_rate, 3),
+            "playable_rate": round(self.playable_rate, 3),
+            "typical_latency": round(self.typical_latency, 3) if self.typical_latency is not None else None,
+            "score": round(self.score, 3),
+            "latency": self.latency.snapshot(),
+        }
+
+
+class HttpResolver(SourceResolver):
+    """A service speaking the ani-cli v2 stream API"""
+
+    def __init__(self, name: str, url: str, **options):
+        super().__init__(name, **options)
+        self.url = url
+
+    async def _fetch(self, client: httpx.AsyncClient, anilist_id: int, title: str, episode: int,
+                     dub: bool) -> list[dict]:
+        response = await client.post(self.url, json={"anilist_id": anilist_id, "title": title, "episode": episode, "dub": dub})
+        if response.status_code >= 500:
+            raise ResolverError("Sources not found")
+        if response.status_code != 200:
+            raise SourcesNotFound("Sources not found")
+        try:
+            return response.json().get("sources") or []
+        except ValueError as e:
+            raise ResolverError("Source resolver returned invalid JSON") from e
+
+
+class LocalResolver(SourceResolver):
+    """An in-process coroutine function"""
+
+    def __init__(self, name: str, function: Callable[[int, str, int, bool], Awaitable[list[dict]]], **options):
+        super().__init__(name, **options)
+        self.function = function
+
+    async def _fetch(self, client: httpx.AsyncClient, anilist_id: int, title: str, episode: int,
+                     dub: bool) -> list[dict]:
+        return await self.function(anilist_id, title, episode, dub)
+
+
+def load_resolvers(raw: str) -> list[SourceResolver]:
+    """Resolvers listed in SOURCE_RESOLVERS, see the module docstring"""
+    if raw and not raw.lstrip().startswith("["):
+        with open(raw) as f:
+            raw = f.read()
+    resolvers = []
+    for entry in json.loads(raw) if raw else []:
+        options = {
+            "deadline": float(entry.get("deadline", 20.0)),
+            "breaker": CircuitBreaker(int(entry.get("breaker_threshold", 5)), float(entry.get("breaker_reset", 30.0))),
+        }
+        if "url" in entry:
+            resolvers.append(HttpResolver(entry["name"], entry["url"], **options))
+        elif "callable" in entry:
+            module, _, attribute = entry["callable"].partition(":")
+            resolvers.append(LocalResolver(entry["name"], getattr(importlib.import_module(module), attribute), **options))
+        else:
+            raise ValueError(f"Source resolver {entry.get('name')!r} needs a url or a callable")
+    return resolvers
+
+
+class Resolution:
+    """One fan-out across the resolvers, which any number of readers can follow"""
+
+    def __init__(self, prefetch_next: bool):
+        # False for background pre-resolutions, which don't chain further
+        self.prefetch_next = prefetch_next
+        # Playable sources in the order they were confirmed, unreachable ones appended at the end
+        self.sources: list[dict] = []
+        self.result: Optional[dict] = None
+        self.error: Optional[Exception] = None
+        self._changed = asyncio.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None or self.error is not None
+
+    async def publish(self, sources: list[dict] = (), result: Optional[dict] = None,
+                      error: Optional[Exception] = None):
+        async with self._changed:
+            self.sources.extend(sources)
+            self.result, self.error = result, error
+            self._changed.notify_all()
+
+    async def first(self):
+        """Wait for the first playable source or the end of the fan-out"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.sources or self.done)
+
+    async def follow(self) -> AsyncIterator[dict]:
+        sent = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: len(self.sources) > sent or self.done)
+                fresh = self.sources[sent:]
+                finished = self.done
+            for source in fresh:
+                yield source
+            sent += len(fresh)
+            if finished and sent >= len(self.sources):
+                return
+
+
+class SourceCache:
+    """
+    Resolved sources by (anilist_id, episode, dub), valid until their URLs
+    expire, with the following episode resolved ahead in the background.
+    """
+
+    def __init__(self, resolvers: list[SourceResolver], max_entries: int = 2000, ttl: float = 1800.0,
+                 expiry_margin: float = 120.0, empty_ttl: float = 60.0, max_prefetches: int = 4,
+                 probe_timeout: float = 3.0):
+        self.resolvers = resolvers
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        # Episodes the resolvers know nothing about yet, checked again after this long
+        self.empty_ttl = empty_ttl
+        self.max_prefetches = max_prefetches
+        # 0 hands sources out without checking they answer
+        self.probe_timeout = probe_timeout
+        # Set when the app starts, see lifespan in main.py
+        self.client: Optional[httpx.AsyncClient] = None
+        self._entries = TTLCache(max_entries, ttl)
+        self._resolving: dict[tuple, Resolution] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.time_to_first = Histogram()
+        self.stats = {
+            "resolutions": 0, "joined": 0, "probes": 0, "unreachable": 0,
+            "prefetched": 0, "prefetch_skipped": 0, "prefetch_errors": 0, "uncacheable": 0,
+        }
+
+    async def get(self, anilist_id: int, title: str, episode: int, dub: bool, prefetch_next: bool = True) -> dict:
+        """
+        Sources for an episode as soon as one is playable, with "complete"
+        false while resolvers are still running. Raises ResolverError or
+        CircuitOpen when no resolver could give any.
+        """
+        cached = self._entries.get((anilist_id, episode, dub))
+        if cached is not None:
+            return cached
+        resolution = self._resolution((anilist_id, episode, dub), title, prefetch_next)
+        await resolution.first()
+        if resolution.error is not None:
+            raise resolution.error
+        return resolution.result or {"sources": list(resolution.sources), "complete": False}
+
+    async def stream(self, anilist_id: int, title: str, episode: int, dub: bool) -> AsyncIterator[dict]:
+        """Events for each source as it is confirmed, then {"done": ...} or {"error": ...}"""
+        cached = self._entries.get((anilist_id, episode, dub))
+        if cached is not None:
+            for source in cached["sources"]:
+                yield {"source": source}
+            yield {"done": True, "count": len(cached["sources"])}
+            return
+        resolution = self._resolution((anilist_id, episode, dub), title, prefetch_next=True)
+        async for source in resolution.follow():
+            yield {"source": source}
+        if resolution.error is not None:
+            yield {"error": str(resolution.error)}
+        else:
+            yield {"done": True, "count": len(resolution.result["sources"])}
+
+    def prefetch(self, anilist_id: int, title: str, episode: int, dub: bool):
+        """Resolve an episode in the background unless it is cached, in flight, or the resolvers are struggling"""
+        key = (anilist_id, episode, dub)
+        if key in self._entries or key in self._resolving:
+            return
+        prefetching = sum(not resolution.prefetch_next for resolution in self._resolving.values())
+        healthy = any(resolver.breaker.state == "closed" for resolver in self.resolvers)
+        if prefetching >= self.max_prefetches or not healthy:
+            self.stats["prefetch_skipped"] += 1
+            return
+        self._resolution(key, title, prefetch_next=False)
+
+    def _resolution(self, key: tuple, title: str, prefetch_next: bool) -> Resolution:
+        resolution = self._resolving.get(key)
+        if resolution is not None:
+            self.stats["joined"] += 1
+            return resolution
+        resolution = self._resolving[key] = Resolution(prefetch_next)
+        self.stats["resolutions"] += 1
+        # Readers that go away must not cancel the fan-out for everyone else
+        task = asyncio.create_task(self._fan_out(key, title, resolution))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return resolution
+
+    async def _fan_out(self, key: tuple, title: str, resolution: Resolution):
+        anilist_id, episode, dub = key
+        started = time.monotonic()
+        ranked = sorted(self.resolvers, key=lambda resolver: resolver.score, reverse=True)
+        seen: set[str] = set()
+        playable: list[dict] = []
+        unreachable: list[dict] = []
+        errors: list[Exception] = []
+        missing: list[SourcesNotFound] = []
+
+        async def check(source: dict) -> bool:
+            if not await self._probe(source):
+                unreachable.append({**source, "reachable": False})
+                return False
+            if not playable:
+                self.time_to_first.observe(time.monotonic() - started)
+            playable.append(source)
+            await resolution.publish([source])
+            return True
+
+        async def run(resolver: SourceResolver):
+            try:
+                sources = await resolver.resolve(self.client, anilist_id, title, episode, dub)
+            except SourcesNotFound as e:
+                missing.append(e)
+                return
+            except (ResolverError, CircuitOpen) as e:
+                errors.append(e)
+                return
+            fresh = [source for source in sources if source["url"] not in seen]
+            seen.update(source["url"] for source in fresh)
+            if fresh:
+                resolver.record_playable(any(await asyncio.gather(*(check(source) for source in fresh))))
+
+        try:
+            await asyncio.gather(*(run(resolver) for resolver in ranked))
+            if len(errors) == len(ranked):
+                # Only an open circuit everywhere reads as "try again later"
+                if all(isinstance(error, CircuitOpen) for error in errors):
+                    await resolution.publish(error=errors[0])
+                else:
+                    await resolution.publish(error=ResolverError("; ".join(str(error) for error in errors)))
+                return
+            if missing and len(missing) + len(errors) == len(ranked):
+                # Not cached, the episode may just not be up yet
+                await resolution.publish(error=missing[0])
+                return
+
+            rank = {resolver.name: position for position, resolver in enumerate(ranked)}
+            # Sorting is stable, so each resolver's sources keep the order it gave them in
+            sources = sorted(playable, key=lambda source: rank[source["resolver"]]) + unreachable
+            result = {"sources": sources, "complete": True}
+            ttl = sources_ttl(sources, self.ttl, self.expiry_margin) if sources else self.empty_ttl
+            if ttl > 0:
+                self._entries.set(key, result, ttl)
+            else:
+                self.stats["uncacheable"] += 1
+            if not resolution.prefetch_next:
+                self.stats["prefetched"] += 1
+            await resolution.publish(unreachable, result=result)
+        except Exception as e:
+            if not resolution.prefetch_next:
+                self.stats["prefetch_errors"] += 1
+            await resolution.publish(error=ResolverError(str(e)))
+            return
+        finally:
+            self._resolving.pop(key, None)
+
+        if resolution.prefetch_next and playable:
+            self.prefetch(anilist_id, title, episode + 1, dub)
+
+    async def _probe(self, source: dict) -> bool:
+        """Whether the source answers a one-byte ranged GET"""
+        if not self.probe_timeout:
+            return True
+        self.stats["probes"] += 1
+        headers = {"Range": "bytes=0-0"}
+        if source.get("referrer"):
+            headers["Referer"] = source["referrer"]
+        try:
+            request = self.client.build_request("GET", source["url"], headers=headers)
+            response = await asyncio.wait_for(self.client.send(request, stream=True), self.probe_timeout)
+            await response.aclose()
+            reachable = response.status_code < 400
+        except Exception:
+            reachable = False
+        if not reachable:
+            self.stats["unreachable"] += 1
+        return reachable
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            **{f"cache_{name}": count for name, count in self._entries.stats.items()},
+            "entries": len(self._entries),
+            "resolving": len(self._resolving),
+            "time_to_first": self.time_to_first.snapshot(),
+            "resolvers": {resolver.name: resolver.snapshot() for resolver in self.resolvers},
+        }
@@ -0,0 +1,82 @@
+"""Adaptive chunking for relaying upstream bodies to clients.
+
+Network reads arrive in whatever sizes the socket hands out, often a few KB.
+Relaying each one costs a trip through StreamingResponse and the ASGI send
+path, so reads are coalesced into chunks sized to the measured throughput:
+small while the upstream is slow (the first bytes go out quickly), growing
+towards max_chunk as it speeds up.
+
+Reads that are already chunk-sized are passed through untouched. Smaller
+ones are copied once, straight into a chunk-sized bytearray. Each chunk gets
+its own buffer: asyncio transports may keep a reference to a chunk they could
+not send immediately, so a buffer is never refilled once it has been yielded.
+"""
+import os, time
+from dataclasses import dataclass
+from typing import AsyncIterator, Union
+import httpx
+
+Chunk = Union[bytes, memoryview]
+
+
+@dataclass(frozen=True)
+class StreamTuning:
+    min_chunk: int = 64 * 1024
+    max_chunk: int = 1024 * 1024
+    # Aim for one chunk per this many seconds of upstream throughput
+    target_interval: float = 0.05
+
+
+def tuning_from_env() -> StreamTuning:
+    return StreamTuning(
+        min_chunk=int(os.getenv("STREAM_MIN_CHUNK", str(64 * 1024))),
+        max_chunk=int(os.getenv("STREAM_MAX_CHUNK", str(1024 * 1024))),
+        target_interval=float(os.getenv("STREAM_TARGET_INTERVAL", "0.05")),
+    )
+
+
+def next_chunk_size(tuning: StreamTuning, throughput: float) -> int:
+    """Power-of-two chunk size covering target_interval at the given bytes/s"""
+    wanted = max(tuning.min_chunk, min(tuning.max_chunk, int(throughput * tuning.target_interval)))
+    size = tuning.min_chunk
+    while size * 2 <= wanted:
+        size *= 2
+    return size
+
+
+async def iter_adaptive(response: httpx.Response, tuning: StreamTuning) -> AsyncIterator[Chunk]:
+    """Relay an upstream body in throughput-sized chunks"""
+    chunk_size = tuning.min_chunk
+    buffer, view, filled = None, None, 0
+    window_start, window_bytes = time.monotonic(), 0
+
+    encoded = response.headers.get("content-encoding", "identity") != "identity"
+    # Raw reads skip httpx's decoder and re-chunker unless the body really is encoded
+    pieces = response.aiter_bytes() if encoded else response.aiter_raw()
+
+    async for piece in pieces:
+        window_bytes += len(piece)
+
+        if filled == 0 and len(piece) >= chunk_size:
+            yield piece
+        else:
+            source, position = memoryview(piece), 0
+            while position < len(piece):
+                if buffer is None:
+                    buffer = bytearray(chunk_size)
+                    view = memoryview(buffer)
+                take = min(len(piece) - position, len(buffer) - filled)
+                view[filled:filled + take] = source[position:position + take]
+                filled += take
+                position += take
+                if filled == len(buffer):
+                    yield view
+                    buffer, view, filled = None, None, 0
+
+        elapsed = time.monotonic() - window_start
+        if elapsed >= tuning.target_interval * 4:
+            chunk_size = next_chunk_size(tuning, window_bytes / elapsed)
+            window_start, window_bytes = time.monotonic(), 0
+
+    if filled:
+        yield view[:filled]
@@ -0,0 +1,128 @@
+"""Admission control and disconnect handling for proxied upstream streams."""
+import asyncio, time
+import anyio
+from typing import AsyncIterator, Awaitable, Callable
+
+
+class StreamLimitExceeded(Exception):
+    """No stream slot became free in time"""
+
+
+class StreamSlot:
+    def __init__(self, limiter: "StreamLimiter", client: str):
+        self._limiter = limiter
+        self._client = client
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter._release(self._client)
+
+
+class StreamLimiter:
+    """
+    Caps concurrent upstream streams globally and per client. Callers over
+    the limit queue for up to queue_timeout seconds, beyond max_queue
+    waiters they are turned away immediately.
+    """
+
+    def __init__(self, max_streams: int, max_per_client: int, max_queue: int = 64, queue_timeout: float = 5.0):
+        self.max_streams = max_streams
+        self.max_per_client = max_per_client
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._global = asyncio.Semaphore(max_streams)
+        # client -> (semaphore, holders + waiters), dropped when unused
+        self._clients: dict[str, list] = {}
+        self.active = 0
+        self.waiting = 0
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "disconnected": 0}
+
+    @property
+    def clients(self) -> int:
+        return len(self._clients)
+
+    async def acquire(self, client: str) -> StreamSlot:
+        if self.waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise StreamLimitExceeded("Too many queued streams")
+
+        entry = self._clients.setdefault(client, [asyncio.Semaphore(self.max_per_client), 0])
+        entry[1] += 1
+        client_semaphore = entry[0]
+        if not client_semaphore.locked() and not self._global.locked():
+            # Both free: acquiring cannot suspend, so skip the queue bookkeeping
+            await self._acquire_both(client_semaphore)
+            return self._admit(client)
+
+        self.stats["queued"] += 1
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._acquire_both(client_semaphore), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._drop_client(client)
+            self.stats["rejected"] += 1
+            raise StreamLimitExceeded("No stream slot became free")
+        except BaseException:
+            self._drop_client(client)
+            raise
+        finally:
+            self.waiting -= 1
+        return self._admit(client)
+
+    def _admit(self, client: str) -> StreamSlot:
+        self.active += 1
+        self.stats["admitted"] += 1
+        return StreamSlot(self, client)
+
+    async def _acquire_both(self, client_semaphore: asyncio.Semaphore):
+        await client_semaphore.acquire()
+        try:
+            await self._global.acquire()
+        except BaseException:
+            client_semaphore.release()
+            raise
+
+    def _release(self, client: str):
+        self.active -= 1
+        self._global.release()
+        self._clients[client][0].release()
+        self._drop_client(client)
+
+    def _drop_client(self, client: str):
+        entry = self._clients[client]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._clients[client]
+
+
+async def guard_stream(
+    body: AsyncIterator[bytes],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    on_close: Callable[[], None],
+    on_disconnect: Callable[[], None] = lambda: None,
+    check_interval: float = 0.5,
+) -> AsyncIterator[bytes]:
+    """
+    Relay body, stopping the upstream read as soon as the client is gone
+    rather than whenever the next write happens to fail. The upstream
+    generator is always closed explicitly, then on_close runs.
+    """
+    try:
+        last_check = time.monotonic()
+        async for chunk in body:
+            yield chunk
+            now = time.monotonic()
+            if now - last_check >= check_interval:
+                last_check = now
+                if await is_disconnected():
+                    on_disconnect()
+                    break
+    finally:
+        try:
+            # Shielded so a cancelled response still releases the upstream connection
+            with anyio.CancelScope(shield=True):
+                await body.aclose()
+        finally:
+            on_close()
@@ -0,0 +1,225 @@
+"""Per-host connection pools for every upstream the backend talks to.
+
+A single httpx.AsyncClient is used everywhere; its transport routes each
+request to a pool dedicated to the request's host, so a busy video CDN can't
+exhaust the connections AniList needs and vice versa. Pool settings come
+from UPSTREAM_POOLS, either inline JSON or a path to a JSON file:
+
+    {"default": {"max_connections": 20},
+     "graphql.anilist.co": {"max_connections": 50, "http2": true},
+     "*.example-cdn.net": {"max_connections": 100, "read": 60}}
+
+Keys are exact hosts or "*."-prefixed domain suffixes; missing fields fall
+back to the "default" entry.
+
+Every request is timed per origin and phase from the connection pool's
+trace events: waiting for a pooled connection, connecting (TCP and TLS),
+time to the first response byte, and reading the body.
+"""
+import importlib.util, json, os, time
+from dataclasses import dataclass, fields, replace
+from typing import Optional
+import httpx
+from metrics import Histogram, count_error
+
+# HTTP/2 lets concurrent calls multiplex over one connection; it needs the
+# optional `h2` package (pip install "httpx[http2]")
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Events that mark the end of waiting for a pooled connection
+POOL_ACQUIRED_EVENTS = (
+    "connection.connect_tcp.started",
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+)
+REQUEST_SENT_EVENTS = ("http11.send_request_headers.started", "http2.send_request_headers.started")
+CONNECTED_EVENTS = ("connection.connect_tcp.complete", "connection.start_tls.complete")
+HEADERS_RECEIVED_EVENTS = ("http11.receive_response_headers.complete", "http2.receive_response_headers.complete")
+
+PHASES = ("pool_wait", "connect", "ttfb", "body")
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0
+    http2: bool = True
+    connect: float = 10.0
+    read: float = 30.0
+    write: float = 30.0
+    pool: float = 10.0
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect, read=self.read, write=self.write, pool=self.pool)
+
+
+# Built-in per-host settings, applied on top of "default"
+DEFAULT_HOST_SETTINGS = {
+    # Small JSON requests, multiplexed over HTTP/2 when available
+    "graphql.anilist.co": {"max_keepalive_connections": 20},
+}
+
+
+def load_pool_configs(raw: Optional[str] = None, aliases: Optional[dict[str, str]] = None) -> dict[str, PoolConfig]:
+    """
+    Built-in settings overlaid with UPSTREAM_POOLS. aliases maps a host to
+    the one whose settings it takes, such as a mirror or a local stub
+    standing in for AniList.
+    """
+    raw = os.getenv("UPSTREAM_POOLS", "") if raw is None else raw
+    if raw and not raw.lstrip().startswith("{"):
+        with open(raw) as f:
+            raw = f.read()
+    overrides = json.loads(raw) if raw else {}
+    aliases = {host: target for host, target in (aliases or {}).items() if host != target}
+
+    default = replace(PoolConfig(), **_pick(overrides.get("default", {})))
+    configs = {"default": default}
+    for host in {**DEFAULT_HOST_SETTINGS, **overrides, **aliases}:
+        if host != "default":
+            settings = {}
+            for source in (aliases.get(host), host):
+                settings.update(DEFAULT_HOST_SETTINGS.get(source, {}), **overrides.get(source, {}))
+            configs[host] = replace(default, **_pick(settings))
+    return configs
+
+
+def _pick(values: dict) -> dict:
+    unknown = set(values) - {field.name for field in fields(PoolConfig)}
+    if unknown:
+        raise ValueError(f"Unknown upstream pool settings: {', '.join(sorted(unknown))}")
+    return values
+
+
+class UpstreamPools(httpx.AsyncBaseTransport):
+    """Transport that keeps a separate connection pool per upstream host and port"""
+
+    def __init__(self, configs: dict[str, PoolConfig]):
+        self.configs = configs
+        self._transports: dict[str, httpx.AsyncHTTPTransport] = {}
+        self.phases: dict[str, dict[str, Histogram]] = {}
+        self.requests: dict[str, int] = {}
+        self.bytes_received: dict[str, int] = {}
+
+    @property
+    def default_timeout(self) -> httpx.Timeout:
+        return self.configs["default"].timeout
+
+    def config_for(self, host: str) -> PoolConfig:
+        if host in self.configs:
+            return self.configs[host]
+        for pattern, config in self.configs.items():
+            if pattern.startswith("*.") and host.endswith(pattern[1:]):
+                return config
+        return self.configs["default"]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        origin = f"{host}:{request.url.port}" if request.url.port else host
+        transport = self._transports.get(origin) or self._open(origin, host)
+        config = self.config_for(host)
+
+        # Host timeouts replace the client-wide default, explicit per-request ones win
+        if request.extensions.get("timeout") == self.default_timeout.as_dict():
+            request.extensions["timeout"] = config.timeout.as_dict()
+
+        started = time.perf_counter()
+        phases = self.phases[origin]
+        marks: dict[str, float] = {}
+        outer_trace = request.extensions.get("trace")
+
+        async def trace(event: str, info: dict):
+            now = time.perf_counter()
+            if "acquired" not in marks and event in POOL_ACQUIRED_EVENTS:
+                marks["acquired"] = now
+                phases["pool_wait"].observe(now - started)
+            if event == "connection.connect_tcp.started":
+                marks["connecting"] = now
+            elif event in CONNECTED_EVENTS:
+                marks["connected"] = now
+            elif event in REQUEST_SENT_EVENTS:
+                marks["sent"] = now
+                if "connecting" in marks and "connected" in marks:
+                    phases["connect"].observe(marks["connected"] - marks["connecting"])
+            elif event in HEADERS_RECEIVED_EVENTS and "sent" in marks:
+                phases["ttfb"].observe(now - marks["sent"])
+            if outer_trace is not None:
+                await outer_trace(event, info)
+
+        request.extensions["trace"] = trace
+        self.requests[origin] += 1
+        try:
+            response = await transport.handle_async_request(request)
+        except Exception as e:
+            count_error(f"upstream {origin}", e)
+            raise
+        response.stream = MeteredStream(response.stream, self, origin)
+        return response
+
+    async def aclose(self):
+        for transport in self._transports.values():
+            await transport.aclose()
+        self._transports.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            origin: {"requests": self.requests[origin], "pool_wait": self.phases[origin]["pool_wait"].snapshot()}
+            for origin in self._transports
+        }
+
+    def collect(self):
+        """Metrics for the /metrics endpoint, see metrics.Registry.register"""
+        yield "upstream_requests_total", "counter", "Requests sent per upstream origin", [
+            ({"host": origin}, count) for origin, count in self.requests.items()
+        ]
+        yield "upstream_received_bytes_total", "counter", "Response body bytes read per upstream origin", [
+            ({"host": origin}, count) for origin, count in self.bytes_received.items()
+        ]
+        yield "upstream_phase_seconds", "histogram", "Upstream request time per origin and phase", [
+            ({"host": origin, "phase": phase}, histogram)
+            for origin, phases in self.phases.items() for phase, histogram in phases.items()
+        ]
+
+    def _open(self, origin: str, host: str) -> httpx.AsyncHTTPTransport:
+        config = self.config_for(host)
+        transport = httpx.AsyncHTTPTransport(
+            http2=config.http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+        )
+        self._transports[origin] = transport
+        self.phases[origin] = {phase: Histogram() for phase in PHASES}
+        self.requests[origin] = 0
+        self.bytes_received[origin] = 0
+        return transport
+
+
+class MeteredStream(httpx.AsyncByteStream):
+    """Response body that counts its bytes and times how long it took to read"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, pools: UpstreamPools, origin: str):
+        self._stream = stream
+        self._pools = pools
+        self._origin = origin
+        self._started = time.perf_counter()
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._pools.bytes_received[self._origin] += len(chunk)
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._pools.phases[self._origin]["body"].observe(time.perf_counter() - self._started)
+        await self._stream.aclose()
+
+
+def create_client(pools: UpstreamPools) -> httpx.AsyncClient:
+    return httpx.AsyncClient(follow_redirects=True, transport=pools, timeout=pools.default_timeout)
@@ -0,0 +1,201 @@
+"""Cache warming for episodes of popular shows the moment they air.
+
+The first viewers of a fresh episode otherwise pay for scraping its
+sources, probing the video and pulling its first blocks from a cold
+upstream, all at once. A Warmer ranks shows by their place on the
+trending and latest lists plus how often they were opened recently, and
+when the airing schedule announces a new episode of one of the top shows
+it resolves that episode's sources and pulls the first few MB of the best
+one into the proxy's chunk cache ahead of the crowd. Sources often appear
+some minutes after air time, so empty results are retried on a backoff.
+Resolver calls and downloaded bytes both come out of hourly budgets.
+"""
+import asyncio, math, time
+from collections import deque
+from typing import Awaitable, Callable
+from airing import AiringSchedule
+
+
+class Budget:
+    """At most `limit` units spent over any rolling `window` seconds"""
+
+    def __init__(self, limit: float, window: float = 3600.0):
+        self.limit = limit
+        self.window = window
+        self._spent: deque[tuple[float, float]] = deque()
+        self._total = 0.0
+
+    def remaining(self) -> float:
+        cutoff = time.monotonic() - self.window
+        while self._spent and self._spent[0][0] < cutoff:
+            self._total -= self._spent.popleft()[1]
+        return max(0.0, self.limit - self._total)
+
+    def spend(self, amount: float):
+        self._spent.append((time.monotonic(), amount))
+        self._total += amount
+
+
+class Warmer:
+    def __init__(
+        self,
+        schedule: AiringSchedule,
+        candidates: Callable[[], Awaitable[list[list[tuple[int, str]]]]],
+        resolve: Callable[[int, str, int], Awaitable[list[dict]]],
+        warm_source: Callable[[dict, int], Awaitable[int]],
+        resolve_budget: Budget,
+        byte_budget: Budget,
+        top_n: int = 20,
+        warm_bytes: int = 8 * 1024 * 1024,
+        retry_delays: tuple[float, ...] = (0, 120, 300, 600, 1200),
+        lists_interval: float = 600.0,
+        view_half_life: float = 86400.0,
+        concurrency: int = 2,
+    ):
+        self.schedule = schedule
+        # Ranked lists of (media id, title), best first
+        self.candidates = candidates
+        # (media id, title, episode) -> playable sources, best first
+        self.resolve = resolve
+        # (source, max bytes) -> bytes downloaded into the cache
+        self.warm_source = warm_source
+        self.resolve_budget = resolve_budget
+        self.byte_budget = byte_budget
+        self.top_n = top_n
+        self.warm_bytes = warm_bytes
+        self.retry_delays = retry_delays
+        self.lists_interval = lists_interval
+        self.view_half_life = view_half_life
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._titles: dict[int, str] = {}
+        self._list_scores: dict[int, float] = {}
+        # media id -> (decayed view count, when it was last decayed)
+        self._views: dict[int, tuple[float, float]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._warming: set[tuple[int, int]] = set()
+        self.stats = {
+            "events": 0, "warmed": 0, "bytes": 0, "attempts": 0, "not_ready": 0, "errors": 0,
+            "skipped_rank": 0, "skipped_budget": 0,
+        }
+
+    def start(self):
+        if not self._tasks:
+            for job in (self._follow_lists(), self._follow_releases()):
+                self._spawn(job)
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, job):
+        task = asyncio.create_task(job)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def record_view(self, media_id: int, title: str):
+        """Count someone opening a show's sources"""
+        now = time.monotonic()
+        count, at = self._views.get(media_id, (0.0, now))
+        self._views[media_id] = (self._decayed(count, at, now) + 1, now)
+        self._titles.setdefault(media_id, title)
+
+    def _decayed(self, count: float, at: float, now: float) -> float:
+        return count * 0.5 ** ((now - at) / self.view_half_life)
+
+    def ranking(self) -> list[tuple[int, float]]:
+        """Shows by warming priority, the top_n that would be warmed"""
+        now = time.monotonic()
+        scores = dict(self._list_scores)
+        for media_id, (count, at) in self._views.items():
+            scores[media_id] = scores.get(media_id, 0.0) + self._decayed(count, at, now)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:self.top_n]
+
+    async def _follow_lists(self):
+        while True:
+            try:
+                lists = await self.candidates()
+                scores: dict[int, float] = {}
+                for ranked in lists:
+                    # A list's first entry is worth a few recent views, its last next to nothing
+                    for position, (media_id, title) in enumerate(ranked):
+                        scores[media_id] = scores.get(media_id, 0.0) + 5.0 * (1 - position / len(ranked))
+                        self._titles[media_id] = title
+                self._list_scores = scores
+                # Make sure the schedule announces these shows' releases
+                self.schedule.watch(scores)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # AniList unreachable, keep the previous lists
+                self.stats["errors"] += 1
+            await asyncio.sleep(self.lists_interval)
+
+    async def _follow_releases(self):
+        async for event in self.schedule.subscribe(max_queue=1000):
+            if event is None:
+                continue
+            self.stats["events"] += 1
+            media_id, episode = event["mediaId"], event["episode"]
+            if media_id not in dict(self.ranking()) or media_id not in self._titles:
+                self.stats["skipped_rank"] += 1
+                continue
+            if (media_id, episode) not in self._warming:
+                self._warming.add((media_id, episode))
+                self._spawn(self._warm(media_id, episode))
+
+    async def _warm(self, media_id: int, episode: int):
+        try:
+            for delay in self.retry_delays:
+                await asyncio.sleep(delay)
+                async with self._semaphore:
+                    if await self._attempt(media_id, episode):
+                        return
+        finally:
+            self._warming.discard((media_id, episode))
+
+    async def _attempt(self, media_id: int, episode: int) -> bool:
+        """One try at warming an episode, True when there is nothing left to do"""
+        if self.resolve_budget.remaining() < 1:
+            self.stats["skipped_budget"] += 1
+            return True
+        self.resolve_budget.spend(1)
+        self.stats["attempts"] += 1
+        try:
+            sources = await self.resolve(media_id, self._titles[media_id], episode)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            return False
+        if not sources:
+            self.stats["not_ready"] += 1
+            return False
+
+        allowance = min(self.warm_bytes, self.byte_budget.remaining())
+        if allowance <= 0:
+            # Sources are resolved and cached, only the bytes are skipped
+            self.stats["skipped_budget"] += 1
+            return True
+        try:
+            fetched = await self.warm_source(sources[0], math.floor(allowance))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            return True
+        self.byte_budget.spend(fetched)
+        self.stats["bytes"] += fetched
+        self.stats["warmed"] += 1
+        return True
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "warming": len(self._warming),
+            "resolves_left": self.resolve_budget.remaining(),
+            "bytes_left": int(self.byte_budget.remaining()),
+            "top": [{"mediaId": media_id, "score": round(score, 2)} for media_id, score in self.ranking()[:10]],
+        }
@@ -54,6 +54,14 @@ interface ContinueWatchingEntry {
   media: Anime;
 }
 
+interface HomeResponse {
+  trending: Partial<ApiResponse>;
+  popular: Partial<ApiResponse>;
+  latest: Partial<ApiResponse>;
+  user: AniListUser | null;
+  continueWatching: { entries: ContinueWatchingEntry[] } | null;
+}
+
 export default function Home() {
   const [trending, setTrending] = useState<Anime[]>([]);
   const [popular, setPopular] = useState<Anime[]>([]);
@@ -70,7 +78,6 @@ export default function Home() {
 
     if (storedToken) {
       setAccessToken(storedToken);
-      fetchAniListUser(storedToken);
     }
 
     // Handle OAuth callback
@@ -103,6 +110,7 @@ export default function Home() {
         setAccessToken(token);
         localStorage.setItem("anilist_token", token);
         localStorage.setItem("anilist_user", JSON.stringify(userData));
+        fetchContinueWatching(token);
       }
     } catch (error) {
       console.error("Error fetching AniList user:", error);
@@ -111,14 +119,12 @@ export default function Home() {
   const [user, setUser] = useState<AniListUser | null>(null);
 
   // Fetch continue watching data
-  const fetchContinueWatching = async () => {
-    if (!accessToken) return;
-
+  const fetchContinueWatching = async (token: string) => {
     try {
       const response = await fetch("/api/continue-watching", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ access_token: accessToken }),
+        body: JSON.stringify({ access_token: token }),
       });
 
       if (response.ok) {
@@ -151,25 +157,33 @@ export default function Home() {
     setContinueWatching([]);
   };
 
-  // Fetch data from API
+  // Fetch every homepage section, and the stored user's, in one request
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [trendingRes, popularRes, latestRes] = await Promise.all([
-          fetch("/api/trending?per_page=12"),
-          fetch("/api/popular?per_page=12"),
-          fetch("/api/latest?per_page=12"),
-        ]);
-
-        const [trendingData, popularData, latestData] = await Promise.all([
-          trendingRes.json() as Promise<ApiResponse>,
-          popularRes.json() as Promise<ApiResponse>,
-          latestRes.json() as Promise<ApiResponse>,
-        ]);
-
-        setTrending(trendingData.media || []);
-        setPopular(popularData.media || []);
-        setLatest(latestData.media || []);
+        const storedToken = localStorage.getItem("anilist_token");
+        const storedUser = localStorage.getItem("anilist_user");
+
+        const response = await fetch("/api/home", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({
+            per_page: 12,
+            access_token: storedToken,
+            user_id: storedUser ? JSON.parse(storedUser).id : null,
+          }),
+        });
+        const data: HomeResponse = await response.json();
+
+        setTrending(data.trending.media || []);
+        setPopular(data.popular.media || []);
+        setLatest(data.latest.media || []);
+
+        if (data.user) {
+          setUser(data.user);
+          localStorage.setItem("anilist_user", JSON.stringify(data.user));
+          setContinueWatching(data.continueWatching?.entries || []);
+        }
       } catch (error) {
         console.error("Error fetching anime data:", error);
       } finally {
@@ -180,13 +194,6 @@ export default function Home() {
     fetchData();
   }, []);
 
-  // Fetch continue watching when user is authenticated
-  useEffect(() => {
-    if (user && accessToken) {
-      fetchContinueWatching();
-    }
-  }, [user, accessToken]);
-
   // Transform API data to component format
   const transformAnime = (anime: Anime[]) =>
     anime.map((item) => ({
@@ -13,6 +13,8 @@ interface Source {
   url: string;
   source: string;
   referrer: string;
+  resolver?: string;
+  reachable?: boolean;
 }
 
 interface AnimeDetails {
@@ -136,27 +138,56 @@ export default function PlayerPage() {
   useEffect(() => {
     if (!animeId || !animeTitle) return;
 
+    const controller = new AbortController();
+
+    // Sources arrive one JSON line at a time as resolvers confirm them, so
+    // playback starts on the first one while the rest are still coming in
     const fetchSources = async () => {
       setLoadingSources(true);
+      setSources([]);
+      setSelectedSource(null);
       try {
         const res = await fetch(
-          `/api/sources?anilist_id=${animeId}&episode=${currentEpisode}&dub=${dubParam}&title=${encodeURIComponent(
+          `/api/sources/stream?anilist_id=${animeId}&episode=${currentEpisode}&dub=${dubParam}&title=${encodeURIComponent(
             animeTitle
-          )}`
+          )}`,
+          { signal: controller.signal }
         );
-        const data = await res.json();
-        const newSources = data.sources || [];
-        setSources(newSources);
-        if (newSources.length) setSelectedSource(newSources[0]);
+        if (!res.body) throw new Error("Failed to fetch sources");
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = "";
+        let first = true;
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffered += decoder.decode(value, { stream: true });
+          const lines = buffered.split("\n");
+          buffered = lines.pop() || "";
+          for (const line of lines) {
+            if (!line) continue;
+            const event = JSON.parse(line);
+            if (event.error) console.error("Error fetching sources:", event.error);
+            if (!event.source) continue;
+            setSources((current) => [...current, event.source]);
+            if (first) {
+              first = false;
+              setSelectedSource(event.source);
+              setLoadingSources(false);
+            }
+          }
+        }
       } catch (e) {
+        if (controller.signal.aborted) return;
         console.error(e);
-        setSources([]);
       } finally {
-        setLoadingSources(false);
+        if (!controller.signal.aborted) setLoadingSources(false);
       }
     };
 
     fetchSources();
+    return () => controller.abort();
   }, [animeId, animeTitle, currentEpisode, dubParam]);
 
   // Reset sync progress when episode changes
@@ -226,11 +257,15 @@ export default function PlayerPage() {
 
     // Update source if selectedSource exists
     if (selectedSource && playerRef.current) {
-      const proxyUrl = `/api/proxy?url=${encodeURIComponent(
+      const isHls = /\.m3u8($|\?)/i.test(selectedSource.url);
+      const proxyUrl = `/api/proxy${isHls ? "/hls" : ""}?url=${encodeURIComponent(
         selectedSource.url
       )}&ref=${encodeURIComponent(selectedSource.referrer)}`;
       console.log("🎥 Updating player source to:", proxyUrl);
-      playerRef.current.src({ src: proxyUrl, type: "video/mp4" });
+      playerRef.current.src({
+        src: proxyUrl,
+        type: isHls ? "application/x-mpegURL" : "video/mp4",
+      });
       playerRef.current.load();
 
       // Seek to saved time once video is ready
@@ -42,7 +42,7 @@ export default function PopularPage() {
       if (page === 1) setLoading(true);
       else setLoadingMore(true);
 
-      const response = await fetch(`/api/popular?page=${page}&per_page=20`);
+      const response = await fetch(`/api/popular?page=${page}&per_page=20&view=card`);
       const data: ApiResponse = await response.json();
 
       if (append) {
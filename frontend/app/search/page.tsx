@@ -40,7 +40,7 @@ export default function SearchPage() {
     setLoading(true);
     setError("");
     try {
-      const response = await fetch(`/api/search/${encodeURIComponent(query)}`);
+      const response = await fetch(`/api/search/${encodeURIComponent(query)}?view=card`);
 
       if (!response.ok) {
         throw new Error("Failed to fetch search results");